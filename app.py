@@ -7,6 +7,24 @@ import json
 import random
 import string
 import time
+import threading
+import os
+import sqlite3
+import re
+import bisect
+import unicodedata
+import io
+import logging
+import functools
+import contextlib
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from openpyxl import Workbook
+import draws
 
 # ==============================================================================
 # 1. CẤU HÌNH HỆ THỐNG
@@ -20,6 +38,69 @@ st.set_page_config(
 
 ADMIN_PASSWORD = "admin123"
 
+# Thời gian sống (giây) của bộ nhớ đệm mỗi sheet, có thể ghi đè bằng Secrets "cache_ttl"
+DEFAULT_CACHE_TTL = 60
+
+SPREADSHEET_NAME = "QUAN_LY_GIAI_DAU_PBC"
+
+# Đường dẫn file dữ liệu khi dùng backend SQLite (Secrets "sqlite_path")
+DEFAULT_SQLITE_PATH = "quanlygd.db"
+
+# Bản sao cục bộ khi chạy offline-first (storage_backend = 'mirror'): file SQLite và chu kỳ (giây) đối soát với Google Sheets
+DEFAULT_MIRROR_PATH = "quanlygd_mirror.db"
+DEFAULT_MIRROR_SYNC_INTERVAL = 15
+
+# Hàng đợi ghi trễ cho Google Sheets: file nhật ký và chu kỳ đẩy (giây)
+DEFAULT_WRITE_JOURNAL = "write_journal.jsonl"
+DEFAULT_FLUSH_INTERVAL = 2.0
+
+# Đồng bộ gia tăng: chu kỳ (giây) tải lại toàn bộ sheet để đối soát
+DEFAULT_FULL_SYNC_INTERVAL = 300
+# Luồng nền làm mới dữ liệu dùng chung cho mọi phiên: chu kỳ (giây) tải lại các sheet
+DEFAULT_REFRESH_INTERVAL = 30
+# Số vòng giữa hai lần tải lại toàn bộ sheet; các vòng khác chỉ đọc nhật ký thay đổi và tải lại sheet có thay đổi
+DEFAULT_FULL_REFRESH_EVERY = 10
+# Nhật ký thay đổi: chu kỳ (giây) gom các mục mới ghi vào sheet 'changes'
+DEFAULT_FEED_FLUSH_INTERVAL = 2.0
+
+# Hạn mức Google Sheets API (lệnh đọc/phút/người dùng) và số lần thử lại khi gặp 429/5xx
+DEFAULT_SHEETS_QUOTA_PER_MINUTE = 60
+DEFAULT_SHEETS_BURST = 10
+DEFAULT_SHEETS_MAX_RETRIES = 5
+
+# Thao tác chậm hơn ngưỡng này (ms) được ghi log mức WARNING
+DEFAULT_SLOW_OP_MS = 1000
+# Cột phiên bản dòng: tăng 1 sau mỗi lần sửa, dùng cho đồng bộ gia tăng và kiểm tra xung đột khi ghi
+REVISION_COLUMN = 'version'
+
+# Cấu trúc cột chuẩn của từng sheet
+EXPECTED_HEADERS = {
+    'config': ['key', 'value'],
+    'systems': ['id', 'name', 'createdAt', 'updatedAt', 'version'],
+    'disciplines': ['id', 'code', 'name', 'is_exempt', 'createdAt', 'updatedAt', 'version'],
+    'contents': ['id', 'discipline_id', 'name', 'gender', 'createdAt', 'updatedAt', 'version'],
+    'units': ['id', 'name', 'manager', 'registrationCode', 'createdAt', 'updatedAt', 'version'],
+    'registrations': ['id', 'unitId', 'unitName', 'athleteName', 'gender', 'dob', 'cccd', 'studentId', 'systemName', 'ageGroup', 'registered_contents', 'rank', 'createdAt', 'updatedAt', 'version'],
+    # Mỗi dòng là một lượt đăng ký VĐV ↔ nội dung (content_id rỗng = đăng ký chung cả môn)
+    'entries': ['id', 'registrationId', 'unitId', 'discipline_id', 'content_id', 'rank', 'createdAt', 'updatedAt', 'version'],
+    # Mỗi dòng là kết quả bốc thăm của một nội dung; layout là JSON (sơ đồ loại trực tiếp hoặc các lượt)
+    'draws': ['id', 'discipline_id', 'content_id', 'format', 'seed', 'layout', 'createdAt', 'updatedAt', 'version'],
+    # Nhật ký thay đổi chỉ ghi thêm: id tăng dần (dùng làm con trỏ), before/after là JSON các cột bị đổi
+    'changes': ['id', 'at', 'origin', 'actor', 'sheet', 'docId', 'op', 'before', 'after']
+}
+
+# Kiểu dữ liệu trong bộ nhớ của các cột (cột không liệt kê giữ dạng chuỗi, kể cả mọi cột id).
+# Cột lặp lại nhiều giá trị dùng category; ngày tháng được phân tích một lần khi tải sheet
+COLUMN_TYPES = {
+    'unitId': 'category', 'unitName': 'category', 'gender': 'category', 'systemName': 'category',
+    'ageGroup': 'category', 'rank': 'category', 'discipline_id': 'category', 'content_id': 'category',
+    'dob': 'date', 'createdAt': 'datetime', 'updatedAt': 'datetime', 'version': 'int',
+}
+
+# Thứ hạng được tính huy chương
+MEDAL_RANKS = ['Nhất', 'Nhì', 'Ba']
+RANK_OPTIONS = ["", "Nhất", "Nhì", "Ba", "Khuyến Khích", "Hoàn thành"]
+
 # CSS Tùy chỉnh
 st.markdown("""
     <style>
@@ -31,6 +112,166 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+def get_setting(name, default=None):
+    """Đọc cấu hình: biến môi trường (chữ hoa) được ưu tiên, sau đó tới Secrets"""
+    env_value = os.environ.get(name.upper())
+    if env_value is not None:
+        return env_value
+    try:
+        return st.secrets.get(name, default)
+    except Exception:
+        return default
+
+# Backend lưu trữ: 'sheets' (Google Sheets), 'sqlite' (chạy cục bộ/offline)
+# hoặc 'mirror' (đọc/ghi bản sao SQLite cục bộ, tự đồng bộ với Google Sheets khi có mạng)
+STORAGE_BACKEND = str(get_setting('storage_backend', 'sheets')).lower()
+
+logger = logging.getLogger("quanlygd")
+
+# --- ĐO HIỆU NĂNG ---
+perf_logger = logging.getLogger("quanlygd.perf")
+
+class PerfRecorder:
+    """Số liệu hiệu năng dùng chung cả tiến trình: độ trễ, số lệnh gọi API và số byte theo từng thao tác/trang.
+
+    Mỗi luồng giữ một ngăn xếp các phép đo đang mở; lệnh gọi API và byte truyền đi được cộng cho mọi phép đo
+    trong ngăn xếp, nên số liệu của một trang đã bao gồm các thao tác lưu trữ bên trong nó.
+    """
+    SAMPLE_SIZE = 200
+    COLUMNS = ['Loại', 'Tên', 'Số lần', 'TB (ms)', 'p95 (ms)', 'Max (ms)', 'Lệnh gọi API', 'KB']
+
+    def __init__(self, slow_ms=DEFAULT_SLOW_OP_MS):
+        self.slow_ms = slow_ms
+        self.started_at = time.time()
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _frames(self):
+        frames = getattr(self._local, 'frames', None)
+        if frames is None:
+            frames = self._local.frames = []
+        return frames
+
+    def add_api_call(self):
+        for frame in self._frames():
+            frame['api_calls'] += 1
+
+    def add_bytes(self, n):
+        for frame in self._frames():
+            frame['bytes'] += n
+
+    def begin_run(self):
+        """Bắt đầu một lượt chạy script: các phép đo sau đó trong luồng này được ghi vào danh sách trả về"""
+        self._local.run_log = []
+        return self._local.run_log
+
+    @contextlib.contextmanager
+    def measure(self, kind, name):
+        frames = self._frames()
+        frame = {'api_calls': 0, 'bytes': 0}
+        frames.append(frame)
+        started = time.perf_counter()
+        try:
+            yield frame
+        finally:
+            elapsed = time.perf_counter() - started
+            frames.pop()
+            self._record(kind, name, elapsed, frame, len(frames))
+
+    def _record(self, kind, name, elapsed, frame, depth):
+        with self._lock:
+            stat = self._stats.get((kind, name))
+            if stat is None:
+                stat = self._stats[(kind, name)] = {'count': 0, 'total': 0.0, 'max': 0.0, 'api_calls': 0, 'bytes': 0,
+                                                    'samples': deque(maxlen=self.SAMPLE_SIZE)}
+            stat['count'] += 1
+            stat['total'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+            stat['api_calls'] += frame['api_calls']
+            stat['bytes'] += frame['bytes']
+            stat['samples'].append(elapsed)
+        event = {'kind': kind, 'name': name, 'ms': round(elapsed * 1000, 1), 'api_calls': frame['api_calls'],
+                 'bytes': frame['bytes'], 'depth': depth}
+        run_log = getattr(self._local, 'run_log', None)
+        if run_log is not None:
+            run_log.append(event)
+        if event['ms'] >= self.slow_ms:
+            perf_logger.warning(json.dumps(event, ensure_ascii=False))
+        else:
+            perf_logger.debug(json.dumps(event, ensure_ascii=False))
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.started_at = time.time()
+
+    def _snapshot(self):
+        with self._lock:
+            return [(kind, name, dict(stat, samples=sorted(stat['samples']))) for (kind, name), stat in sorted(self._stats.items())]
+
+    def table(self):
+        rows = []
+        for kind, name, stat in self._snapshot():
+            samples = stat['samples']
+            p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else 0.0
+            rows.append([kind, name, stat['count'], round(stat['total'] / stat['count'] * 1000, 1), round(p95 * 1000, 1),
+                         round(stat['max'] * 1000, 1), stat['api_calls'], round(stat['bytes'] / 1024, 1)])
+        return pd.DataFrame(rows, columns=self.COLUMNS)
+
+    @staticmethod
+    def _label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def prometheus_text(self, extra=None):
+        """Số liệu theo định dạng text của Prometheus; extra: {tên metric: giá trị} bổ sung dạng gauge"""
+        families = [('quanlygd_op_count_total', 'counter', 'Số lần thực hiện', lambda s: s['count']),
+                    ('quanlygd_op_seconds_total', 'counter', 'Tổng thời gian (giây)', lambda s: s['total']),
+                    ('quanlygd_op_seconds_max', 'gauge', 'Thời gian lâu nhất (giây)', lambda s: s['max']),
+                    ('quanlygd_op_api_calls_total', 'counter', 'Số lệnh gọi Google Sheets API', lambda s: s['api_calls']),
+                    ('quanlygd_op_bytes_total', 'counter', 'Số byte gửi và nhận', lambda s: s['bytes'])]
+        snapshot = self._snapshot()
+        lines = []
+        for metric, metric_type, help_text, value_of in families:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {metric_type}")
+            for kind, name, stat in snapshot:
+                lines.append(f'{metric}{{kind="{self._label(kind)}",name="{self._label(name)}"}} {value_of(stat)!r}')
+        for metric, value in (extra or {}).items():
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value!r}")
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def get_perf_recorder():
+    try:
+        slow_ms = float(get_setting('slow_op_ms', DEFAULT_SLOW_OP_MS))
+    except (TypeError, ValueError):
+        slow_ms = DEFAULT_SLOW_OP_MS
+    return PerfRecorder(slow_ms)
+
+def perf_timed(op, label_arg=0):
+    """Đo một hàm lưu trữ; nhãn là "op:<tham số thứ label_arg>" (thường là tên sheet)"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            name = f"{op}:{args[label_arg]}" if len(args) > label_arg else op
+            with get_perf_recorder().measure('storage', name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def install_byte_counter(gclient, recorder):
+    """Đếm byte gửi/nhận của mọi HTTP request mà gspread thực hiện (hook của requests.Session)"""
+    session = getattr(getattr(gclient, 'http_client', None), 'session', None) or getattr(gclient, 'session', None)
+    if session is None or not hasattr(session, 'hooks'):
+        return
+
+    def count(response, *args, **kwargs):
+        body = getattr(response.request, 'body', None) or b''
+        recorder.add_bytes(len(response.content or b'') + len(body))
+    session.hooks.setdefault('response', []).append(count)
+
 # --- KẾT NỐI GOOGLE SHEETS ---
 @st.cache_resource
 def get_gsheet_client():
@@ -47,55 +288,1447 @@ def get_gsheet_client():
         st.error(f"❌ Lỗi kết nối: {e}")
         return None
 
-client = get_gsheet_client()
+client = get_gsheet_client() if STORAGE_BACKEND in ('sheets', 'mirror') else None
+
+# --- ĐIỀU TIẾT LỆNH GỌI GOOGLE SHEETS ---
+@st.cache_resource
+def get_storage_error_classes():
+    """Lớp lỗi lưu trữ tạo một lần mỗi tiến trình (cùng lý do với get_conflict_error_class)"""
+
+    class StorageError(Exception):
+        """Lệnh gọi Google Sheets thất bại (đã thử lại nếu lỗi tạm thời)"""
+
+        def __init__(self, message, status=None, attempts=1):
+            self.status = status
+            self.attempts = attempts
+            super().__init__(message)
+
+    class RateLimitError(StorageError):
+        """Vượt hạn mức API (HTTP 429) sau khi đã thử lại"""
+
+    class ServiceUnavailableError(StorageError):
+        """Google Sheets lỗi máy chủ (5xx) hoặc mất kết nối sau khi đã thử lại"""
+
+    return StorageError, RateLimitError, ServiceUnavailableError
+
+StorageError, RateLimitError, ServiceUnavailableError = get_storage_error_classes()
+
+class SheetsGovernor:
+    """Mọi lệnh gọi gspread đi qua đây:
+    - token bucket giới hạn số lệnh/phút theo hạn mức của project (các phiên và luồng nền dùng chung)
+    - gặp 429/5xx hoặc lỗi mạng thì thử lại với backoff lũy thừa + jitter, hết lượt thì ném lỗi có kiểu
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    # Lệnh ghi không lặp lại an toàn: lỗi 5xx có thể đã ghi xong nên chỉ thử lại khi bị 429
+    NON_IDEMPOTENT = {'append_row', 'append_rows', 'delete_rows', 'add_worksheet'}
+
+    def __init__(self, per_minute=60, burst=10, max_retries=5, base_delay=1.0, max_delay=32.0, recorder=None):
+        self.recorder = recorder
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, min(burst, per_minute))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.throttled_seconds = 0.0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.calls += 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.throttled_seconds += wait
+            time.sleep(wait)
+
+    @staticmethod
+    def _status(error):
+        response = getattr(error, 'response', None)
+        code = getattr(error, 'code', None) or getattr(response, 'status_code', None)
+        try:
+            return int(code)
+        except (TypeError, ValueError):
+            return None
+
+    def _delay(self, error, attempt):
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        try:
+            return min(self.max_delay, float(headers.get('Retry-After')))
+        except (TypeError, ValueError):
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, method_name, fn, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        retry_server_errors = method_name not in self.NON_IDEMPOTENT
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            if self.recorder is not None:
+                self.recorder.add_api_call()
+            try:
+                return fn(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                error, status = e, self._status(e)
+                if status not in self.RETRY_STATUSES:
+                    self.failures += 1
+                    raise StorageError(f"Google Sheets từ chối lệnh {method_name}: {e}", status, attempt + 1) from e
+                if status != 429 and not retry_server_errors:
+                    break
+            except OSError as e:
+                # requests.RequestException cũng là OSError (mất mạng, hết thời gian chờ)
+                error, status = e, None
+                if not retry_server_errors:
+                    break
+            if attempt < self.max_retries:
+                self.retries += 1
+                time.sleep(self._delay(error, attempt))
+        self.failures += 1
+        attempts = attempt + 1
+        if status == 429:
+            raise RateLimitError(f"Google Sheets đang quá tải hạn mức truy cập (429) sau {attempts} lần thử", status, attempts) from error
+        raise ServiceUnavailableError(f"Không kết nối được Google Sheets ({status or error}) sau {attempts} lần thử", status, attempts) from error
+
+    def summary(self):
+        return {'calls': self.calls, 'retries': self.retries, 'failures': self.failures, 'throttled_seconds': self.throttled_seconds}
+
+class GovernedHandle:
+    """Bọc Client/Spreadsheet/Worksheet của gspread để mọi phương thức đều gọi qua SheetsGovernor"""
+
+    def __init__(self, target, governor):
+        self._target = target
+        self._governor = governor
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def governed(*args, **kwargs):
+            result = self._governor.call(name, attr, args, kwargs)
+            if isinstance(result, (gspread.Spreadsheet, gspread.Worksheet)):
+                return GovernedHandle(result, self._governor)
+            return result
+        return governed
+
+def get_int_setting(name, default):
+    try:
+        return int(get_setting(name, default))
+    except (TypeError, ValueError):
+        return default
+
+@st.cache_resource
+def get_sheets_governor():
+    return SheetsGovernor(per_minute=get_int_setting('sheets_quota_per_minute', DEFAULT_SHEETS_QUOTA_PER_MINUTE),
+                          burst=get_int_setting('sheets_burst', DEFAULT_SHEETS_BURST),
+                          max_retries=get_int_setting('sheets_max_retries', DEFAULT_SHEETS_MAX_RETRIES),
+                          recorder=get_perf_recorder())
+
+# --- BỘ NHỚ ĐỆM DỮ LIỆU ---
+class RunSnapshot:
+    """Dữ liệu một lượt chạy trang đã dùng: mỗi sheet lấy một lần, các lần đọc sau trong lượt dùng lại đúng bản đó"""
+
+    def __init__(self):
+        self.frames = {}
+        self.derived = {}
+        self.reads = {}
+
+    def get(self, sheet_name):
+        df = self.frames.get(sheet_name)
+        if df is not None:
+            self.reads[sheet_name][1] += 1
+        return df
+
+    def pin(self, sheet_name, df, source):
+        self.frames[sheet_name] = df
+        self.reads.setdefault(sheet_name, [source, 0])
+        self.reads[sheet_name][0] = source
+        self.reads[sheet_name][1] += 1
+
+    def drop(self, sheet_name=None):
+        """Bỏ bản đã ghim (sau khi chính lượt này ghi vào sheet) để lần đọc sau lấy dữ liệu mới"""
+        if sheet_name is None:
+            self.frames.clear()
+            self.derived.clear()
+        else:
+            self.frames.pop(sheet_name, None)
+            self.derived.pop(sheet_name, None)
+
+    def summary(self):
+        """Các sheet lượt chạy đã cần: nguồn lấy dữ liệu và số lần đọc"""
+        return pd.DataFrame([{'sheet': name, 'source': source, 'reads': reads} for name, (source, reads) in self.reads.items()],
+                            columns=['sheet', 'source', 'reads'])
+
+class SheetCache:
+    """Bộ nhớ đệm đọc-xuyên (read-through) theo từng sheet, có TTL và xóa có chọn lọc.
+
+    Mỗi sheet chỉ có một luồng tải tại một thời điểm: các phiên cùng lỡ cache sẽ chờ và dùng chung kết quả.
+    Mỗi lần xóa tăng "thế hệ" của sheet, dữ liệu tải từ trước lần xóa sẽ không được ghi đè vào cache.
+    Trong khối pinned(), luồng hiện tại đọc mỗi sheet tối đa một lần (RunSnapshot).
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._generations = {}
+        self._epoch = 0
+        self._load_locks = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def pinned(self):
+        previous = self.snapshot()
+        self._local.snapshot = RunSnapshot()
+        try:
+            yield self._local.snapshot
+        finally:
+            self._local.snapshot = previous
+
+    def snapshot(self):
+        return getattr(self._local, 'snapshot', None)
+
+    def get(self, sheet_name):
+        with self._lock:
+            entry = self._entries.get(sheet_name)
+        if entry is None:
+            return None
+        loaded_at, df = entry
+        if time.monotonic() - loaded_at > self.ttl:
+            return None
+        # Trả bản sao để các trang có thể sửa cột (astype...) mà không làm bẩn cache
+        return df.copy()
+
+    def peek(self, sheet_name):
+        """DataFrame đang giữ (không sao chép, bỏ qua TTL) — chỉ dùng để so sánh"""
+        with self._lock:
+            entry = self._entries.get(sheet_name)
+        return None if entry is None else entry[1]
+
+    def generation(self, sheet_name):
+        with self._lock:
+            return self._epoch, self._generations.get(sheet_name, 0)
+
+    def put(self, sheet_name, df, generation=None):
+        """Lưu vào cache; trả về False (không lưu) nếu sheet đã bị xóa cache kể từ thế hệ generation"""
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(sheet_name, 0)):
+                return False
+            self._entries[sheet_name] = (time.monotonic(), df.copy())
+            return True
+
+    def touch(self, sheet_names):
+        """Gia hạn TTL cho các sheet đang giữ khi biết chắc chúng chưa đổi (vd. nhật ký không có mục mới)"""
+        now = time.monotonic()
+        with self._lock:
+            for name in sheet_names:
+                if name in self._entries:
+                    self._entries[name] = (now, self._entries[name][1])
+
+    def invalidate(self, sheet_name=None):
+        snapshot = self.snapshot()
+        if snapshot is not None:
+            snapshot.drop(sheet_name)
+        with self._lock:
+            if sheet_name is None:
+                self._entries.clear()
+                self._epoch += 1
+            else:
+                self._entries.pop(sheet_name, None)
+                self._generations[sheet_name] = self._generations.get(sheet_name, 0) + 1
+
+    def _load_lock(self, sheet_name):
+        with self._lock:
+            return self._load_locks.setdefault(sheet_name, threading.RLock())
+
+    def load(self, sheet_name, loader):
+        """Tải lại sheet qua loader(sheet_name) và lưu vào cache; trả về (dữ liệu cũ, dữ liệu mới, đã lưu)"""
+        with self._load_lock(sheet_name):
+            previous = self.peek(sheet_name)
+            generation = self.generation(sheet_name)
+            df = loader(sheet_name)
+            return previous, df, self.put(sheet_name, df, generation)
+
+    def get_or_load(self, sheet_name, loader):
+        with self._load_lock(sheet_name):
+            cached = self.get(sheet_name)
+            if cached is not None:
+                return cached
+            return self.load(sheet_name, loader)[1]
+
+    def memory_usage(self):
+        """Số byte bộ nhớ của từng sheet đang giữ"""
+        with self._lock:
+            frames = {name: df for name, (_, df) in self._entries.items()}
+        return {name: int(df.memory_usage(deep=True).sum()) for name, df in frames.items()}
+
+    def ages(self):
+        """Tuổi (giây) của dữ liệu đang giữ cho từng sheet"""
+        now = time.monotonic()
+        with self._lock:
+            return {name: now - loaded_at for name, (loaded_at, _) in self._entries.items()}
+
+def get_cache_ttl():
+    try:
+        return float(get_setting("cache_ttl", DEFAULT_CACHE_TTL))
+    except (TypeError, ValueError):
+        return DEFAULT_CACHE_TTL
+
+@st.cache_resource
+def get_sheet_cache():
+    return SheetCache(get_cache_ttl())
 
 # --- HÀM KIỂM TRA VÀ CẬP NHẬT HEADER ---
 def sync_headers(ws, sheet_name):
-    expected_headers = {
-        'config': ['key', 'value'],
-        'systems': ['id', 'name', 'createdAt'],
-        'disciplines': ['id', 'code', 'name', 'is_exempt', 'createdAt'],
-        'contents': ['id', 'discipline_id', 'name', 'gender', 'createdAt'],
-        'units': ['id', 'name', 'manager', 'registrationCode', 'createdAt'],
-        'registrations': ['id', 'unitId', 'unitName', 'athleteName', 'gender', 'dob', 'cccd', 'studentId', 'systemName', 'ageGroup', 'registered_contents', 'rank', 'createdAt']
-    }
-    
-    if sheet_name in expected_headers:
+    """Bổ sung các cột còn thiếu vào dòng 1, trả về danh sách header sau khi đồng bộ"""
+    current_headers = ws.row_values(1)
+    if sheet_name in EXPECTED_HEADERS:
         try:
-            current_headers = ws.row_values(1)
-            missing_cols = [h for h in expected_headers[sheet_name] if h not in current_headers]
+            missing_cols = [h for h in EXPECTED_HEADERS[sheet_name] if h not in current_headers]
             if missing_cols:
                 start_col = len(current_headers) + 1
                 for i, header in enumerate(missing_cols):
                     ws.update_cell(1, start_col + i, header)
+                current_headers = current_headers + missing_cols
                 time.sleep(0.5)
-        except Exception as e:
-            print(f"Lỗi sync header: {e}")
+        except (StorageError, gspread.exceptions.GSpreadException) as e:
+            # Thiếu cột thì chỉ các cột đó không ghi được; trang vẫn đọc được dữ liệu hiện có
+            logger.exception("Lỗi sync header sheet %s: %s", sheet_name, e)
+    return current_headers
 
-# --- HÀM XỬ LÝ DỮ LIỆU ---
-def get_worksheet(sheet_name):
+# --- QUẢN LÝ HANDLE SPREADSHEET / WORKSHEET ---
+class WorksheetRegistry:
+    """Mở Spreadsheet một lần mỗi tiến trình, giữ Worksheet và bản đồ header→cột trong bộ nhớ"""
+
+    def __init__(self, gclient):
+        self.client = gclient
+        self._sh = None
+        self._worksheets = {}
+        self._headers = {}
+        self._lock = threading.RLock()
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._sh is None:
+                self._sh = self.client.open(SPREADSHEET_NAME)
+            return self._sh
+
+    @perf_timed('get_worksheet', label_arg=1)
+    def worksheet(self, sheet_name):
+        with self._lock:
+            ws = self._worksheets.get(sheet_name)
+            if ws is None:
+                sh = self.spreadsheet()
+                try:
+                    ws = sh.worksheet(sheet_name)
+                    self._set_headers(sheet_name, sync_headers(ws, sheet_name))
+                except gspread.exceptions.WorksheetNotFound:
+                    ws = sh.add_worksheet(title=sheet_name, rows=100, cols=20)
+                    headers = EXPECTED_HEADERS.get(sheet_name, [])
+                    if headers:
+                        ws.append_row(headers)
+                    self._set_headers(sheet_name, headers)
+                self._worksheets[sheet_name] = ws
+            return ws
+
+    def _set_headers(self, sheet_name, headers):
+        headers = list(headers)
+        self._headers[sheet_name] = (headers, {h: i + 1 for i, h in enumerate(headers) if h})
+
+    def headers(self, sheet_name):
+        self.worksheet(sheet_name)
+        return list(self._headers[sheet_name][0])
+
+    def column_map(self, sheet_name, keys=()):
+        """Bản đồ header→số cột; chỉ đọc lại dòng 1 khi gặp cột chưa biết (schema thay đổi)"""
+        ws = self.worksheet(sheet_name)
+        with self._lock:
+            col_map = self._headers[sheet_name][1]
+            if any(k not in col_map for k in keys):
+                self._set_headers(sheet_name, sync_headers(ws, sheet_name))
+                col_map = self._headers[sheet_name][1]
+            return dict(col_map)
+
+    def refresh(self, sheet_name=None):
+        with self._lock:
+            if sheet_name is None:
+                self._sh = None
+                self._worksheets.clear()
+                self._headers.clear()
+            else:
+                self._worksheets.pop(sheet_name, None)
+                self._headers.pop(sheet_name, None)
+
+@st.cache_resource
+def get_worksheet_registry():
+    install_byte_counter(client, get_perf_recorder())
+    return WorksheetRegistry(GovernedHandle(client, get_sheets_governor()))
+
+# --- BACKEND LƯU TRỮ ---
+@st.cache_resource
+def get_conflict_error_class():
+    """Tạo lớp lỗi một lần mỗi tiến trình: Streamlit chạy lại script ở mỗi lượt tương tác,
+    lớp khai báo ở cấp module sẽ là lớp mới và `except` không bắt được lỗi do backend đã cache ném ra"""
+
+    class ConflictError(Exception):
+        """Dòng đã bị sửa hoặc xóa từ nơi khác kể từ lúc được đọc (cột version không khớp)"""
+
+        def __init__(self, sheet_name, doc_id, expected, actual):
+            self.sheet_name = sheet_name
+            self.doc_id = doc_id
+            self.expected = expected
+            self.actual = actual
+            if actual is None:
+                detail = "dòng đã bị xóa"
+            else:
+                detail = f"phiên bản {expected} đã thành {actual}"
+            super().__init__(f"Dữ liệu '{sheet_name}' (id {doc_id}) vừa bị người khác thay đổi: {detail}")
+
+    return ConflictError
+
+ConflictError = get_conflict_error_class()
+
+def parse_version(value):
     try:
-        SPREADSHEET_NAME = "QUAN_LY_GIAI_DAU_PBC" 
-        sh = client.open(SPREADSHEET_NAME)
+        return int(str(value).strip() or 0)
+    except ValueError:
+        return 0
+
+class StorageBackend:
+    """Giao diện chung cho mọi nơi lưu trữ; các dòng dữ liệu luôn là dict {cột: giá trị}"""
+    name = ''
+
+    def read_records(self, sheet_name):
+        raise NotImplementedError
+
+    def append_rows(self, sheet_name, rows):
+        raise NotImplementedError
+
+    def update_row(self, sheet_name, doc_id, updated_data, key_col='id', expected_version=None):
+        """Trả về False nếu không tìm thấy dòng có key_col == doc_id.
+
+        Sheet có cột version: version tự tăng 1; nếu truyền expected_version mà không khớp
+        (hoặc dòng đã bị xóa) thì raise ConflictError và không ghi gì.
+        """
+        raise NotImplementedError
+
+    def delete_row(self, sheet_name, doc_id, key_col='id', expected_version=None):
+        raise NotImplementedError
+
+    def existing_ids(self, sheet_name, doc_ids, key_col='id'):
+        """Tập các id trong doc_ids hiện có dòng trên nơi lưu trữ"""
+        keys = {str(r.get(key_col, '')) for r in self.read_records(sheet_name)}
+        return {str(d) for d in doc_ids if str(d) in keys}
+
+    def update_rows(self, sheet_name, updates, key_col='id', expected_versions=None):
+        """Cập nhật nhiều dòng {doc_id: {cột: giá trị}}, trả về danh sách id không tìm thấy"""
+        expected_versions = expected_versions or {}
+        return [doc_id for doc_id, data in updates.items()
+                if not self.update_row(sheet_name, doc_id, data, key_col, expected_versions.get(doc_id))]
+
+    def delete_rows(self, sheet_name, doc_ids, key_col='id', expected_versions=None):
+        """Xóa nhiều dòng, trả về danh sách id không tìm thấy"""
+        expected_versions = expected_versions or {}
+        return [doc_id for doc_id in doc_ids if not self.delete_row(sheet_name, doc_id, key_col, expected_versions.get(doc_id))]
+
+    def refresh(self):
+        pass
+
+class GoogleSheetsBackend(StorageBackend):
+    name = 'sheets'
+
+    # Quá tỉ lệ này số dòng bị sửa thì tải lại cả sheet thay vì tải từng dòng
+    DELTA_MAX_CHANGED_RATIO = 0.25
+    # Sheet chỉ ghi thêm (id duy nhất, không sửa tại chỗ): đồng bộ gia tăng theo cột khóa là đủ dù không có cột version
+    APPEND_ONLY_SHEETS = ('changes',)
+
+    def __init__(self, registry, full_sync_interval=300):
+        self.registry = registry
+        self.full_sync_interval = full_sync_interval
+        # Chỉ mục khóa → số dòng trên sheet: {(sheet_name, key_col): {id: row}}
+        self._row_index = {}
+        self._row_count = {}
+        # Bản sao dữ liệu đã tải: {sheet_name: {'headers', 'rows', 'full_at'}}, dùng cho đồng bộ gia tăng
+        self._snapshots = {}
+        self._index_lock = threading.RLock()
+        # Tuần tự hóa bước "đọc version → ghi" trong tiến trình
+        self._write_lock = threading.Lock()
+
+    def worksheet(self, sheet_name):
+        return self.registry.worksheet(sheet_name)
+
+    # --- Chỉ mục khóa chính ---
+    @staticmethod
+    def _key_cols(sheet_name):
+        return ['key'] if sheet_name == 'config' else ['id']
+
+    def _store_index(self, sheet_name, key_col, keys):
+        index = {}
+        for i, key in enumerate(keys):
+            key = str(key)
+            if key and key not in index:
+                index[key] = i + 2  # dòng 1 là header
+        self._row_index[(sheet_name, key_col)] = index
+        self._row_count[sheet_name] = len(keys)
+        return index
+
+    def _key_index(self, sheet_name, key_col, rebuild=False):
+        with self._index_lock:
+            index = self._row_index.get((sheet_name, key_col))
+            if index is None or rebuild:
+                # Chỉ tải đúng cột khóa, tránh ws.find() quét toàn bộ sheet
+                col = self.registry.column_map(sheet_name, [key_col]).get(key_col)
+                values = self.worksheet(sheet_name).col_values(col) if col else []
+                index = self._store_index(sheet_name, key_col, values[1:])
+            return index
+
+    def existing_ids(self, sheet_name, doc_ids, key_col='id'):
+        doc_ids = [str(d) for d in doc_ids]
+        index = self._key_index(sheet_name, key_col)
+        if any(d not in index for d in doc_ids):
+            # Có thể dòng được thêm từ nơi khác: dựng lại chỉ mục một lần
+            index = self._key_index(sheet_name, key_col, rebuild=True)
+        return {d for d in doc_ids if d in index}
+
+    def _find_row(self, sheet_name, doc_id, key_col):
+        row = self._key_index(sheet_name, key_col).get(str(doc_id))
+        if row is None:
+            # Có thể dòng được thêm từ nơi khác: dựng lại chỉ mục một lần
+            row = self._key_index(sheet_name, key_col, rebuild=True).get(str(doc_id))
+        return row
+
+    @staticmethod
+    def _appended_start_row(response):
         try:
-            worksheet = sh.worksheet(sheet_name)
-            sync_headers(worksheet, sheet_name)
-        except:
-            worksheet = sh.add_worksheet(title=sheet_name, rows=100, cols=20)
-            headers = {
-                'config': ['key', 'value'],
-                'systems': ['id', 'name', 'createdAt'],
-                'disciplines': ['id', 'code', 'name', 'is_exempt', 'createdAt'],
-                'contents': ['id', 'discipline_id', 'name', 'gender', 'createdAt'],
-                'units': ['id', 'name', 'manager', 'registrationCode', 'createdAt'],
-                'registrations': ['id', 'unitId', 'unitName', 'athleteName', 'gender', 'dob', 'cccd', 'studentId', 'systemName', 'ageGroup', 'registered_contents', 'rank', 'createdAt']
-            }
-            if sheet_name in headers:
-                worksheet.append_row(headers[sheet_name])
-        return worksheet
-    except Exception as e:
-        st.error(f"⚠️ Không tìm thấy file Google Sheet '{SPREADSHEET_NAME}'.")
-        st.stop()
+            updated_range = response['updates']['updatedRange']
+            start = updated_range.split('!')[-1].split(':')[0]
+            return gspread.utils.a1_to_rowcol(start)[0]
+        except (TypeError, KeyError, IndexError, ValueError):
+            return None
+
+    # --- Đồng bộ gia tăng ---
+    @staticmethod
+    def _pad(row, width):
+        row = [str(v) for v in row[:width]]
+        return row + [''] * (width - len(row))
+
+    @staticmethod
+    def _col_letter(col):
+        return re.sub(r'\d', '', gspread.utils.rowcol_to_a1(1, col))
+
+    def _rev_cols(self, sheet_name, headers):
+        """Vị trí (0-based) các cột nhận diện phiên bản dòng: cột khóa và cột version nếu có"""
+        names = self._key_cols(sheet_name) + [REVISION_COLUMN]
+        return [headers.index(n) for n in names if n in headers]
+
+    def _reindex(self, sheet_name, snap):
+        headers = snap['headers']
+        for key_col in self._key_cols(sheet_name):
+            if key_col in headers:
+                pos = headers.index(key_col)
+                self._store_index(sheet_name, key_col, [row[pos] for row in snap['rows']])
+
+    def _full_sync(self, sheet_name):
+        values = self.worksheet(sheet_name).get_all_values()
+        headers = list(values[0]) if values else self.registry.headers(sheet_name)
+        snap = {'headers': headers, 'rows': [self._pad(r, len(headers)) for r in values[1:]], 'full_at': time.monotonic()}
+        self._snapshots[sheet_name] = snap
+        self._reindex(sheet_name, snap)
+        return snap
+
+    def _delta_sync(self, sheet_name, snap):
+        """Chỉ tải cột khóa/version; sau đó tải riêng các dòng mới hoặc có version thay đổi.
+
+        Sheet không có cột version mà sửa được tại chỗ (config) thì thay đổi không làm đổi cột khóa nên không
+        phát hiện được: các sheet này nhỏ, luôn tải lại toàn bộ. Sheet chỉ ghi thêm (changes) chỉ cần tải dòng mới.
+        """
+        headers, rows = snap['headers'], snap['rows']
+        cols = self._rev_cols(sheet_name, headers)
+        if not cols or (REVISION_COLUMN not in headers and sheet_name not in self.APPEND_ONLY_SHEETS):
+            return self._full_sync(sheet_name)
+        ws = self.worksheet(sheet_name)
+        columns = ws.batch_get([f"{self._col_letter(c + 1)}2:{self._col_letter(c + 1)}" for c in cols])
+        n_new = max((len(col) for col in columns), default=0)
+        new_revs = [tuple(str(col[i][0]) if i < len(col) and col[i] else '' for col in columns) for i in range(n_new)]
+        old_revs = [tuple(row[c] for c in cols) for row in rows]
+        if new_revs == old_revs:
+            return snap
+        n_old = len(old_revs)
+        # Có dòng bị xóa hoặc đổi chỗ: không vá được, tải lại toàn bộ
+        if n_new < n_old or any(new_revs[i][0] != old_revs[i][0] for i in range(n_old)):
+            return self._full_sync(sheet_name)
+        changed = [i for i in range(n_old) if new_revs[i] != old_revs[i]]
+        if len(changed) > self.DELTA_MAX_CHANGED_RATIO * max(n_old, 1):
+            return self._full_sync(sheet_name)
+        last = self._col_letter(len(headers))
+        ranges = [f"A{i + 2}:{last}{i + 2}" for i in changed]
+        if n_new > n_old:
+            ranges.append(f"A{n_old + 2}:{last}{n_new + 1}")
+        fetched = ws.batch_get(ranges)
+        for i, block in zip(changed, fetched):
+            rows[i] = self._pad(block[0] if block else [], len(headers))
+        if n_new > n_old:
+            block = list(fetched[-1])
+            block += [[]] * (n_new - n_old - len(block))
+            rows.extend(self._pad(r, len(headers)) for r in block)
+        self._reindex(sheet_name, snap)
+        return snap
+
+    # --- Giao diện StorageBackend ---
+    def read_records(self, sheet_name):
+        with self._index_lock:
+            snap = self._snapshots.get(sheet_name)
+            if snap is None or time.monotonic() - snap['full_at'] > self.full_sync_interval:
+                snap = self._full_sync(sheet_name)
+            else:
+                snap = self._delta_sync(sheet_name, snap)
+            headers = snap['headers']
+            return [{h: v for h, v in zip(headers, row) if h} for row in snap['rows']]
+
+    def append_rows(self, sheet_name, rows):
+        ws = self.worksheet(sheet_name)
+        keys = set().union(*(r.keys() for r in rows))
+        self.registry.column_map(sheet_name, keys)
+        headers = self.registry.headers(sheet_name)
+        values = [[str(r.get(h, "")) for h in headers] for r in rows]
+        if len(values) == 1:
+            response = ws.append_row(values[0])
+        else:
+            response = ws.append_rows(values)
+        with self._index_lock:
+            start_row = self._appended_start_row(response)
+            if start_row is None:
+                start_row = self._row_count.get(sheet_name, 0) + 2
+            snap = self._snapshots.get(sheet_name)
+            if snap is not None:
+                # Chỉ nối vào bản sao khi không có dòng nào được thêm từ nơi khác
+                if snap['headers'] == headers and start_row == len(snap['rows']) + 2:
+                    snap['rows'].extend(self._pad(v, len(headers)) for v in values)
+                else:
+                    self._snapshots.pop(sheet_name, None)
+            for key_col in self._key_cols(sheet_name):
+                index = self._row_index.get((sheet_name, key_col))
+                if index is None:
+                    continue
+                for offset, r in enumerate(rows):
+                    key = str(r.get(key_col, ''))
+                    if key:
+                        index[key] = start_row + offset
+            self._row_count[sheet_name] = start_row - 2 + len(rows)
+
+    def update_row(self, sheet_name, doc_id, updated_data, key_col='id', expected_version=None):
+        expected_versions = None if expected_version is None else {doc_id: expected_version}
+        return not self.update_rows(sheet_name, {doc_id: updated_data}, key_col, expected_versions)
+
+    @staticmethod
+    def _cell_value(value_range):
+        return str(value_range[0][0]) if value_range and value_range[0] else ''
+
+    def _verified_rows(self, sheet_name, doc_ids, key_col, col_map):
+        """Đọc lại ô khóa (và version) tại các dòng trong chỉ mục, trong một lệnh batch_get.
+
+        Nếu dòng đã bị dịch chuyển (xóa từ nơi khác) thì dựng lại chỉ mục và thử lại một lần.
+        Trả về {doc_id: (số dòng, version hiện tại)} cho các id tìm thấy.
+        """
+        ws = self.worksheet(sheet_name)
+        key_c, ver_c = col_map.get(key_col), col_map.get(REVISION_COLUMN)
+        found, pending = {}, [str(d) for d in doc_ids]
+        for attempt in range(2):
+            if not pending or key_c is None:
+                break
+            index = self._key_index(sheet_name, key_col, rebuild=attempt > 0)
+            targets = [(d, index[d]) for d in pending if d in index]
+            ranges = []
+            for _, row in targets:
+                ranges.append(gspread.utils.rowcol_to_a1(row, key_c))
+                if ver_c:
+                    ranges.append(gspread.utils.rowcol_to_a1(row, ver_c))
+            values = ws.batch_get(ranges) if ranges else []
+            step = 2 if ver_c else 1
+            for n, (d, row) in enumerate(targets):
+                if self._cell_value(values[n * step]) == d:
+                    found[d] = (row, self._cell_value(values[n * step + 1]) if ver_c else '')
+            pending = [d for d in pending if d not in found]
+        return found
+
+    def update_rows(self, sheet_name, updates, key_col='id', expected_versions=None):
+        # Kiểm tra version rồi gom mọi ô cần sửa thành một lệnh batch_update duy nhất
+        ws = self.worksheet(sheet_name)
+        keys = set().union(*(d.keys() for d in updates.values())) if updates else set()
+        col_map = self.registry.column_map(sheet_name, keys | {key_col})
+        ver_c = col_map.get(REVISION_COLUMN)
+        expected_versions = {str(k): v for k, v in (expected_versions or {}).items()}
+        with self._write_lock:
+            rows = self._verified_rows(sheet_name, list(updates), key_col, col_map)
+            missing = [doc_id for doc_id in updates if str(doc_id) not in rows]
+            for doc_id, expected in expected_versions.items():
+                if doc_id not in rows:
+                    raise ConflictError(sheet_name, doc_id, expected, None)
+                if ver_c and parse_version(rows[doc_id][1]) != parse_version(expected):
+                    raise ConflictError(sheet_name, doc_id, expected, rows[doc_id][1])
+            batch, cells = [], []
+            for doc_id, data in updates.items():
+                if str(doc_id) not in rows:
+                    continue
+                row, current_version = rows[str(doc_id)]
+                data = {k: v for k, v in data.items() if k != REVISION_COLUMN}
+                if ver_c:
+                    data[REVISION_COLUMN] = parse_version(current_version) + 1
+                for key, value in data.items():
+                    if key in col_map:
+                        batch.append({'range': gspread.utils.rowcol_to_a1(row, col_map[key]), 'values': [[str(value)]]})
+                        cells.append((row, col_map[key], str(value)))
+            if batch:
+                ws.batch_update(batch)
+                with self._index_lock:
+                    snap = self._snapshots.get(sheet_name)
+                    if snap is not None:
+                        for row, col, value in cells:
+                            if row - 2 < len(snap['rows']) and col <= len(snap['headers']):
+                                snap['rows'][row - 2][col - 1] = value
+                            else:
+                                self._snapshots.pop(sheet_name, None)
+                                break
+        return missing
+
+    def delete_row(self, sheet_name, doc_id, key_col='id', expected_version=None):
+        ws = self.worksheet(sheet_name)
+        col_map = self.registry.column_map(sheet_name, [key_col])
+        with self._write_lock:
+            found = self._verified_rows(sheet_name, [doc_id], key_col, col_map)
+            if str(doc_id) not in found:
+                if expected_version is not None:
+                    raise ConflictError(sheet_name, doc_id, expected_version, None)
+                return False
+            row, current_version = found[str(doc_id)]
+            if expected_version is not None and REVISION_COLUMN in col_map and parse_version(current_version) != parse_version(expected_version):
+                raise ConflictError(sheet_name, doc_id, expected_version, current_version)
+            ws.delete_rows(row)
+        self._forget_rows(sheet_name, [row])
+        return True
+
+    def delete_rows(self, sheet_name, doc_ids, key_col='id', expected_versions=None):
+        # Kiểm tra version cả lô trong một lần đọc, rồi mỗi đoạn dòng liền nhau xóa bằng một lệnh (từ dưới lên
+        # để số dòng của các đoạn phía trên không đổi)
+        doc_ids = list(dict.fromkeys(str(d) for d in doc_ids))
+        if not doc_ids:
+            return []
+        ws = self.worksheet(sheet_name)
+        col_map = self.registry.column_map(sheet_name, [key_col])
+        expected_versions = {str(k): v for k, v in (expected_versions or {}).items()}
+        with self._write_lock:
+            found = self._verified_rows(sheet_name, doc_ids, key_col, col_map)
+            for doc_id, expected in expected_versions.items():
+                if doc_id not in found:
+                    raise ConflictError(sheet_name, doc_id, expected, None)
+                if REVISION_COLUMN in col_map and parse_version(found[doc_id][1]) != parse_version(expected):
+                    raise ConflictError(sheet_name, doc_id, expected, found[doc_id][1])
+            spans = []
+            for row in sorted(found[d][0] for d in doc_ids if d in found):
+                if spans and spans[-1][1] == row - 1:
+                    spans[-1][1] = row
+                else:
+                    spans.append([row, row])
+            deleted = []
+            try:
+                for start, end in reversed(spans):
+                    ws.delete_rows(start, end)
+                    deleted.extend(range(start, end + 1))
+            finally:
+                self._forget_rows(sheet_name, deleted)
+        return [d for d in doc_ids if d not in found]
+
+    def _forget_rows(self, sheet_name, deleted):
+        """Bỏ các dòng vừa xóa (số dòng trên sheet) khỏi chỉ mục và bản sao; các dòng phía dưới bị đẩy lên"""
+        if not deleted:
+            return
+        deleted = sorted(deleted)
+        gone = set(deleted)
+        with self._index_lock:
+            for (name, _), index in self._row_index.items():
+                if name != sheet_name:
+                    continue
+                for key in [k for k, r in index.items() if r in gone]:
+                    del index[key]
+                for key, r in index.items():
+                    index[key] = r - bisect.bisect_left(deleted, r)
+            if sheet_name in self._row_count:
+                self._row_count[sheet_name] -= len(deleted)
+            snap = self._snapshots.get(sheet_name)
+            if snap is not None:
+                for row in reversed(deleted):
+                    if row - 2 < len(snap['rows']):
+                        del snap['rows'][row - 2]
+
+    def refresh(self):
+        self.registry.refresh()
+        with self._index_lock:
+            self._row_index.clear()
+            self._row_count.clear()
+            self._snapshots.clear()
+
+class SQLiteBackend(StorageBackend):
+    """Lưu trữ cục bộ bằng SQLite: cùng 6 bảng như Google Sheets, có chỉ mục theo khóa"""
+    name = 'sqlite'
+
+    # Chỉ mục phụ cho các truy vấn hay dùng
+    SECONDARY_INDEXES = {
+        'registrations': ['unitId'],
+        'units': ['registrationCode'],
+        'contents': ['discipline_id'],
+        'entries': ['registrationId', 'content_id', 'unitId'],
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.RLock()
+        self._tx_depth = 0
+        self._columns = {}
+        for sheet_name in EXPECTED_HEADERS:
+            self._ensure_table(sheet_name)
+
+    @staticmethod
+    def _q(name):
+        return '"' + str(name).replace('"', '""') + '"'
+
+    def _ensure_table(self, sheet_name):
+        with self.transaction():
+            headers = EXPECTED_HEADERS.get(sheet_name, ['id'])
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self._q(sheet_name)} ({', '.join(self._q(h) + ' TEXT' for h in headers)})")
+            current = [r['name'] for r in self._conn.execute(f"PRAGMA table_info({self._q(sheet_name)})")]
+            for h in headers:
+                if h not in current:
+                    self._conn.execute(f"ALTER TABLE {self._q(sheet_name)} ADD COLUMN {self._q(h)} TEXT")
+                    current.append(h)
+            key_col = 'key' if sheet_name == 'config' else 'id'
+            self._conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {self._q('ux_' + sheet_name + '_' + key_col)} ON {self._q(sheet_name)} ({self._q(key_col)})")
+            for col in self.SECONDARY_INDEXES.get(sheet_name, []):
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self._q('ix_' + sheet_name + '_' + col)} ON {self._q(sheet_name)} ({self._q(col)})")
+            self._columns[sheet_name] = current
+
+    def table_columns(self, sheet_name):
+        if sheet_name not in self._columns:
+            self._ensure_table(sheet_name)
+        return self._columns[sheet_name]
+
+    def read_records(self, sheet_name):
+        cols = self.table_columns(sheet_name)
+        with self._lock:
+            cur = self._conn.execute(f"SELECT {', '.join(self._q(c) for c in cols)} FROM {self._q(sheet_name)} ORDER BY rowid")
+            return [{c: ('' if row[c] is None else row[c]) for c in cols} for row in cur]
+
+    def append_rows(self, sheet_name, rows):
+        cols = self.table_columns(sheet_name)
+        sql = f"INSERT INTO {self._q(sheet_name)} ({', '.join(self._q(c) for c in cols)}) VALUES ({', '.join('?' for _ in cols)})"
+        with self.transaction():
+            self._conn.executemany(sql, [[str(r.get(c, "")) for c in cols] for r in rows])
+
+    def _version_sql(self):
+        return f"CAST(COALESCE(NULLIF({self._q(REVISION_COLUMN)}, ''), '0') AS INTEGER)"
+
+    def _where(self, sheet_name, doc_id, key_col, expected_version):
+        """Điều kiện WHERE theo khóa, kèm so khớp version (compare-and-set) nếu có yêu cầu"""
+        where, params = f"{self._q(key_col)} = ?", [str(doc_id)]
+        if expected_version is not None and REVISION_COLUMN in self.table_columns(sheet_name):
+            where += f" AND {self._version_sql()} = ?"
+            params.append(parse_version(expected_version))
+        return where, params
+
+    def _raise_conflict(self, sheet_name, doc_id, key_col, expected_version):
+        current = self.current_version(sheet_name, doc_id, key_col)
+        if expected_version is not None:
+            raise ConflictError(sheet_name, doc_id, expected_version, current)
+
+    def update_row(self, sheet_name, doc_id, updated_data, key_col='id', expected_version=None):
+        cols = self.table_columns(sheet_name)
+        fields = [k for k in updated_data if k in cols and k != REVISION_COLUMN]
+        sets = [self._q(k) + ' = ?' for k in fields]
+        if REVISION_COLUMN in cols:
+            sets.append(f"{self._q(REVISION_COLUMN)} = {self._version_sql()} + 1")
+        if not sets:
+            return self.current_version(sheet_name, doc_id, key_col) is not None
+        where, params = self._where(sheet_name, doc_id, key_col, expected_version)
+        with self.transaction():
+            cur = self._conn.execute(f"UPDATE {self._q(sheet_name)} SET {', '.join(sets)} WHERE {where}",
+                                     [str(updated_data[k]) for k in fields] + params)
+            if cur.rowcount == 0:
+                self._raise_conflict(sheet_name, doc_id, key_col, expected_version)
+            return cur.rowcount > 0
+
+    def delete_row(self, sheet_name, doc_id, key_col='id', expected_version=None):
+        where, params = self._where(sheet_name, doc_id, key_col, expected_version)
+        with self.transaction():
+            cur = self._conn.execute(f"DELETE FROM {self._q(sheet_name)} WHERE {where}", params)
+            if cur.rowcount == 0:
+                self._raise_conflict(sheet_name, doc_id, key_col, expected_version)
+            return cur.rowcount > 0
+
+    def delete_rows(self, sheet_name, doc_ids, key_col='id', expected_versions=None):
+        # Một giao dịch: xung đột version ở bất kỳ dòng nào thì không xóa dòng nào
+        with self.transaction():
+            return super().delete_rows(sheet_name, doc_ids, key_col, expected_versions)
+
+    def current_version(self, sheet_name, doc_id, key_col='id'):
+        """Version hiện tại của dòng ('' nếu bảng không có cột version), None nếu không có dòng"""
+        cols = self.table_columns(sheet_name)
+        select = self._q(REVISION_COLUMN) if REVISION_COLUMN in cols else "''"
+        with self._lock:
+            cur = self._conn.execute(f"SELECT {select} FROM {self._q(sheet_name)} WHERE {self._q(key_col)} = ? LIMIT 1", [str(doc_id)])
+            row = cur.fetchone()
+            return None if row is None else (row[0] or '')
+
+    def get_row(self, sheet_name, doc_id, key_col='id'):
+        """Dòng có key_col == doc_id dạng {cột: chuỗi}, None nếu không có"""
+        cols = self.table_columns(sheet_name)
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(self._q(c) for c in cols)} FROM {self._q(sheet_name)} "
+                                     f"WHERE {self._q(key_col)} = ? LIMIT 1", [str(doc_id)]).fetchone()
+        return None if row is None else {c: ('' if row[c] is None else row[c]) for c in cols}
+
+    def replace_rows(self, sheet_name, rows):
+        """Thay toàn bộ nội dung bảng bằng rows trong một giao dịch"""
+        cols = self.table_columns(sheet_name)
+        with self.transaction() as conn:
+            conn.execute(f"DELETE FROM {self._q(sheet_name)}")
+            conn.executemany(f"INSERT INTO {self._q(sheet_name)} ({', '.join(self._q(c) for c in cols)}) VALUES ({', '.join('?' for _ in cols)})",
+                             [[str(r.get(c, '')) for c in cols] for r in rows])
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Giữ khóa ghi và gom mọi lệnh trong khối thành một giao dịch (lỗi thì rollback cả khối).
+
+        Dùng cho bảng phụ phải ghi cùng giao dịch với dữ liệu (outbox của OfflineMirror);
+        các lệnh ghi của backend gọi bên trong khối cũng thuộc giao dịch này.
+        """
+        with self._lock:
+            if self._tx_depth:
+                # Lồng trong giao dịch đang mở: khối ngoài cùng commit/rollback
+                self._tx_depth += 1
+                try:
+                    yield self._conn
+                finally:
+                    self._tx_depth -= 1
+                return
+            self._tx_depth = 1
+            try:
+                with self._conn:
+                    yield self._conn
+            finally:
+                self._tx_depth = 0
+
+class WriteBehindQueue(StorageBackend):
+    """Hàng đợi ghi trễ bọc quanh một backend:
+    - gom các lệnh thêm dòng thành append_rows và các lệnh sửa thành một batch_update mỗi chu kỳ
+    - ghi nhật ký (journal) xuống đĩa để lệnh chưa đẩy lên vẫn còn sau khi khởi động lại
+    - khi đọc, áp các lệnh đang chờ lên dữ liệu để người vừa ghi thấy ngay thay đổi của mình
+    """
+
+    def __init__(self, inner, journal_path, interval=2.0, max_batch=200):
+        self.inner = inner
+        self.name = inner.name
+        self.journal_path = journal_path
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending = []
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._load_journal()
+        threading.Thread(target=self._run, name="write-behind-flusher", daemon=True).start()
+
+    # --- Nhật ký trên đĩa ---
+    def _load_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        self._pending.append(json.loads(line))
+                    except ValueError:
+                        logger.warning("Bỏ qua dòng journal hỏng: %s", line[:80])
+
+    def _append_journal(self, ops):
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            for op in ops:
+                f.write(json.dumps(op, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_journal(self):
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for op in self._pending:
+                f.write(json.dumps(op, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def _enqueue(self, ops):
+        with self._lock:
+            self._pending.extend(ops)
+            self._append_journal(ops)
+            if len(self._pending) >= self.max_batch:
+                self._wakeup.set()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    # --- Giao diện StorageBackend ---
+    def read_records(self, sheet_name):
+        records = self.inner.read_records(sheet_name)
+        with self._lock:
+            ops = [op for op in self._pending if op['sheet'] == sheet_name]
+        if not ops:
+            return records
+        records = [dict(r) for r in records]
+        n_stored = len(records)
+        by_key, bumped = {}, set()
+        for op in ops:
+            if op['op'] == 'append':
+                records.append(dict(op['row']))
+                by_key.clear()
+            elif op['op'] == 'update':
+                key_col = op['key_col']
+                if key_col not in by_key:
+                    by_key[key_col] = {}
+                    for pos, r in enumerate(records):
+                        by_key[key_col].setdefault(str(r.get(key_col, '')), (pos, r))
+                pos, target = by_key[key_col].get(op['id'], (None, None))
+                if target is not None:
+                    target.update(op['data'])
+                    # Khi đẩy lên, mọi lệnh sửa cùng một dòng được gộp lại nên version chỉ tăng 1
+                    if pos < n_stored and REVISION_COLUMN in target and (key_col, op['id']) not in bumped:
+                        target[REVISION_COLUMN] = str(parse_version(target[REVISION_COLUMN]) + 1)
+                        bumped.add((key_col, op['id']))
+        return records
+
+    def append_rows(self, sheet_name, rows):
+        self._enqueue([{'op': 'append', 'sheet': sheet_name, 'row': {k: str(v) for k, v in row.items()}} for row in rows])
+
+    def update_row(self, sheet_name, doc_id, updated_data, key_col='id', expected_version=None):
+        expected_versions = None if expected_version is None else {doc_id: expected_version}
+        return not self.update_rows(sheet_name, {doc_id: updated_data}, key_col, expected_versions)
+
+    def update_rows(self, sheet_name, updates, key_col='id', expected_versions=None):
+        if expected_versions:
+            # Ghi có kiểm tra version phải chạy ngay trên dữ liệu thật
+            self.flush()
+            return self.inner.update_rows(sheet_name, updates, key_col, expected_versions)
+        # Id không có trên nơi lưu trữ lẫn trong các dòng đang chờ thêm thì báo thiếu ngay, không xếp hàng
+        with self._lock:
+            queued = {str(op['row'].get(key_col, '')) for op in self._pending if op['op'] == 'append' and op['sheet'] == sheet_name}
+        unknown = [str(d) for d in updates if str(d) not in queued]
+        found = queued | (self.inner.existing_ids(sheet_name, unknown, key_col) if unknown else set())
+        self._enqueue([{'op': 'update', 'sheet': sheet_name, 'id': str(doc_id), 'key_col': key_col,
+                        'data': {k: str(v) for k, v in data.items()}} for doc_id, data in updates.items() if str(doc_id) in found])
+        return [doc_id for doc_id in updates if str(doc_id) not in found]
+
+    def delete_row(self, sheet_name, doc_id, key_col='id', expected_version=None):
+        # Xóa làm dịch chuyển dòng nên phải đẩy hết lệnh đang chờ trước
+        self.flush()
+        return self.inner.delete_row(sheet_name, doc_id, key_col, expected_version)
+
+    def delete_rows(self, sheet_name, doc_ids, key_col='id', expected_versions=None):
+        self.flush()
+        return self.inner.delete_rows(sheet_name, doc_ids, key_col, expected_versions)
+
+    def refresh(self):
+        self.flush()
+        self.inner.refresh()
+
+    # --- Đẩy dữ liệu ---
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending)
+            if not batch:
+                return
+            done = set()
+            try:
+                for sheet_name, key_col, appends, updates in self._coalesce(batch):
+                    if appends:
+                        self._push_appends(sheet_name, batch, *appends)
+                        done.update(appends[0])
+                    if updates:
+                        missing = self.inner.update_rows(sheet_name, updates[1], key_col)
+                        if missing:
+                            logger.warning("Bỏ qua cập nhật %s: không tìm thấy %s", sheet_name, missing)
+                        done.update(updates[0])
+            finally:
+                if done:
+                    with self._lock:
+                        flushed = {id(batch[i]) for i in done}
+                        self._pending = [op for op in self._pending if id(op) not in flushed]
+                        self._rewrite_journal()
+                    get_sheet_cache().invalidate()
+
+    def _push_appends(self, sheet_name, batch, indexes, rows):
+        """Thêm dòng lên backend; lần thêm trước lỗi 5xx/mạng (có thể đã ghi) thì bỏ các dòng đã có trước khi gửi lại"""
+        if any(batch[i].get('uncertain') for i in indexes):
+            key_col = 'key' if sheet_name == 'config' else 'id'
+            existing = self.inner.existing_ids(sheet_name, [r.get(key_col, '') for r in rows], key_col)
+            rows = [r for r in rows if str(r.get(key_col, '')) not in existing]
+        if not rows:
+            return
+        try:
+            self.inner.append_rows(sheet_name, rows)
+        except ServiceUnavailableError:
+            with self._lock:
+                for i in indexes:
+                    batch[i]['uncertain'] = True
+                self._rewrite_journal()
+            raise
+
+    @staticmethod
+    def _coalesce(batch):
+        """Gom lệnh theo sheet: (sheet, key_col, (chỉ số, dòng thêm), (chỉ số, {id: dữ liệu sửa}))"""
+        groups = {}
+        for i, op in enumerate(batch):
+            key_col = op.get('key_col', 'id')
+            g = groups.setdefault((op['sheet'], key_col), {'append_idx': [], 'rows': [], 'update_idx': [], 'updates': {}})
+            if op['op'] == 'append':
+                g['append_idx'].append(i)
+                g['rows'].append(dict(op['row']))
+            elif op['op'] == 'update':
+                # Sửa một dòng vừa thêm trong cùng lượt: gộp thẳng vào dòng thêm
+                target = next((r for r in g['rows'] if str(r.get(key_col, '')) == op['id']), None)
+                if target is not None:
+                    target.update(op['data'])
+                    g['append_idx'].append(i)
+                else:
+                    g['update_idx'].append(i)
+                    g['updates'].setdefault(op['id'], {}).update(op['data'])
+        for (sheet_name, key_col), g in groups.items():
+            appends = (g['append_idx'], g['rows']) if g['rows'] else None
+            updates = (g['update_idx'], g['updates']) if g['updates'] else None
+            yield sheet_name, key_col, appends, updates
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Lỗi đẩy hàng đợi ghi: %s", e)
+
+class OfflineMirror(StorageBackend):
+    """Bản sao SQLite cục bộ của mọi sheet: trang đọc/ghi ở tốc độ cục bộ dù Google Sheets có truy cập được hay không.
+
+    - mỗi lệnh ghi được áp vào SQLite và xếp vào bảng _outbox trong cùng một giao dịch
+    - luồng đối soát định kỳ đẩy outbox lên Google Sheets (theo thứ tự), rồi kéo về các sheet không còn lệnh chờ
+    - xung đột (dòng đã bị sửa trên Sheets kể từ version lúc sửa cục bộ): version lớn hơn thắng,
+      bằng nhau thì updatedAt mới hơn thắng; dòng bị xóa ở một phía và sửa ở phía kia thì giữ bản sửa
+    - lệnh bị Sheets từ chối hẳn (không phải lỗi mạng/5xx) được chuyển sang bảng _dead_letter để không chặn các lệnh sau
+    """
+    name = 'mirror'
+    OUTBOX = '_outbox'
+    DEAD_LETTER = '_dead_letter'
+
+    def __init__(self, local, remote, interval=DEFAULT_MIRROR_SYNC_INTERVAL):
+        self.local = local
+        self.remote = remote
+        self.interval = interval
+        self.online = None
+        self.last_sync_at = None
+        self.last_error = ''
+        self.conflicts = deque(maxlen=50)
+        self._sync_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        with self.local.transaction() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.OUTBOX} (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "sheet TEXT, op TEXT, uncertain INTEGER DEFAULT 0)")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.DEAD_LETTER} (seq INTEGER, at TEXT, sheet TEXT, op TEXT, error TEXT)")
+        if remote is not None:
+            threading.Thread(target=self._run, name="mirror-reconciler", daemon=True).start()
+
+    # --- Giao diện StorageBackend: luôn trên bản cục bộ ---
+    def read_records(self, sheet_name):
+        return self.local.read_records(sheet_name)
+
+    def _queue(self, conn, sheet_name, op):
+        # Cùng giao dịch với lệnh ghi cục bộ ngay sau đó: commit (hoặc rollback) cả hai
+        conn.execute(f"INSERT INTO {self.OUTBOX} (sheet, op) VALUES (?, ?)", [sheet_name, json.dumps(op, ensure_ascii=False)])
+
+    def append_rows(self, sheet_name, rows):
+        with self.local.transaction() as conn:
+            self._queue(conn, sheet_name, {'op': 'append', 'rows': [{k: str(v) for k, v in row.items()} for row in rows]})
+            self.local.append_rows(sheet_name, rows)
+
+    def update_row(self, sheet_name, doc_id, updated_data, key_col='id', expected_version=None):
+        with self.local.transaction() as conn:
+            base = self.local.current_version(sheet_name, doc_id, key_col)
+            if base is None:
+                if expected_version is not None:
+                    raise ConflictError(sheet_name, doc_id, expected_version, None)
+                return False
+            self._queue(conn, sheet_name, {'op': 'update', 'id': str(doc_id), 'key_col': key_col, 'base': base,
+                                     'data': {k: str(v) for k, v in updated_data.items() if k != REVISION_COLUMN}})
+            return self.local.update_row(sheet_name, doc_id, updated_data, key_col, expected_version)
+
+    def delete_row(self, sheet_name, doc_id, key_col='id', expected_version=None):
+        with self.local.transaction() as conn:
+            base = self.local.current_version(sheet_name, doc_id, key_col)
+            if base is None:
+                if expected_version is not None:
+                    raise ConflictError(sheet_name, doc_id, expected_version, None)
+                return False
+            self._queue(conn, sheet_name, {'op': 'delete', 'id': str(doc_id), 'key_col': key_col, 'base': base})
+            return self.local.delete_row(sheet_name, doc_id, key_col, expected_version)
+
+    def delete_rows(self, sheet_name, doc_ids, key_col='id', expected_versions=None):
+        # Mỗi dòng một lệnh trong outbox (cùng một giao dịch); khi đẩy lên, các lệnh xóa liên tiếp được gộp lại
+        with self.local.transaction():
+            return super().delete_rows(sheet_name, doc_ids, key_col, expected_versions)
+
+    def refresh(self):
+        if self.remote is not None:
+            self.remote.refresh()
+        self._wakeup.set()
+
+    def pending_count(self):
+        with self.local.transaction() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.OUTBOX}").fetchone()[0]
+
+    def dead_letters(self):
+        """Các lệnh Sheets đã từ chối, mới nhất trước (để quản trị viên xem và nhập lại bằng tay)"""
+        with self.local.transaction() as conn:
+            return [{'Lúc': at, 'Sheet': sheet, 'Lệnh': op, 'Lỗi': error}
+                    for at, sheet, op, error in conn.execute(f"SELECT at, sheet, op, error FROM {self.DEAD_LETTER} ORDER BY rowid DESC")]
+
+    # --- Đối soát ---
+    def _outbox(self):
+        with self.local.transaction() as conn:
+            return [(seq, sheet, json.loads(op), uncertain)
+                    for seq, sheet, op, uncertain in conn.execute(f"SELECT seq, sheet, op, uncertain FROM {self.OUTBOX} ORDER BY seq")]
+
+    def _done(self, seqs):
+        with self.local.transaction() as conn:
+            conn.executemany(f"DELETE FROM {self.OUTBOX} WHERE seq = ?", [(s,) for s in seqs])
+
+    def _mark_uncertain(self, seqs):
+        with self.local.transaction() as conn:
+            conn.executemany(f"UPDATE {self.OUTBOX} SET uncertain = 1 WHERE seq = ?", [(s,) for s in seqs])
+
+    def _reject(self, group, error):
+        """Chuyển các lệnh bị từ chối sang _dead_letter (cùng giao dịch với việc xóa khỏi outbox) và ghi vào danh sách xung đột"""
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.local.transaction() as conn:
+            conn.executemany(f"INSERT INTO {self.DEAD_LETTER} (seq, at, sheet, op, error) VALUES (?, ?, ?, ?, ?)",
+                             [(seq, now, sheet_name, json.dumps(op, ensure_ascii=False), str(error)) for seq, sheet_name, op, _ in group])
+            conn.executemany(f"DELETE FROM {self.OUTBOX} WHERE seq = ?", [(g[0],) for g in group])
+        for _, sheet_name, op, _ in group:
+            self.conflicts.appendleft({'Lúc': now, 'Sheet': sheet_name, 'id': op.get('id', ''), 'Lệnh': op['op'],
+                                       'Kết quả': f"bị từ chối, đã chuyển sang _dead_letter: {error}"})
+
+    def _remote_row(self, sheet_name, key_col, doc_id):
+        return next((r for r in self.remote.read_records(sheet_name) if str(r.get(key_col, '')) == doc_id), None)
+
+    @staticmethod
+    def _newer(row, other):
+        """row thắng other: version lớn hơn, bằng nhau thì updatedAt (chuỗi "YYYY-MM-DD HH:MM:SS") mới hơn"""
+        return ((parse_version(row.get(REVISION_COLUMN)), str(row.get('updatedAt', ''))) >
+                (parse_version(other.get(REVISION_COLUMN)), str(other.get('updatedAt', ''))))
+
+    def _resolve(self, sheet_name, op):
+        """Lệnh sửa/xóa không khớp version trên Sheets: ghi đè bản cục bộ lên nếu mới hơn, nếu không thì để lần kéo về lấy bản Sheets"""
+        key_col, doc_id = op['key_col'], op['id']
+        remote_row = self._remote_row(sheet_name, key_col, doc_id)
+        local_row = self.local.get_row(sheet_name, doc_id, key_col)
+        if remote_row is None:
+            if op['op'] == 'delete':
+                return
+            if local_row is None:
+                outcome = "dòng đã bị xóa ở cả hai phía"
+            else:
+                # Sửa thắng xóa: thêm lại bản cục bộ (giữ nguyên khóa và version) để lần kéo về không xóa mất
+                self.remote.append_rows(sheet_name, [local_row])
+                outcome = "dòng đã bị xóa trên Google Sheets, khôi phục bản sửa cục bộ"
+        else:
+            if op['op'] == 'update' and local_row is not None and self._newer(local_row, remote_row):
+                self.remote.update_row(sheet_name, doc_id, {k: v for k, v in local_row.items() if k not in (key_col, REVISION_COLUMN)}, key_col)
+                outcome = "giữ bản cục bộ"
+            else:
+                outcome = "giữ bản trên Google Sheets"
+        self.conflicts.appendleft({'Lúc': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'Sheet': sheet_name,
+                                   'id': doc_id, 'Lệnh': op['op'], 'Kết quả': outcome})
+
+    @staticmethod
+    def _run_of(ops, i):
+        """Các lệnh sửa/xóa liên tiếp từ ops[i]: cùng loại, cùng sheet và key_col, mỗi dòng một lần"""
+        _, sheet_name, op, _ = ops[i]
+        group = [ops[i]]
+        while (i + len(group) < len(ops) and ops[i + len(group)][1] == sheet_name and ops[i + len(group)][2]['op'] == op['op']
+               and ops[i + len(group)][2]['key_col'] == op['key_col'] and ops[i + len(group)][2]['id'] not in {g[2]['id'] for g in group}):
+            group.append(ops[i + len(group)])
+        return group
+
+    def _push(self):
+        """Đẩy outbox theo thứ tự; dòng thêm liên tiếp cùng sheet gộp một lệnh, sửa/xóa liên tiếp gộp một lượt.
+
+        Lỗi tạm thời (mạng, 5xx, hết hạn mức) thì dừng, các lệnh còn lại giữ nguyên cho lần sau;
+        lệnh bị Sheets từ chối vì lý do khác thì chuyển sang _dead_letter và đẩy tiếp các lệnh sau.
+        """
+        ops = self._outbox()
+        settled = set()
+        i = 0
+        while i < len(ops):
+            seq, sheet_name, op, uncertain = ops[i]
+            group = [ops[i]]
+            try:
+                if op['op'] == 'append':
+                    while i + len(group) < len(ops) and ops[i + len(group)][1] == sheet_name and ops[i + len(group)][2]['op'] == 'append':
+                        group.append(ops[i + len(group)])
+                    self._push_appends(sheet_name, group)
+                    i += len(group)
+                    continue
+                if op['op'] in ('update', 'delete'):
+                    # Các lệnh sửa/xóa liên tiếp cùng sheet: kiểm tra version cả lô rồi ghi bằng một lượt
+                    group = self._run_of(ops, i)
+                    if len(group) > 1 and not any((sheet_name, op['key_col'], g[2]['id']) in settled for g in group):
+                        bases = {g[2]['id']: g[2]['base'] for g in group if g[2]['base'] != ''}
+                        try:
+                            if op['op'] == 'update':
+                                missing = self.remote.update_rows(sheet_name, {g[2]['id']: g[2]['data'] for g in group}, op['key_col'], bases)
+                            else:
+                                # Dòng đã không còn trên Sheets (không có version để so) thì lệnh xóa coi như xong
+                                self.remote.delete_rows(sheet_name, [g[2]['id'] for g in group], op['key_col'], bases)
+                                missing = []
+                        except ConflictError:
+                            pass  # Chưa ghi gì: đẩy lại từng lệnh để giải quyết riêng dòng xung đột
+                        else:
+                            for g in group:
+                                if g[2]['id'] in missing:
+                                    self._resolve(sheet_name, g[2])
+                                    settled.add((sheet_name, op['key_col'], g[2]['id']))
+                            self._done([g[0] for g in group])
+                            i += len(group)
+                            continue
+                    group = [ops[i]]
+                target = (sheet_name, op['key_col'], op['id'])
+                if target not in settled:
+                    base = op['base'] if op['base'] != '' else None
+                    try:
+                        if op['op'] == 'update':
+                            found = self.remote.update_row(sheet_name, op['id'], op['data'], op['key_col'], base)
+                        else:
+                            # Dòng đã không còn trên Sheets thì lệnh xóa coi như xong
+                            found = self.remote.delete_row(sheet_name, op['id'], op['key_col'], base) or True
+                    except ConflictError:
+                        found = False
+                    if not found:
+                        # Các lệnh sau của cùng dòng dựa trên nhánh đã được giải quyết, không đẩy nữa
+                        self._resolve(sheet_name, op)
+                        settled.add(target)
+                self._done([seq])
+                i += 1
+            except (ServiceUnavailableError, RateLimitError):
+                raise
+            except StorageError as e:
+                self._reject(group, e)
+                i += len(group)
+
+    def _push_appends(self, sheet_name, group):
+        rows = [row for _, _, g_op, _ in group for row in g_op['rows']]
+        if any(g[3] for g in group):
+            # Lần đẩy trước lỗi giữa chừng (có thể đã ghi): bỏ các dòng đã có trên Sheets
+            key_col = 'key' if sheet_name == 'config' else 'id'
+            existing = {str(r.get(key_col, '')) for r in self.remote.read_records(sheet_name)}
+            rows = [r for r in rows if str(r.get(key_col, '')) not in existing]
+        try:
+            if rows:
+                self.remote.append_rows(sheet_name, rows)
+        except ServiceUnavailableError:
+            self._mark_uncertain([g[0] for g in group])
+            raise
+        self._done([g[0] for g in group])
+
+    def _pull(self, sheet_name):
+        """Thay bản cục bộ của sheet bằng dữ liệu Sheets nếu khác và sheet không còn lệnh chờ đẩy"""
+        remote_rows = self.remote.read_records(sheet_name)
+        cols = self.local.table_columns(sheet_name)
+        remote_rows = [{c: str(r.get(c, '')) for c in cols} for r in remote_rows]
+        with self.local.transaction() as conn:
+            if conn.execute(f"SELECT 1 FROM {self.OUTBOX} WHERE sheet = ? LIMIT 1", [sheet_name]).fetchone():
+                return False
+            if self.local.read_records(sheet_name) == remote_rows:
+                return False
+            self.local.replace_rows(sheet_name, remote_rows)
+        return True
+
+    def sync(self):
+        """Một vòng đối soát: đẩy outbox rồi kéo mọi sheet; trả về các sheet đã thay đổi cục bộ"""
+        changed = []
+        with self._sync_lock:
+            try:
+                self._push()
+                for sheet_name in EXPECTED_HEADERS:
+                    if self._pull(sheet_name):
+                        changed.append(sheet_name)
+                self.online, self.last_error, self.last_sync_at = True, '', time.time()
+            except Exception as e:
+                self.online, self.last_error = False, str(e)
+        for sheet_name in changed:
+            get_sheet_cache().invalidate(sheet_name)
+            invalidate_derived(sheet_name)
+        return changed
+
+    def _run(self):
+        while True:
+            self.sync()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def status(self):
+        with self.local.transaction() as conn:
+            rejected = conn.execute(f"SELECT COUNT(*) FROM {self.DEAD_LETTER}").fetchone()[0]
+        return {'online': self.online, 'pending': self.pending_count(), 'rejected': rejected, 'last_sync_at': self.last_sync_at,
+                'last_error': self.last_error, 'connected': self.remote is not None}
+
+@st.cache_resource
+def get_storage():
+    """Chọn backend theo cấu hình "storage_backend": 'sheets' (mặc định), 'sqlite' hoặc 'mirror'"""
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteBackend(get_setting('sqlite_path', DEFAULT_SQLITE_PATH))
+    if STORAGE_BACKEND == 'mirror':
+        # Không có Secrets vẫn chạy được trên bản cục bộ, chỉ không đồng bộ
+        remote = None if client is None else GoogleSheetsBackend(get_worksheet_registry(), float(get_setting('full_sync_interval', DEFAULT_FULL_SYNC_INTERVAL)))
+        return OfflineMirror(SQLiteBackend(get_setting('mirror_path', DEFAULT_MIRROR_PATH)), remote,
+                             float(get_setting('mirror_sync_interval', DEFAULT_MIRROR_SYNC_INTERVAL)))
+    if client is None:
+        return None
+    backend = GoogleSheetsBackend(get_worksheet_registry(), float(get_setting('full_sync_interval', DEFAULT_FULL_SYNC_INTERVAL)))
+    if str(get_setting('write_behind', 'true')).lower() in ('1', 'true', 'yes'):
+        backend = WriteBehindQueue(backend, get_setting('write_journal_path', DEFAULT_WRITE_JOURNAL),
+                                   float(get_setting('write_flush_interval', DEFAULT_FLUSH_INTERVAL)))
+    return backend
+
+# --- HÀM XỬ LÝ DỮ LIỆU ---
+def refresh_data_handles():
+    """Làm mới thủ công: mở lại kết nối, đồng bộ lại header và xóa cache dữ liệu"""
+    get_storage().refresh()
+    get_sheet_cache().invalidate()
+    get_tournament_stats().invalidate()
+    get_unit_login_index().invalidate()
+    get_athlete_search_index().invalidate()
+    get_content_catalog_store().invalidate()
+    get_registration_rules().invalidate()
+    if background_refresh_enabled():
+        get_background_refresher().wake()
 
 def ensure_columns(df, required_cols):
     if df.empty:
@@ -105,91 +1738,1688 @@ def ensure_columns(df, required_cols):
             df[col] = "" 
     return df
 
+def to_typed_frame(df):
+    """Đổi DataFrame toàn chuỗi đọc từ backend sang kiểu gọn theo COLUMN_TYPES (ô trống: '' / NaT / 0)"""
+    for col in df.columns:
+        values = df[col].fillna('').astype(str)
+        kind = COLUMN_TYPES.get(col)
+        if kind == 'category':
+            df[col] = values.astype('category')
+        elif kind == 'date':
+            df[col] = parse_dob(values)
+        elif kind == 'datetime':
+            df[col] = pd.to_datetime(values, format="%Y-%m-%d %H:%M:%S", errors='coerce')
+        elif kind == 'int':
+            df[col] = pd.to_numeric(values, errors='coerce').fillna(0).astype('int32')
+        else:
+            df[col] = values
+    return df
+
+def format_dates(series, fmt='%Y-%m-%d'):
+    """Cột ngày → chuỗi để hiển thị/xuất file (NaT → '')"""
+    return pd.to_datetime(series, errors='coerce').dt.strftime(fmt).fillna('')
+
+def format_date(value, fmt='%Y-%m-%d'):
+    return '' if value is None or pd.isna(value) else pd.Timestamp(value).strftime(fmt)
+
+@perf_timed('load_sheet')
+def load_sheet(sheet_name):
+    """Đọc một sheet từ backend lưu trữ thành DataFrame đã định kiểu (không qua cache)"""
+    data = get_storage().read_records(sheet_name)
+    df = pd.DataFrame(data)
+    if sheet_name in ('registrations', 'units'):
+        df = ensure_columns(df, EXPECTED_HEADERS[sheet_name])
+    return to_typed_frame(df)
+
+def report_storage_error(error, stale=False):
+    if stale:
+        st.warning(f"⚠️ {error}. Đang hiển thị dữ liệu đã tải trước đó.")
+    else:
+        st.error(f"❌ {error}. Vui lòng thử lại sau ít phút.")
+
+@perf_timed('get_data')
 def get_data(sheet_name):
+    """Dữ liệu sheet từ cache; Google Sheets lỗi thì dùng bản cũ nếu có, nếu không thì dừng trang kèm thông báo.
+
+    Trong lượt chạy đang ghim (SheetCache.pinned) mọi lần gọi trả về cùng một bản của sheet.
+    """
+    cache = get_sheet_cache()
+    snapshot = cache.snapshot()
+    if snapshot is not None:
+        pinned = snapshot.get(sheet_name)
+        if pinned is not None:
+            return pinned.copy()
+    df, source = fetch_sheet(cache, sheet_name)
+    if snapshot is not None:
+        snapshot.pin(sheet_name, df, source)
+        return df.copy()
+    return df
+
+def fetch_sheet(cache, sheet_name):
+    """(DataFrame, nguồn): 'cache', 'tải' (đọc từ nơi lưu trữ) hoặc 'bản cũ' (nơi lưu trữ đang lỗi)"""
+    cached = cache.get(sheet_name)
+    if cached is not None:
+        return cached, 'cache'
     try:
-        ws = get_worksheet(sheet_name)
-        data = ws.get_all_records()
-        df = pd.DataFrame(data)
-        if sheet_name == 'registrations':
-            required = ['id', 'unitId', 'unitName', 'athleteName', 'gender', 'dob', 'cccd', 'studentId', 'systemName', 'ageGroup', 'registered_contents', 'rank', 'createdAt']
-            df = ensure_columns(df, required)
-        elif sheet_name == 'units':
-            df = ensure_columns(df, ['id', 'name', 'manager', 'registrationCode', 'createdAt'])
-        return df
-    except:
-        return pd.DataFrame()
+        return cache.get_or_load(sheet_name, load_sheet), 'tải'
+    except StorageError as e:
+        error = e
+    stale = cache.peek(sheet_name)
+    if stale is not None:
+        report_storage_error(error, stale=True)
+        return stale.copy(), 'bản cũ'
+    report_storage_error(error)
+    st.stop()
 
 def save_data(sheet_name, row_dict):
+    return save_rows(sheet_name, [row_dict])
+
+def stamp_row(sheet_name, row_dict, inserting=False):
+    """Điền updatedAt (và version = 1 khi thêm mới) cho các sheet có theo dõi phiên bản"""
+    if REVISION_COLUMN in EXPECTED_HEADERS.get(sheet_name, []):
+        row_dict['updatedAt'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if inserting:
+            row_dict[REVISION_COLUMN] = 1
+    return row_dict
+
+@perf_timed('save_rows')
+def save_rows(sheet_name, rows):
+    """Thêm nhiều dòng bằng một lệnh ghi; id và createdAt được điền vào chính các dict"""
+    try:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for row_dict in rows:
+            if 'id' not in row_dict:
+                row_dict['id'] = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+            if 'createdAt' not in row_dict:
+                row_dict['createdAt'] = now
+            stamp_row(sheet_name, row_dict, inserting=True)
+        
+        get_storage().append_rows(sheet_name, rows)
+        get_sheet_cache().invalidate(sheet_name)
+        for row_dict in rows:
+            notify_change(sheet_name, 'insert', row_dict['id'], row_dict)
+        get_change_feed().record([(sheet_name, 'insert', row_dict['id'], None, row_dict) for row_dict in rows])
+        return True
+    except Exception as e:
+        st.error(f"Lỗi lưu: {e}")
+        return False
+
+def shown_version(sheet_name, doc_id, current):
+    """Gọi lúc hiển thị dòng (trước nút bấm): trả về version đã hiển thị ở lượt chạy trước — bản người dùng
+    đang nhìn khi bấm nút — rồi ghi nhận version đang hiển thị ở lượt này cho lần bấm sau"""
+    versions = st.session_state.setdefault('shown_versions', {})
+    key = (sheet_name, str(doc_id))
+    previous = versions.get(key, current)
+    versions[key] = current
+    return previous
+
+def forget_shown_version(sheet_name, doc_id):
+    st.session_state.get('shown_versions', {}).pop((sheet_name, str(doc_id)), None)
+
+def report_conflict(error):
+    """Xung đột ghi: bỏ cache của sheet để lần tải sau thấy dữ liệu mới nhất và báo người dùng"""
+    get_sheet_cache().invalidate(error.sheet_name)
+    forget_shown_version(error.sheet_name, error.doc_id)
+    st.warning(f"⚠️ {error}. Vui lòng xem lại dữ liệu mới nhất rồi thao tác lại.")
+
+@perf_timed('update_row_data')
+def update_row_data(sheet_name, doc_id, updated_data, expected_version=None):
+    """Cập nhật toàn bộ dòng dữ liệu dựa trên ID (kiểm tra version nếu truyền expected_version)"""
+    try:
+        updated_data = stamp_row(sheet_name, dict(updated_data))
+        before = stored_rows(sheet_name, [doc_id]).get(str(doc_id), {})
+        if not get_storage().update_row(sheet_name, doc_id, updated_data, expected_version=expected_version):
+            return False
+        get_sheet_cache().invalidate(sheet_name)
+        notify_change(sheet_name, 'update', doc_id, updated_data)
+        get_change_feed().record([(sheet_name, 'update', doc_id, before, updated_data)])
+        return True
+    except ConflictError as e:
+        report_conflict(e)
+        return False
+    except Exception as e:
+        st.error(f"Lỗi update: {e}")
+        return False
+
+@perf_timed('update_rows_data')
+def update_rows_data(sheet_name, updates, expected_versions=None):
+    """Cập nhật nhiều dòng {id: {cột: giá trị}} bằng một lệnh ghi gộp; trả về danh sách id không tìm thấy"""
+    try:
+        updates = {doc_id: stamp_row(sheet_name, dict(data)) for doc_id, data in updates.items()}
+        before = stored_rows(sheet_name, list(updates))
+        missing = get_storage().update_rows(sheet_name, updates, expected_versions=expected_versions)
+        get_sheet_cache().invalidate(sheet_name)
+        for doc_id, data in updates.items():
+            if doc_id not in missing:
+                notify_change(sheet_name, 'update', doc_id, data)
+        get_change_feed().record([(sheet_name, 'update', doc_id, before.get(str(doc_id), {}), data)
+                                  for doc_id, data in updates.items() if doc_id not in missing])
+        return missing
+    except ConflictError as e:
+        report_conflict(e)
+        return None
+    except Exception as e:
+        st.error(f"Lỗi update: {e}")
+        return None
+
+def update_cell(sheet_name, doc_id, col_name, new_value):
+    return update_row_data(sheet_name, doc_id, {col_name: new_value})
+
+@perf_timed('delete_data')
+def delete_data(sheet_name, id_to_delete, expected_version=None):
+    try:
+        before = stored_rows(sheet_name, [id_to_delete]).get(str(id_to_delete))
+        if get_storage().delete_row(sheet_name, id_to_delete, expected_version=expected_version):
+            get_sheet_cache().invalidate(sheet_name)
+            notify_change(sheet_name, 'delete', id_to_delete)
+            get_change_feed().record([(sheet_name, 'delete', id_to_delete, before, None)])
+            return True
+        return False
+    except ConflictError as e:
+        report_conflict(e)
+        return False
+    except StorageError as e:
+        report_storage_error(e)
+        return False
+
+@perf_timed('delete_rows_data')
+def delete_rows_data(sheet_name, ids):
+    """Xóa nhiều dòng bằng một lượt ghi gộp; trả về danh sách id không tìm thấy (None nếu lỗi)"""
+    ids = [str(doc_id) for doc_id in ids]
+    if not ids:
+        return []
+    try:
+        before = stored_rows(sheet_name, ids)
+        missing = get_storage().delete_rows(sheet_name, ids)
+        get_sheet_cache().invalidate(sheet_name)
+        deleted = [doc_id for doc_id in ids if doc_id not in missing]
+        for doc_id in deleted:
+            notify_change(sheet_name, 'delete', doc_id)
+        get_change_feed().record([(sheet_name, 'delete', doc_id, before.get(doc_id), None) for doc_id in deleted])
+        return missing
+    except StorageError as e:
+        report_storage_error(e)
+        return None
+
+def notify_change(sheet_name, op, doc_id, data=None):
+    """Báo cho các bộ dữ liệu tổng hợp trong bộ nhớ về một thay đổi vừa ghi (op: insert/update/delete)"""
+    try:
+        get_tournament_stats().apply_change(sheet_name, op, doc_id, data or {})
+        if sheet_name == 'units':
+            get_unit_login_index().apply_change(op, doc_id, data or {})
+        if sheet_name in AthleteSearchIndex.SOURCE_SHEETS:
+            get_athlete_search_index().invalidate()
+        if sheet_name in ContentCatalog.SOURCE_SHEETS:
+            get_content_catalog_store().invalidate()
+        get_registration_rules().apply_change(sheet_name, op, doc_id, data or {})
+    except Exception as e:
+        logger.exception("Lỗi cập nhật thống kê: %s", e)
+
+def invalidate_derived(sheet_name):
+    """Dữ liệu của sheet bị sửa từ nơi khác: dựng lại các bộ dữ liệu tổng hợp phụ thuộc vào nó"""
+    if sheet_name in TournamentStats.SOURCE_SHEETS:
+        get_tournament_stats().invalidate()
+    if sheet_name == 'units':
+        get_unit_login_index().invalidate()
+    if sheet_name in AthleteSearchIndex.SOURCE_SHEETS:
+        get_athlete_search_index().invalidate()
+    if sheet_name in ContentCatalog.SOURCE_SHEETS:
+        get_content_catalog_store().invalidate()
+    if sheet_name in RegistrationRules.SOURCE_SHEETS:
+        get_registration_rules().invalidate()
+
+# --- NHẬT KÝ THAY ĐỔI ---
+def stored_value(col, value):
+    """Giá trị trong DataFrame đã định kiểu → chuỗi đúng như khi lưu"""
+    kind = COLUMN_TYPES.get(col)
+    if kind == 'date':
+        return format_date(value)
+    if kind == 'datetime':
+        return format_date(value, "%Y-%m-%d %H:%M:%S")
+    return '' if value is None or (not isinstance(value, str) and pd.isna(value)) else str(value)
+
+def stored_rows(sheet_name, doc_ids):
+    """Nội dung hiện tại của các dòng {id: {cột: chuỗi}}, lấy từ dữ liệu đã tải (không đọc lại nơi lưu trữ nếu đã có)"""
+    df = get_sheet_cache().peek(sheet_name)
+    if df is None:
+        df = get_data(sheet_name)
+    if df.empty or 'id' not in df.columns:
+        return {}
+    df = df[df['id'].isin([str(d) for d in doc_ids])]
+    return {str(row['id']): {col: stored_value(col, v) for col, v in row.items()} for row in df.to_dict('records')}
+
+class ChangeFeed:
+    """Nhật ký thay đổi chỉ ghi thêm (sheet 'changes'): ai sửa, sheet, id, trước/sau, lúc nào.
+
+    - record() chỉ thêm vào bộ đệm; luồng nền gom các mục mới thành một lệnh append_rows mỗi chu kỳ
+    - read(cursor) trả các mục sau con trỏ (vị trí dòng trên sheet), latest() phân trang cho màn hình quản trị
+    - origin là mã của tiến trình đã ghi, để tiến trình khác biết thay đổi nào chưa được áp dụng ở mình
+    """
+    # Cột không ghi vào before/after (đã có trong at, hoặc tự tăng)
+    SKIP_COLUMNS = {'updatedAt', REVISION_COLUMN}
+
+    def __init__(self, interval=DEFAULT_FEED_FLUSH_INTERVAL, max_batch=200):
+        self.origin = uuid.uuid4().hex[:8]
+        self.interval = interval
+        self.max_batch = max_batch
+        self._buffer = []
+        self._last_seq = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        threading.Thread(target=self._run, name="change-feed-flusher", daemon=True).start()
+
+    def _next_id(self):
+        self._last_seq = max(time.time_ns(), self._last_seq + 1)
+        return f"{self._last_seq:020d}"
+
+    @classmethod
+    def _compact(cls, values, keep_all=False):
+        if values is None:
+            return ''
+        values = {k: str(v) for k, v in values.items() if keep_all or k not in cls.SKIP_COLUMNS}
+        return json.dumps(values, ensure_ascii=False, separators=(',', ':'))
+
+    def record(self, changes, actor=None):
+        """changes: [(sheet, op, doc_id, before, after)]; sửa thì chỉ giữ các cột bị đổi ở before"""
+        actor = actor or current_actor()
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            for sheet_name, op, doc_id, before, after in changes:
+                if op == 'update' and before is not None and after is not None:
+                    before = {k: before.get(k, '') for k in after}
+                self._buffer.append({'id': self._next_id(), 'at': now, 'origin': self.origin, 'actor': actor, 'sheet': sheet_name,
+                                     'docId': str(doc_id), 'op': op, 'before': self._compact(before, keep_all=op == 'delete'),
+                                     'after': self._compact(after)})
+            if len(self._buffer) >= self.max_batch:
+                self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return list(self._buffer)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+            try:
+                get_storage().append_rows('changes', batch)
+            except Exception:
+                with self._lock:
+                    self._buffer = batch + self._buffer
+                raise
+            get_sheet_cache().invalidate('changes')
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("Lỗi ghi nhật ký thay đổi (sẽ thử lại): %s", e)
+
+    @staticmethod
+    def _decode(row):
+        entry = dict(row)
+        for field in ('before', 'after'):
+            try:
+                entry[field] = json.loads(row[field]) if row[field] else None
+            except ValueError:
+                entry[field] = None
+        return entry
+
+    def _frame(self, frame):
+        return ensure_columns(get_data('changes') if frame is None else frame, EXPECTED_HEADERS['changes'])
+
+    @staticmethod
+    def end_cursor(frame):
+        """Con trỏ ở cuối dữ liệu đã tải: mọi mục hiện có coi như đã đọc"""
+        ids = ensure_columns(frame, ['id'])['id']
+        return (len(ids), str(ids.iloc[-1])) if len(ids) else (0, '')
+
+    def read(self, cursor=None, limit=None, frame=None, foreign_only=False):
+        """Các mục sau con trỏ theo thứ tự dòng trên sheet (before/after đã giải mã) và con trỏ mới.
+
+        Con trỏ là (số dòng đã đọc, id dòng cuối): sheet chỉ ghi thêm nên mục do tiến trình khác đẩy lên muộn
+        (id theo giờ ghi có thể nhỏ hơn các mục đã đọc) vẫn nằm sau con trỏ. Nếu dòng tại con trỏ không còn
+        đúng id (sheet bị sửa tay/xóa bớt) thì tìm lại id đó, không thấy thì đọc lại từ đầu.
+        frame: dữ liệu sheet 'changes' đã tải (mặc định lấy qua get_data); mục còn trong bộ đệm chưa có con trỏ nên không trả về.
+        foreign_only: chỉ các mục do tiến trình khác ghi.
+        """
+        df = self._frame(frame)
+        ids = df['id'].astype(str).tolist()
+        start = 0
+        if cursor is not None:
+            position, last_id = cursor
+            if 0 < position <= len(ids) and ids[position - 1] == last_id:
+                start = position
+            elif last_id in ids:
+                start = ids.index(last_id) + 1
+        stop = len(ids) if limit is None else min(len(ids), start + limit)
+        page = df.iloc[start:stop]
+        if foreign_only:
+            page = page[page['origin'].astype(str) != self.origin]
+        entries = [self._decode(row) for row in page.to_dict('records')]
+        next_cursor = (stop, ids[stop - 1]) if stop else (0, '')
+        return entries, next_cursor
+
+    def latest(self, page=1, page_size=200, sheet_name=None, doc_id=None, frame=None):
+        """Trang nhật ký cho màn hình quản trị, mới nhất trước (gồm cả mục chưa ghi xuống): (mục, tổng số mục khớp bộ lọc).
+
+        Chỉ giải mã before/after của các mục trong trang.
+        """
+        df = self._frame(frame)
+        pending = self.pending()
+        if pending:
+            df = pd.concat([df, pd.DataFrame(pending, columns=EXPECTED_HEADERS['changes'])], ignore_index=True)
+        if sheet_name:
+            df = df[df['sheet'] == sheet_name]
+        if doc_id:
+            df = df[df['docId'].astype(str) == str(doc_id)]
+        df = df.sort_values('id', ascending=False, kind='stable')
+        start = (max(page, 1) - 1) * page_size
+        return [self._decode(row) for row in df.iloc[start:start + page_size].to_dict('records')], len(df)
+
+@st.cache_resource
+def get_change_feed():
     try:
-        ws = get_worksheet(sheet_name)
-        if 'id' not in row_dict:
-            row_dict['id'] = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        if 'createdAt' not in row_dict:
-            row_dict['createdAt'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        headers = ws.row_values(1)
-        row_to_add = [str(row_dict.get(h, "")) for h in headers]
-        ws.append_row(row_to_add)
-        return True
-    except Exception as e:
-        st.error(f"Lỗi lưu: {e}")
-        return False
+        interval = float(get_setting('feed_flush_interval', DEFAULT_FEED_FLUSH_INTERVAL))
+    except (TypeError, ValueError):
+        interval = DEFAULT_FEED_FLUSH_INTERVAL
+    return ChangeFeed(interval)
 
-def update_row_data(sheet_name, doc_id, updated_data):
-    """Cập nhật toàn bộ dòng dữ liệu dựa trên ID"""
+def current_actor():
+    """Người thực hiện lệnh ghi trong phiên hiện tại (luồng nền: 'hệ thống')"""
     try:
-        ws = get_worksheet(sheet_name)
-        cell = ws.find(str(doc_id))
-        if not cell:
+        role = st.session_state.get('role', 'guest')
+        if role == 'unit' and st.session_state.get('user_info'):
+            return f"Đơn vị {st.session_state.user_info['name']}"
+        return role
+    except Exception:
+        return 'hệ thống'
+
+def undo_change(entry):
+    """Ghi ngược một mục nhật ký (bản thân lệnh hoàn tác cũng được ghi vào nhật ký); trả về True nếu thành công.
+
+    VĐV (registrations) đi qua đúng luồng của trang đăng ký: xóa kèm entries, sửa/khôi phục thì đồng bộ lại entries.
+    Thêm/sửa chỉ được hoàn tác khi dòng vẫn đúng như 'after' của mục nhật ký (không ai sửa tiếp sau đó);
+    lệnh ghi ngược kiểm tra version hiện tại như mọi lệnh ghi khác.
+    """
+    sheet_name, doc_id, before = entry['sheet'], entry['docId'], entry['before'] or {}
+    version = None
+    if entry['op'] in ('insert', 'update'):
+        if sheet_name == 'config':
+            value = get_config(doc_id)
+            current = None if value is None else {'value': str(value)}
+        else:
+            current = stored_rows(sheet_name, [doc_id]).get(doc_id)
+        if current is None or any(current.get(k, '') != v for k, v in (entry['after'] or {}).items()):
+            actual = None if current is None else (current.get(REVISION_COLUMN) or "giá trị khác")
+            report_conflict(ConflictError(sheet_name, doc_id, "lúc ghi nhật ký", actual))
             return False
-        
-        headers = ws.row_values(1)
-        row_idx = cell.row
-        
-        # Duyệt qua từng field cần update
-        for key, value in updated_data.items():
-            if key in headers:
-                col_idx = headers.index(key) + 1
-                ws.update_cell(row_idx, col_idx, str(value))
+        version = current.get(REVISION_COLUMN) or None
+    if sheet_name == 'config':
+        set_config(doc_id, before.get('value', ''))
         return True
-    except Exception as e:
-        st.error(f"Lỗi update: {e}")
+    if entry['op'] == 'insert':
+        if sheet_name == 'registrations':
+            return delete_registration(doc_id, expected_version=version)
+        return delete_data(sheet_name, doc_id, expected_version=version)
+    if entry['op'] == 'update' and before:
+        if not update_row_data(sheet_name, doc_id, before, expected_version=version):
+            return False
+    elif entry['op'] == 'delete' and before:
+        if not save_rows(sheet_name, [{k: v for k, v in before.items() if k != REVISION_COLUMN}]):
+            return False
+    else:
         return False
+    if sheet_name == 'registrations' and (entry['op'] == 'delete' or {'registered_contents', 'unitId'} & set(before)):
+        row = stored_rows('registrations', [doc_id]).get(doc_id, {})
+        labels = [label for label in str(row.get('registered_contents', '')).split(ENTRY_SEPARATOR) if label]
+        sync_registration_entries(doc_id, row.get('unitId', ''), labels)
+    return True
 
-def update_cell(sheet_name, doc_id, col_name, new_value):
-    return update_row_data(sheet_name, doc_id, {col_name: new_value})
+# --- LÀM MỚI DỮ LIỆU NỀN ---
+class BackgroundRefresher:
+    """Một luồng nền cho cả tiến trình: định kỳ tải lại dữ liệu vào SheetCache dùng chung.
+
+    Các phiên chỉ đọc cache nên số lệnh gọi Google Sheets không phụ thuộc số người đang dùng;
+    sheet đổi từ nơi khác thì các bộ tổng hợp (thống kê, chỉ mục...) được dựng lại ngay.
+    Có nhật ký thay đổi thì phần lớn chu kỳ chỉ đọc sheet 'changes' và tải lại các sheet mà tiến trình
+    khác vừa ghi; cứ full_every chu kỳ mới tải lại tất cả (bắt cả các sửa tay trực tiếp trên Sheets).
+    """
+
+    def __init__(self, cache, interval, feed=None, full_every=DEFAULT_FULL_REFRESH_EVERY):
+        self.cache = cache
+        self.interval = interval
+        self.feed = feed
+        self.full_every = max(int(full_every), 1)
+        self.cursor = None
+        self.cycles = 0
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        threading.Thread(target=self._run, name="sheet-refresher", daemon=True).start()
+
+    def refresh_sheet(self, sheet_name):
+        """Tải lại một sheet vào cache; trả về False nếu lỗi"""
+        started = time.monotonic()
+        try:
+            previous, df, stored = self.cache.load(sheet_name, load_sheet)
+            error = None
+        except Exception as e:
+            error = str(e)
+        with self._lock:
+            m = self._metrics.setdefault(sheet_name, {'refreshes': 0, 'changes': 0, 'errors': 0, 'last_error': '', 'duration': 0.0})
+            m['duration'] = time.monotonic() - started
+            if error is not None:
+                m['errors'] += 1
+                m['last_error'] = error
+                return False
+            m['refreshes'] += 1
+            changed = stored and previous is not None and not previous.equals(df)
+            if changed:
+                m['changes'] += 1
+        if changed:
+            invalidate_derived(sheet_name)
+        return True
 
-def delete_data(sheet_name, id_to_delete):
+    def wake(self):
+        self._wakeup.set()
+
+    def refresh_from_feed(self):
+        """Tải lại sheet 'changes' rồi chỉ các sheet có mục mới từ tiến trình khác kể từ con trỏ.
+
+        Các sheet còn lại được gia hạn TTL: nhật ký vừa đọc xác nhận chúng chưa đổi, nên giữa hai lần
+        tải toàn bộ chúng không hết hạn rồi bị các phiên tự tải lại từng sheet.
+        """
+        if not self.refresh_sheet('changes'):
+            return
+        frame = self.cache.peek('changes')
+        if frame is None:
+            return
+        entries, self.cursor = self.feed.read(self.cursor, frame=frame, foreign_only=True)
+        dirty = {e['sheet'] for e in entries if e['sheet'] in EXPECTED_HEADERS}
+        for sheet_name in sorted(dirty):
+            self.refresh_sheet(sheet_name)
+        self.cache.touch([name for name in EXPECTED_HEADERS if name not in dirty])
+
+    def _run(self):
+        while True:
+            if self.feed is None or self.cursor is None or self.cycles % self.full_every == 0:
+                for sheet_name in EXPECTED_HEADERS:
+                    self.refresh_sheet(sheet_name)
+                # Vừa tải lại tất cả: mọi mục đã có trong nhật ký coi như đã áp dụng
+                frame = self.cache.peek('changes')
+                if self.feed is not None and frame is not None:
+                    self.cursor = self.feed.end_cursor(frame)
+            else:
+                self.refresh_from_feed()
+            self.cycles += 1
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def metrics(self):
+        """Bảng độ trễ dữ liệu theo sheet cho trang quản trị"""
+        ages = self.cache.ages()
+        with self._lock:
+            rows = [{'Sheet': name, 'Tuổi dữ liệu (s)': round(ages[name], 1) if name in ages else None,
+                     'Lần tải': m['refreshes'], 'Có thay đổi': m['changes'], 'Lỗi': m['errors'],
+                     'Thời gian tải (ms)': round(m['duration'] * 1000), 'Lỗi gần nhất': m['last_error']}
+                    for name, m in self._metrics.items()]
+        return pd.DataFrame(rows, columns=['Sheet', 'Tuổi dữ liệu (s)', 'Lần tải', 'Có thay đổi', 'Lỗi', 'Thời gian tải (ms)', 'Lỗi gần nhất'])
+
+def background_refresh_enabled():
+    default = 'true' if STORAGE_BACKEND == 'sheets' else 'false'
+    return str(get_setting('background_refresh', default)).lower() in ('1', 'true', 'yes')
+
+@st.cache_resource
+def get_background_refresher():
     try:
-        ws = get_worksheet(sheet_name)
-        cell = ws.find(str(id_to_delete))
-        if cell:
-            ws.delete_rows(cell.row)
-            return True
-        return False
-    except:
-        return False
+        interval = float(get_setting('refresh_interval', DEFAULT_REFRESH_INTERVAL))
+    except (TypeError, ValueError):
+        interval = DEFAULT_REFRESH_INTERVAL
+    return BackgroundRefresher(get_sheet_cache(), interval, get_change_feed(),
+                               get_int_setting('full_refresh_every', DEFAULT_FULL_REFRESH_EVERY))
 
 # --- CONFIG ---
-def get_config(key):
+def get_config_values():
+    """Sheet config dạng {key: value} (key lặp lại thì lấy dòng đầu), dựng một lần mỗi lượt chạy đang ghim"""
+    snapshot = get_sheet_cache().snapshot()
+    if snapshot is not None and 'config' in snapshot.derived:
+        return snapshot.derived['config']
     df = get_data('config')
+    values = {}
     if not df.empty:
         df = ensure_columns(df, ['key', 'value'])
-        row = df[df['key'] == key]
-        if not row.empty:
-            return row.iloc[0]['value']
-    return None
+        for key, value in zip(df['key'].astype(str), df['value']):
+            values.setdefault(key, value)
+    if snapshot is not None:
+        snapshot.derived['config'] = values
+    return values
+
+def get_config(key):
+    return get_config_values().get(key)
 
 def set_config(key, value):
-    ws = get_worksheet('config')
+    storage = get_storage()
+    df = get_data('config')
+    exists = not df.empty and 'key' in df.columns and (df['key'].astype(str) == key).any()
+    old_value = get_config(key)
+    # Form cấu hình lưu lại mọi khóa mỗi lần bấm: khóa không đổi (hoặc chưa có mà giá trị rỗng) thì không ghi
+    if str('' if old_value is None else old_value) == str(value):
+        return
     try:
-        cell = ws.find(key)
-        if cell:
-            ws.update_cell(cell.row, 2, str(value))
+        if not (exists and storage.update_row('config', key, {'value': str(value)}, key_col='key')):
+            storage.append_rows('config', [{'key': key, 'value': str(value)}])
+    except StorageError as e:
+        # Không thêm dòng mới: lệnh sửa có thể chưa chạy và sẽ sinh trùng khóa
+        report_storage_error(e)
+        return
+    get_sheet_cache().invalidate('config')
+    get_registration_rules().invalidate()
+    get_change_feed().record([('config', 'update' if exists else 'insert', key,
+                               None if old_value is None else {'value': str(old_value)}, {'value': str(value)})])
+
+# --- NỘI DUNG ĐĂNG KÝ (ENTRIES) ---
+ENTRY_SEPARATOR = "; "
+
+class ContentCatalog:
+    """Danh mục môn/nội dung dựng một lần và giữ trong bộ nhớ; dựng lại khi disciplines/contents thay đổi.
+
+    Nhãn giữ đúng định dạng cũ của cột registered_contents: "Môn: Nội dung" hoặc "Môn (Chung)".
+    """
+    SOURCE_SHEETS = ('disciplines', 'contents')
+    REBUILD_AFTER = 300
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+    def rebuild(self):
+        df_disc = get_data('disciplines')
+        df_cont = get_data('contents')
+        disciplines = [{'id': str(d['id']), 'name': d['name']} for d in df_disc.to_dict('records')] if not df_disc.empty else []
+        disc_names = {d['id']: d['name'] for d in disciplines}
+        contents_by_discipline, by_label, by_key = {}, {}, {}
+        for disc_id, disc_name in disc_names.items():
+            by_label[f"{disc_name} (Chung)"] = (disc_id, '')
+            by_key[(disc_id, '')] = f"{disc_name} (Chung)"
+        for cont in (df_cont.to_dict('records') if not df_cont.empty else []):
+            disc_id = str(cont['discipline_id'])
+            if disc_id in disc_names:
+                key = (disc_id, str(cont['id']))
+                label = f"{disc_names[disc_id]}: {cont['name']}"
+                contents_by_discipline.setdefault(disc_id, []).append({'id': key[1], 'name': cont['name'], 'gender': cont.get('gender', '')})
+                by_label[label] = key
+                by_key[key] = label
+        with self._lock:
+            self.disciplines = disciplines
+            self.contents_by_discipline = contents_by_discipline
+            self.by_label = by_label
+            self.by_key = by_key
+            self._built_at = time.monotonic()
+
+    def get(self):
+        with self._lock:
+            if self._built_at is None or time.monotonic() - self._built_at > self.REBUILD_AFTER:
+                self.rebuild()
+            return self
+
+@st.cache_resource
+def get_content_catalog_store():
+    return ContentCatalog()
+
+def get_catalog():
+    return get_content_catalog_store().get()
+
+def get_content_catalog():
+    """Danh mục nội dung: ({nhãn: (discipline_id, content_id)}, {(discipline_id, content_id): nhãn})"""
+    catalog = get_catalog()
+    return catalog.by_label, catalog.by_key
+
+def get_content_frame():
+    """Danh mục nội dung dạng bảng: label, discipline_id, content_id, gender ("(Chung)" dành cho cả Nam & Nữ)"""
+    catalog = get_catalog()
+    by_label = catalog.by_label
+    gender_of = {c['id']: c['gender'] for conts in catalog.contents_by_discipline.values() for c in conts}
+    rows = [{'label': label, 'discipline_id': disc_id, 'content_id': cont_id, 'gender': gender_of.get(cont_id, 'Nam & Nữ') if cont_id else 'Nam & Nữ'}
+            for label, (disc_id, cont_id) in by_label.items()]
+    return pd.DataFrame(rows, columns=['label', 'discipline_id', 'content_id', 'gender'])
+
+def get_entries(registration_id=None):
+    df = ensure_columns(get_data('entries'), EXPECTED_HEADERS['entries'])
+    if registration_id is not None:
+        df = df[df['registrationId'] == str(registration_id)]
+    return df
+
+def sync_registration_entries(registration_id, unit_id, labels):
+    """Đồng bộ các entries của một VĐV theo danh sách nhãn nội dung đã chọn"""
+    by_label, _ = get_content_catalog()
+    wanted = []
+    for label in labels:
+        key = by_label.get(label)
+        if key and key not in wanted:
+            wanted.append(key)
+    current = get_entries(registration_id)
+    have = {(r['discipline_id'], r['content_id']): r['id'] for _, r in current.iterrows()}
+    delete_rows_data('entries', [entry_id for key, entry_id in have.items() if key not in wanted])
+    new_rows = [{'registrationId': str(registration_id), 'unitId': str(unit_id), 'discipline_id': disc_id,
+                 'content_id': cont_id, 'rank': ''} for disc_id, cont_id in wanted if (disc_id, cont_id) not in have]
+    if new_rows:
+        save_rows('entries', new_rows)
+
+def delete_registration(registration_id, expected_version=None):
+    """Xóa VĐV (kiểm tra version nếu có) rồi xóa toàn bộ entries của VĐV đó"""
+    if not delete_data('registrations', registration_id, expected_version=expected_version):
+        return False
+    delete_rows_data('entries', get_entries(registration_id)['id'])
+    return True
+
+def migrate_registration_entries():
+    """Tách cột registered_contents cũ thành các dòng entries (bỏ qua VĐV đã có entries).
+
+    Trả về (số entries đã tạo, danh sách nhãn không khớp danh mục).
+    """
+    df_reg = get_data('registrations')
+    by_label, _ = get_content_catalog()
+    done = set(get_entries()['registrationId'])
+    rows, unknown = [], set()
+    for _, reg in df_reg.iterrows():
+        if str(reg['id']) in done:
+            continue
+        for label in str(reg.get('registered_contents', '') or '').split(ENTRY_SEPARATOR):
+            label = label.strip()
+            if not label:
+                continue
+            if label not in by_label:
+                unknown.add(label)
+                continue
+            disc_id, cont_id = by_label[label]
+            rows.append({'registrationId': str(reg['id']), 'unitId': str(reg.get('unitId', '')), 'discipline_id': disc_id,
+                         'content_id': cont_id, 'rank': str(reg.get('rank', '') or '')})
+    if rows:
+        save_rows('entries', rows)
+    set_config('entries_migrated', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    return len(rows), sorted(unknown)
+
+def get_entry_board():
+    """Bảng entries đã ghép tên VĐV, đơn vị và nhãn nội dung"""
+    df_ent = get_entries()
+    df_reg = get_data('registrations')
+    if df_ent.empty or df_reg.empty:
+        return pd.DataFrame(columns=['id', 'registrationId', 'unitId', 'athleteName', 'unitName', 'content', 'rank', REVISION_COLUMN], dtype=str)
+    _, by_key = get_content_catalog()
+    regs = df_reg[['id', 'athleteName', 'unitName']].rename(columns={'id': 'registrationId'})
+    regs['registrationId'] = regs['registrationId'].astype(str)
+    board = df_ent.merge(regs, on='registrationId', how='inner')
+    board['content'] = [by_key.get((d, c), '') for d, c in zip(board['discipline_id'], board['content_id'])]
+    return board
+
+
+# --- THỐNG KÊ TỔNG QUAN ---
+class TournamentStats:
+    """Số liệu trang Tổng quan giữ sẵn trong bộ nhớ, cập nhật dần theo từng lệnh ghi.
+
+    Dựng lại toàn bộ từ dữ liệu khi chưa có hoặc sau REBUILD_AFTER giây (bắt kịp sửa đổi từ nơi khác).
+    """
+    SOURCE_SHEETS = ('registrations', 'units', 'disciplines', 'entries')
+    REBUILD_AFTER = 300
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+    def _ensure_built(self):
+        if self._built_at is None or time.monotonic() - self._built_at > self.REBUILD_AFTER:
+            self.rebuild()
+
+    def rebuild(self):
+        df_reg = get_data('registrations')
+        df_units = get_data('units')
+        df_disc = ensure_columns(get_data('disciplines'), EXPECTED_HEADERS['disciplines'])
+        df_ent = get_entries()
+        entry_cols = ('registrationId', 'unitId', 'discipline_id', 'content_id', 'rank')
+        with self._lock:
+            self.registrations = {reg_id: {'athleteName': name, 'unitName': unit_name}
+                                  for reg_id, name, unit_name in zip(df_reg['id'], df_reg['athleteName'], df_reg['unitName'])}
+            self.units = dict(zip(df_units['id'], df_units['name']))
+            self.disciplines = dict(zip(df_disc['id'], df_disc['name']))
+            self.entries = {}
+            self.entries_by_discipline = {}
+            self.entries_by_unit = {}
+            self.medals = {}
+            for entry_id, *values in zip(df_ent['id'], *(df_ent[c] for c in entry_cols)):
+                self._add_entry(entry_id, dict(zip(entry_cols, values)))
+            self._built_at = time.monotonic()
+
+    # --- Cập nhật dần ---
+    @staticmethod
+    def _bump(counter, key, delta):
+        counter[key] = counter.get(key, 0) + delta
+        if counter[key] <= 0:
+            del counter[key]
+
+    def _add_entry(self, entry_id, entry):
+        self.entries[entry_id] = entry
+        self._bump(self.entries_by_discipline, entry['discipline_id'], 1)
+        self._bump(self.entries_by_unit, entry['unitId'], 1)
+        if entry['rank'] in MEDAL_RANKS:
+            self._bump(self.medals.setdefault(entry['unitId'], {}), entry['rank'], 1)
+
+    def _remove_entry(self, entry_id):
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return None
+        self._bump(self.entries_by_discipline, entry['discipline_id'], -1)
+        self._bump(self.entries_by_unit, entry['unitId'], -1)
+        if entry['rank'] in MEDAL_RANKS:
+            self._bump(self.medals.setdefault(entry['unitId'], {}), entry['rank'], -1)
+        return entry
+
+    def apply_change(self, sheet_name, op, doc_id, data):
+        with self._lock:
+            if self._built_at is None:
+                return
+            doc_id = str(doc_id)
+            if sheet_name == 'entries':
+                old = self._remove_entry(doc_id)
+                if op != 'delete':
+                    entry = dict(old or {'registrationId': '', 'unitId': '', 'discipline_id': '', 'content_id': '', 'rank': ''})
+                    entry.update({k: str(v) for k, v in data.items() if k in entry})
+                    self._add_entry(doc_id, entry)
+            elif sheet_name == 'registrations':
+                if op == 'delete':
+                    self.registrations.pop(doc_id, None)
+                else:
+                    reg = self.registrations.setdefault(doc_id, {'athleteName': '', 'unitName': ''})
+                    reg.update({k: data[k] for k in reg if k in data})
+            elif sheet_name in ('units', 'disciplines'):
+                names = self.units if sheet_name == 'units' else self.disciplines
+                if op == 'delete':
+                    names.pop(doc_id, None)
+                elif op == 'insert' or 'name' in data:
+                    names[doc_id] = data.get('name', names.get(doc_id, ''))
+
+    # --- Đọc số liệu ---
+    def summary(self):
+        with self._lock:
+            self._ensure_built()
+            return {'athletes': len(self.registrations), 'units': len(self.units), 'disciplines': len(self.disciplines),
+                    'entries': len(self.entries)}
+
+    def medal_table(self):
+        """Bảng tổng sắp huy chương theo đơn vị"""
+        with self._lock:
+            self._ensure_built()
+            rows = [{'Đơn vị': self.units.get(unit_id, unit_id), 'Nhất': m.get('Nhất', 0), 'Nhì': m.get('Nhì', 0), 'Ba': m.get('Ba', 0)}
+                    for unit_id, m in self.medals.items() if m]
+        df = pd.DataFrame(rows, columns=['Đơn vị', 'Nhất', 'Nhì', 'Ba'])
+        df['Tổng'] = df[['Nhất', 'Nhì', 'Ba']].sum(axis=1)
+        return df.sort_values(['Nhất', 'Nhì', 'Ba'], ascending=False).reset_index(drop=True)
+
+    def entry_counts(self):
+        """Số lượt đăng ký theo môn và theo đơn vị"""
+        with self._lock:
+            self._ensure_built()
+            by_disc = pd.DataFrame([{'Môn': self.disciplines.get(k, k), 'Lượt đăng ký': v} for k, v in self.entries_by_discipline.items()],
+                                   columns=['Môn', 'Lượt đăng ký'])
+            by_unit = pd.DataFrame([{'Đơn vị': self.units.get(k, k), 'Lượt đăng ký': v} for k, v in self.entries_by_unit.items()],
+                                   columns=['Đơn vị', 'Lượt đăng ký'])
+        return by_disc, by_unit
+
+    def winners(self):
+        """Danh sách VĐV đạt huy chương (chỉ duyệt các entries có thứ hạng)"""
+        _, label_of = get_content_catalog()
+        with self._lock:
+            self._ensure_built()
+            rows = []
+            for e in self.entries.values():
+                if e['rank'] in MEDAL_RANKS:
+                    reg = self.registrations.get(e['registrationId'], {})
+                    rows.append({'athleteName': reg.get('athleteName', ''), 'unitName': reg.get('unitName', ''),
+                                 'content': label_of.get((e['discipline_id'], e['content_id']), ''), 'rank': e['rank']})
+        return pd.DataFrame(rows, columns=['athleteName', 'unitName', 'content', 'rank'])
+
+@st.cache_resource
+def get_tournament_stats():
+    return TournamentStats()
+
+
+# --- ĐĂNG NHẬP ĐƠN VỊ ---
+class UnitLoginIndex:
+    """Từ điển mã đăng ký → đơn vị giữ trong bộ nhớ, kèm giới hạn số lần nhập sai theo phiên và địa chỉ IP.
+
+    Mọi lần nhập sai của một người đều được đếm, dù họ thử nhiều mã khác nhau; đăng nhập đúng không xóa
+    số lần sai. Các mục đã hết hạn được dọn định kỳ để từ điển không phình theo số phiên.
+    """
+    MAX_FAILURES = 5
+    # Nhiều máy có thể dùng chung một IP (phòng máy, NAT) nên giới hạn theo IP rộng hơn
+    MAX_FAILURES_PER_ADDRESS = 30
+    LOCK_SECONDS = 300
+    # Mã không có trong từ điển: chỉ tải lại danh sách đơn vị nếu từ điển đã cũ hơn ngần này giây
+    MISS_REBUILD_AFTER = 30
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_code = None
+        self._code_of = {}
+        self._built_at = 0
+        # {('session' | 'address', giá trị): [thời điểm nhập sai]}
+        self._failures = {}
+        self._swept_at = 0
+
+    @staticmethod
+    def _norm(code):
+        return str(code).strip().upper()
+
+    def invalidate(self):
+        with self._lock:
+            self._by_code = None
+
+    def rebuild(self):
+        df = get_data('units')
+        with self._lock:
+            self._by_code, self._code_of = {}, {}
+            if not df.empty:
+                for unit in df.to_dict('records'):
+                    code = self._norm(unit.get('registrationCode', ''))
+                    if code:
+                        self._by_code[code] = unit
+                        self._code_of[str(unit['id'])] = code
+            self._built_at = time.monotonic()
+
+    def apply_change(self, op, doc_id, data):
+        with self._lock:
+            if self._by_code is None:
+                return
+            doc_id = str(doc_id)
+            old_code = self._code_of.pop(doc_id, None)
+            unit = self._by_code.pop(old_code, None) if old_code else None
+            if op == 'delete':
+                return
+            unit = dict(unit or {})
+            unit.update(data)
+            code = self._norm(unit.get('registrationCode', ''))
+            if code:
+                self._by_code[code] = unit
+                self._code_of[doc_id] = code
+
+    def _evict(self, now):
+        if now - self._swept_at < self.LOCK_SECONDS:
+            return
+        self._swept_at = now
+        self._failures = {key: times for key, times in self._failures.items() if now - times[-1] < self.LOCK_SECONDS}
+
+    def _locked_for(self, clients, now):
+        """Số giây còn bị khóa (0 nếu không) của người dùng có các khóa clients"""
+        self._evict(now)
+        wait = 0
+        for key in clients:
+            recent = [t for t in self._failures.get(key, []) if now - t < self.LOCK_SECONDS]
+            if not recent:
+                self._failures.pop(key, None)
+                continue
+            self._failures[key] = recent
+            limit = self.MAX_FAILURES_PER_ADDRESS if key[0] == 'address' else self.MAX_FAILURES
+            if len(recent) >= limit:
+                # Mở khóa khi lần sai thứ limit tính từ cuối hết hạn
+                wait = max(wait, int(self.LOCK_SECONDS - (now - recent[-limit])) + 1)
+        return wait
+
+    def login(self, code, clients=()):
+        """Trả về (đơn vị, trạng thái) với trạng thái: 'ok', 'not_found', 'locked', 'empty'.
+
+        clients là các khóa nhận diện người đăng nhập (xem login_clients()).
+        """
+        code = self._norm(code)
+        now = time.monotonic()
+        with self._lock:
+            if self._locked_for(clients, now):
+                return None, 'locked'
+            if self._by_code is None:
+                self.rebuild()
+            unit = self._by_code.get(code)
+            if unit is None and now - self._built_at > self.MISS_REBUILD_AFTER:
+                self.rebuild()
+                unit = self._by_code.get(code)
+            if unit is not None:
+                return dict(unit), 'ok'
+            if not self._by_code:
+                return None, 'empty'
+            for key in clients:
+                self._failures.setdefault(key, []).append(now)
+            return None, 'not_found'
+
+    def seconds_locked(self, clients):
+        with self._lock:
+            return self._locked_for(clients, time.monotonic())
+
+@st.cache_resource
+def get_unit_login_index():
+    return UnitLoginIndex()
+
+def login_clients():
+    """Khóa giới hạn đăng nhập của người dùng hiện tại: phiên Streamlit và địa chỉ IP (nếu biết)"""
+    if 'login_client' not in st.session_state:
+        st.session_state.login_client = uuid.uuid4().hex
+    clients = [('session', st.session_state.login_client)]
+    if st.context.ip_address:
+        clients.append(('address', st.context.ip_address))
+    return clients
+
+
+# --- TÌM KIẾM VĐV ---
+def fold_text(text):
+    """Chuẩn hóa để tìm kiếm: bỏ dấu tiếng Việt, đ → d, chữ thường"""
+    text = str(text or '').replace('đ', 'd').replace('Đ', 'D')
+    text = unicodedata.normalize('NFD', text)
+    return ''.join(ch for ch in text if not unicodedata.combining(ch)).lower()
+
+def search_terms(text):
+    return re.findall(r'\w+', fold_text(text))
+
+class AthleteSearchIndex:
+    """Chỉ mục tìm kiếm theo tiền tố (không dấu) trên tên VĐV, đơn vị và nội dung thi"""
+    SOURCE_SHEETS = ('registrations', 'entries', 'contents', 'disciplines')
+    REBUILD_AFTER = 300
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+    def rebuild(self):
+        df_reg = get_data('registrations')
+        df_ent = get_entries()
+        _, label_of = get_content_catalog()
+        contents_of = {}
+        for reg_id, disc_id, cont_id in zip(df_ent['registrationId'], df_ent['discipline_id'], df_ent['content_id']):
+            if (disc_id, cont_id) in label_of:
+                contents_of.setdefault(reg_id, []).append(label_of[(disc_id, cont_id)])
+        ids, labels, pairs = [], [], []
+        for reg in (df_reg.to_dict('records') if not df_reg.empty else []):
+            reg_id = str(reg['id'])
+            contents = ENTRY_SEPARATOR.join(contents_of.get(reg_id, [])) or str(reg.get('registered_contents', '') or '')
+            label = f"{reg.get('athleteName', '')} ({reg.get('unitName', '')}) - {contents}"
+            pos = len(ids)
+            ids.append(reg_id)
+            labels.append(label)
+            pairs.extend((term, pos) for term in set(search_terms(label)))
+        pairs.sort()
+        with self._lock:
+            self._ids, self._labels = ids, labels
+            self._terms = [t for t, _ in pairs]
+            self._postings = [p for _, p in pairs]
+            self._built_at = time.monotonic()
+
+    def _ensure_built(self):
+        if self._built_at is None or time.monotonic() - self._built_at > self.REBUILD_AFTER:
+            self.rebuild()
+
+    def _prefix_matches(self, term):
+        lo = bisect.bisect_left(self._terms, term)
+        hi = bisect.bisect_left(self._terms, term + '\uffff')
+        return set(self._postings[lo:hi])
+
+    def search(self, query, page=1, page_size=20):
+        """Trả về ([(registration_id, nhãn)] của trang, tổng số kết quả); mọi từ trong query phải khớp tiền tố"""
+        with self._lock:
+            self._ensure_built()
+            terms = search_terms(query)
+            if terms:
+                matched = None
+                for term in sorted(terms, key=len, reverse=True):
+                    hits = self._prefix_matches(term)
+                    matched = hits if matched is None else matched & hits
+                    if not matched:
+                        break
+                positions = sorted(matched or [])
+            else:
+                positions = range(len(self._ids))
+            start = (max(page, 1) - 1) * page_size
+            return [(self._ids[p], self._labels[p]) for p in positions[start:start + page_size]], len(positions)
+
+@st.cache_resource
+def get_athlete_search_index():
+    return AthleteSearchIndex()
+
+
+# --- KIỂM TRA HỢP LỆ ĐĂNG KÝ ---
+def parse_age_groups(text):
+    """Cấu hình lứa tuổi "U11: 2015-2016; U14: 2012-2014" → {tên: (năm sinh nhỏ nhất, lớn nhất)}"""
+    groups = {}
+    for part in str(text or '').split(';'):
+        name, _, years = part.partition(':')
+        match = re.fullmatch(r'\s*(\d{4})\s*(?:-\s*(\d{4})\s*)?', years)
+        if name.strip() and match:
+            lo, hi = int(match.group(1)), int(match.group(2) or match.group(1))
+            groups[name.strip()] = (min(lo, hi), max(lo, hi))
+    return groups
+
+def norm_id_value(value):
+    """Bản vô hướng của normalize_id_number"""
+    return str(value if value is not None else '').strip().lstrip('0')
+
+class RegistrationRules:
+    """Luật đăng ký dựng sẵn thành chỉ mục băm trong bộ nhớ, cập nhật dần theo từng lệnh ghi:
+    - giới tính của nội dung ("Nam & Nữ" nhận cả hai)
+    - hạn mức số VĐV mỗi đơn vị cho một nội dung (config max_per_content; môn is_exempt không giới hạn)
+    - lứa tuổi theo năm sinh (config age_groups)
+    - CCCD / mã học sinh không trùng trên toàn giải
+
+    validate() kiểm tra một VĐV chỉ bằng tra từ điển; audit() quét toàn giải bằng các phép toán trên cột.
+    """
+    SOURCE_SHEETS = ('registrations', 'entries', 'contents', 'disciplines', 'config')
+    REBUILD_AFTER = 300
+    ANY_GENDER = 'Nam & Nữ'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._built_at = None
+
+    def _ensure_built(self):
+        if self._built_at is None or time.monotonic() - self._built_at > self.REBUILD_AFTER:
+            self.rebuild()
+
+    def rebuild(self):
+        df_reg = ensure_columns(get_data('registrations'), EXPECTED_HEADERS['registrations'])
+        df_ent = get_entries()
+        df_disc = ensure_columns(get_data('disciplines'), EXPECTED_HEADERS['disciplines'])
+        catalog = get_catalog()
+        content = get_content_frame()
+        try:
+            quota = max(int(get_config('max_per_content') or 0), 0)
+        except ValueError:
+            quota = 0
+        with self._lock:
+            self.quota = quota
+            self.age_groups = parse_age_groups(get_config('age_groups'))
+            self.exempt = set(df_disc['id'][df_disc['is_exempt'].astype(str).str.lower() == 'true'])
+            self.content_gender = {(disc_id, cont_id): gender if gender in ('Nam', 'Nữ') else self.ANY_GENDER
+                                   for disc_id, cont_id, gender in zip(content['discipline_id'], content['content_id'],
+                                                                       content['gender'].astype(str))}
+            self.label_of = dict(catalog.by_key)
+            self._by_cccd, self._by_student_id, self._regs = {}, {}, {}
+            for reg_id, cccd, sid, unit_id, unit_name in zip(df_reg['id'], df_reg['cccd'], df_reg['studentId'],
+                                                             df_reg['unitId'], df_reg['unitName']):
+                self._add_registration(reg_id, {'cccd': cccd, 'studentId': sid, 'unitId': unit_id, 'unitName': unit_name})
+            self._entries, self._entry_counts, self._keys_of = {}, {}, {}
+            for entry_id, reg_id, unit_id, disc_id, cont_id in zip(df_ent['id'], df_ent['registrationId'], df_ent['unitId'],
+                                                                    df_ent['discipline_id'], df_ent['content_id']):
+                self._add_entry(entry_id, (reg_id, unit_id, disc_id, cont_id))
+            self._built_at = time.monotonic()
+
+    # --- Cập nhật dần ---
+    def _add_registration(self, reg_id, reg):
+        reg = {'cccd': norm_id_value(reg.get('cccd')), 'studentId': norm_id_value(reg.get('studentId')),
+               'unitId': str(reg.get('unitId', '')), 'unitName': str(reg.get('unitName', ''))}
+        self._regs[reg_id] = reg
+        for index, key in ((self._by_cccd, reg['cccd']), (self._by_student_id, reg['studentId'])):
+            if key:
+                index.setdefault(key, set()).add(reg_id)
+
+    def _remove_registration(self, reg_id):
+        reg = self._regs.pop(reg_id, None)
+        if reg is None:
+            return None
+        for index, key in ((self._by_cccd, reg['cccd']), (self._by_student_id, reg['studentId'])):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(reg_id)
+                if not ids:
+                    del index[key]
+        return reg
+
+    def _add_entry(self, entry_id, entry):
+        reg_id, unit_id, disc_id, cont_id = entry
+        self._entries[entry_id] = entry
+        count_key = (unit_id, disc_id, cont_id)
+        self._entry_counts[count_key] = self._entry_counts.get(count_key, 0) + 1
+        self._keys_of.setdefault(reg_id, set()).add((disc_id, cont_id))
+
+    def _remove_entry(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return None
+        reg_id, unit_id, disc_id, cont_id = entry
+        count_key = (unit_id, disc_id, cont_id)
+        self._entry_counts[count_key] -= 1
+        if self._entry_counts[count_key] <= 0:
+            del self._entry_counts[count_key]
+        keys = self._keys_of.get(reg_id)
+        if keys is not None:
+            keys.discard((disc_id, cont_id))
+        return entry
+
+    def apply_change(self, sheet_name, op, doc_id, data):
+        with self._lock:
+            if self._built_at is None:
+                return
+            doc_id = str(doc_id)
+            if sheet_name == 'registrations':
+                old = self._remove_registration(doc_id)
+                if op != 'delete':
+                    self._add_registration(doc_id, dict(old or {}, **data))
+            elif sheet_name == 'entries':
+                old = self._remove_entry(doc_id)
+                if op != 'delete':
+                    fields = dict(zip(('registrationId', 'unitId', 'discipline_id', 'content_id'), old or ('', '', '', '')))
+                    fields.update({k: str(v) for k, v in data.items() if k in fields})
+                    self._add_entry(doc_id, tuple(fields.values()))
+            elif sheet_name in self.SOURCE_SHEETS:
+                self._built_at = None
+
+    # --- Kiểm tra ---
+    def derive_age_group(self, dob):
+        """Lứa tuổi đầu tiên chứa năm sinh, None nếu không có hoặc chưa cấu hình"""
+        with self._lock:
+            self._ensure_built()
+            if dob is None or pd.isna(dob):
+                return None
+            year = pd.Timestamp(dob).year
+            return next((name for name, (lo, hi) in self.age_groups.items() if lo <= year <= hi), None)
+
+    def derive_age_groups(self, dob):
+        """Bản theo cột của derive_age_group (dob: Series datetime)"""
+        with self._lock:
+            self._ensure_built()
+            groups = pd.Series(None, index=dob.index, dtype=object)
+            for name, (lo, hi) in reversed(list(self.age_groups.items())):
+                groups = groups.mask(dob.dt.year.between(lo, hi), name)
+            return groups
+
+    def _owners(self, index, key, registration_id):
+        ids = index.get(key, set()) - {str(registration_id)}
+        return sorted({self._regs[i]['unitName'] for i in ids if i in self._regs})
+
+    def validate(self, athlete, keys, unit_id, registration_id=None):
+        """Danh sách lỗi của một VĐV định đăng ký các nội dung keys [(discipline_id, content_id)]"""
+        problems = []
+        with self._lock:
+            self._ensure_built()
+            for field, label, index in (('cccd', "CCCD", self._by_cccd), ('studentId', "Mã học sinh", self._by_student_id)):
+                key = norm_id_value(athlete.get(field))
+                owners = self._owners(index, key, registration_id) if key else []
+                if owners:
+                    problems.append(f"{label} {athlete.get(field)} đã được đăng ký ({', '.join(owners)})")
+            if len(set(keys)) != len(keys):
+                problems.append("Chọn trùng nội dung")
+            own = self._keys_of.get(str(registration_id), set()) if registration_id is not None else set()
+            for key in dict.fromkeys(keys):
+                label = self.label_of.get(key, key[1])
+                gender = self.content_gender.get(key, self.ANY_GENDER)
+                if gender != self.ANY_GENDER and gender != athlete.get('gender'):
+                    problems.append(f"{label} chỉ dành cho VĐV {gender}")
+                # Nội dung VĐV đã có từ trước không tính lại, để sửa thông tin khác không bị chặn
+                if self.quota and key[0] not in self.exempt and key not in own:
+                    if self._entry_counts.get((str(unit_id), *key), 0) >= self.quota:
+                        problems.append(f"Đơn vị đã đủ {self.quota} VĐV cho nội dung {label}")
+            years = self.age_groups.get(str(athlete.get('ageGroup', '')).strip())
+            dob = athlete.get('dob')
+            if years and (dob is None or pd.isna(dob) or not years[0] <= pd.Timestamp(dob).year <= years[1]):
+                problems.append(f"Năm sinh không thuộc lứa tuổi {athlete.get('ageGroup')} ({years[0]}-{years[1]})")
+        return problems
+
+    def batch_errors(self, df, picks, unit_id):
+        """Lỗi của cả file nhập (cột cccd, studentId, dob, ageGroup; picks: idx, discipline_id, content_id, label).
+
+        Trả về Series chuỗi lỗi "…; " theo index của df, tính cả VĐV đã có và các dòng phía trên trong file.
+        """
+        errors = pd.Series('', index=df.index)
+        with self._lock:
+            self._ensure_built()
+            for field, label, index in (('cccd', "CCCD", self._by_cccd), ('studentId', "Mã học sinh", self._by_student_id)):
+                key = normalize_id_number(df[field])
+                errors = errors.mask((key != '') & key.isin(index.keys()), errors + f"{label} đã được đăng ký; ")
+            errors = errors.mask((normalize_id_number(df['studentId']) != '') & normalize_id_number(df['studentId']).duplicated(keep=False),
+                                 errors + "Mã học sinh trùng trong file; ")
+            lo = df['ageGroup'].map({name: years[0] for name, years in self.age_groups.items()})
+            hi = df['ageGroup'].map({name: years[1] for name, years in self.age_groups.items()})
+            year = parse_dob(df['dob']).dt.year
+            errors = errors.mask(lo.notna() & ~year.between(lo, hi), errors + "Năm sinh không thuộc lứa tuổi; ")
+            if self.quota and not picks.empty:
+                counted = picks[~picks['discipline_id'].isin(self.exempt)]
+                taken = pd.Series([self._entry_counts.get((str(unit_id), d, c), 0)
+                                   for d, c in zip(counted['discipline_id'], counted['content_id'])], index=counted.index)
+                rank_in_file = counted.groupby(['discipline_id', 'content_id']).cumcount() + 1
+                over = counted[taken + rank_in_file > self.quota]
+                over = over.groupby('idx')['label'].agg(', '.join)
+                errors = errors + (f"Vượt hạn mức {self.quota} VĐV/nội dung: " + over + "; ").reindex(df.index, fill_value='')
+        return errors
+
+    def audit(self):
+        """Quét toàn giải, trả về bảng vi phạm: Luật, VĐV, Đơn vị, Chi tiết"""
+        columns = ['Luật', 'VĐV', 'Đơn vị', 'Chi tiết']
+        df_reg = ensure_columns(get_data('registrations'), EXPECTED_HEADERS['registrations'])
+        reg = pd.DataFrame({'registrationId': df_reg['id'], 'athleteName': df_reg['athleteName'].astype(str),
+                            'unitName': df_reg['unitName'].astype(str), 'gender': df_reg['gender'].astype(str),
+                            'ageGroup': df_reg['ageGroup'].astype(str).str.strip(), 'dob': parse_dob(df_reg['dob'].astype(str))
+                            if df_reg['dob'].dtype == object else df_reg['dob']})
+        issues = []
+
+        def add(rule, frame, detail):
+            issues.append(pd.DataFrame({'Luật': rule, 'VĐV': frame['athleteName'], 'Đơn vị': frame['unitName'], 'Chi tiết': detail}))
+
+        for field, label in (('cccd', "CCCD"), ('studentId', "Mã học sinh")):
+            key = normalize_id_number(df_reg[field])
+            dup = (key != '') & key.duplicated(keep=False)
+            add(f"Trùng {label}", reg[dup], label + " " + df_reg.loc[dup, field].astype(str))
+
+        with self._lock:
+            self._ensure_built()
+            quota, exempt, age_groups = self.quota, set(self.exempt), dict(self.age_groups)
+            gender_of = dict(self.content_gender)
+        content = get_content_frame()
+        content['gender'] = [gender_of.get(key, self.ANY_GENDER) for key in zip(content['discipline_id'], content['content_id'])]
+        ent = get_entries()[['registrationId', 'unitId', 'discipline_id', 'content_id']].astype(str)
+        ent = ent.merge(reg, on='registrationId', how='inner')
+        ent = ent.merge(content.rename(columns={'gender': 'content_gender'}), on=['discipline_id', 'content_id'], how='left')
+        ent['label'] = ent['label'].fillna(ent['content_id'])
+
+        wrong_gender = ent[ent['content_gender'].notna() & (ent['content_gender'] != self.ANY_GENDER) & (ent['content_gender'] != ent['gender'])]
+        add("Sai giới tính", wrong_gender, wrong_gender['label'] + " (" + wrong_gender['content_gender'] + ")")
+        dup_entries = ent[ent.duplicated(['registrationId', 'discipline_id', 'content_id'])]
+        add("Đăng ký trùng nội dung", dup_entries, dup_entries['label'])
+
+        if quota:
+            counted = ent[~ent['discipline_id'].isin(exempt)]
+            sizes = counted.groupby(['unitName', 'label']).size().reset_index(name='n')
+            over = sizes[sizes['n'] > quota].assign(athleteName='')
+            add("Vượt hạn mức", over, over['label'] + ": " + over['n'].astype(str) + f"/{quota} VĐV")
+
+        if age_groups:
+            lo = reg['ageGroup'].map({name: years[0] for name, years in age_groups.items()})
+            hi = reg['ageGroup'].map({name: years[1] for name, years in age_groups.items()})
+            bad = reg[lo.notna() & ~reg['dob'].dt.year.between(lo, hi)]
+            add("Sai lứa tuổi", bad, bad['ageGroup'] + ": năm sinh " + bad['dob'].dt.year.astype('Int64').astype(str))
+
+        issues = [frame for frame in issues if not frame.empty]
+        if not issues:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(issues, ignore_index=True)[columns]
+
+@st.cache_resource
+def get_registration_rules():
+    return RegistrationRules()
+
+
+# --- BỐC THĂM ---
+def draw_tasks(formats, heat_size, seed, keys=None):
+    """Công việc bốc thăm cho từng nội dung có VĐV; formats: {discipline_id: định dạng}, keys: chỉ các nội dung này"""
+    df_ent = get_entries()[['id', 'unitId', 'discipline_id', 'content_id']].astype(str)
+    tasks = []
+    for key, group in df_ent.groupby(['discipline_id', 'content_id'], sort=True):
+        if keys is None or key in keys:
+            tasks.append((key, list(zip(group['id'], group['unitId'])), formats.get(key[0], draws.KNOCKOUT), heat_size, seed))
+    return tasks
+
+def run_draws(tasks):
+    """Bốc thăm các nội dung song song trên nhiều process (spawn: không kế thừa luồng nền của app)"""
+    workers = min(get_int_setting('draw_workers', os.cpu_count() or 1), len(tasks))
+    if workers > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                return dict(pool.map(draws.draw_content, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+        except (OSError, BrokenProcessPool) as e:
+            logger.warning("Không chạy được process pool, bốc thăm tuần tự: %s", e)
+    return dict(map(draws.draw_content, tasks))
+
+def load_draws():
+    """{(discipline_id, content_id): dòng draws kèm layout đã giải mã}"""
+    df = ensure_columns(get_data('draws'), EXPECTED_HEADERS['draws'])
+    result = {}
+    for row in df.to_dict('records'):
+        try:
+            row['layout'] = json.loads(row['layout'])
+        except (TypeError, ValueError):
+            continue
+        result[(str(row['discipline_id']), str(row['content_id']))] = row
+    return result
+
+def save_draws(layouts, seed):
+    """Ghi kết quả bốc thăm: nội dung đã có sơ đồ thì thay layout (một lệnh ghi gộp), nội dung mới thì thêm dòng"""
+    existing = load_draws()
+    updates, new_rows = {}, []
+    for (disc_id, cont_id), layout in layouts.items():
+        row = {'discipline_id': disc_id, 'content_id': cont_id, 'format': layout['format'], 'seed': str(seed),
+               'layout': json.dumps(layout, ensure_ascii=False, separators=(',', ':'))}
+        if (disc_id, cont_id) in existing:
+            updates[existing[(disc_id, cont_id)]['id']] = row
         else:
-            ws.append_row([key, str(value)])
-    except:
-        ws.append_row([key, str(value)])
+            new_rows.append(row)
+    if updates and update_rows_data('draws', updates) is None:
+        return False
+    return not new_rows or save_rows('draws', new_rows)
+
+def record_bracket(draw, layout, expected_version):
+    """Lưu người thắng của sơ đồ (chỉ khi sơ đồ vẫn ở expected_version — bản đang hiển thị) và ghi thứ hạng huy chương suy ra vào entries"""
+    if not update_row_data('draws', draw['id'], {'layout': json.dumps(layout, ensure_ascii=False, separators=(',', ':'))},
+                           expected_version=expected_version):
+        return False
+    ranks = draws.bracket_ranks(layout, MEDAL_RANKS)
+    df_ent = get_entries()
+    df_ent = df_ent[(df_ent['discipline_id'] == draw['discipline_id']) & (df_ent['content_id'] == draw['content_id'])]
+    changed, versions = {}, {}
+    for entry_id, rank, version in zip(df_ent['id'], df_ent['rank'].astype(str), df_ent['version']):
+        # Huy chương cũ không còn đúng (sửa kết quả trận) thì xóa; thứ hạng khác nhập tay giữ nguyên
+        new_rank = ranks.get(entry_id, '' if rank in MEDAL_RANKS else rank)
+        if new_rank != rank:
+            changed[entry_id] = {'rank': new_rank}
+            versions[entry_id] = version
+    # Thứ hạng suy ra từ entries vừa đọc: không ghi đè nếu ai đó sửa các entries này trong lúc đó
+    return not changed or update_rows_data('entries', changed, versions) == []
+
+
+# --- NHẬP FILE ---
+def read_uploaded_table(uploaded_file):
+    """Đọc file CSV/XLSX tải lên thành DataFrame toàn chuỗi (ô trống = "")"""
+    if uploaded_file.name.lower().endswith(('.xlsx', '.xls')):
+        df = pd.read_excel(uploaded_file, dtype=str)
+    else:
+        df = pd.read_csv(uploaded_file, dtype=str, encoding='utf-8-sig')
+    df.columns = [str(c).strip() for c in df.columns]
+    return df.fillna('').apply(lambda col: col.str.strip())
+
+# --- NHẬP KẾT QUẢ HÀNG LOẠT ---
+RESULT_IMPORT_COLUMNS = ['athleteId', 'athleteName', 'unitName', 'content', 'rank']
+
+def result_import_template(content_label=None):
+    """File mẫu điền sẵn các VĐV đã đăng ký (lọc theo một nội dung nếu có)"""
+    board = get_entry_board()
+    if content_label:
+        board = board[board['content'] == content_label]
+    template = board.rename(columns={'registrationId': 'athleteId'})
+    return ensure_columns(template, RESULT_IMPORT_COLUMNS)[RESULT_IMPORT_COLUMNS]
+
+def plan_result_import(df_in):
+    """Đối chiếu file kết quả với entries hiện có trong một lượt (không gọi API).
+
+    Mỗi dòng xác định VĐV bằng athleteId, hoặc athleteName + unitName (so khớp không dấu).
+    Trả về DataFrame gồm cột gốc + entryId, entryVersion (version lúc đối chiếu), oldRank, newRank, status.
+    """
+    df = ensure_columns(df_in.copy(), RESULT_IMPORT_COLUMNS)[RESULT_IMPORT_COLUMNS].astype(str)
+    df_reg = ensure_columns(get_data('registrations'), EXPECTED_HEADERS['registrations'])
+    reg_ids = df_reg['id'].astype(str)
+    person_keys = df_reg['athleteName'].map(fold_text) + '|' + df_reg['unitName'].astype(str).map(fold_text)
+    ambiguous_keys = set(person_keys[person_keys.duplicated(keep=False)])
+    id_by_person = pd.Series(reg_ids.values, index=person_keys.values)
+    id_by_person = id_by_person[~id_by_person.index.duplicated(keep=False)]
+
+    df['person_key'] = df['athleteName'].map(fold_text) + '|' + df['unitName'].map(fold_text)
+    df['registrationId'] = df['athleteId'].where(df['athleteId'] != '', df['person_key'].map(id_by_person)).fillna('')
+    df['content_key'] = df['content'].map(fold_text)
+
+    board = get_entry_board()
+    board = pd.DataFrame({'entryId': board['id'].astype(str), 'registrationId': board['registrationId'],
+                          'content_key': board['content'].map(fold_text), 'oldRank': board['rank'].astype(str),
+                          'entryVersion': [stored_value(REVISION_COLUMN, v) for v in board[REVISION_COLUMN]]})
+    plan = df.merge(board, on=['registrationId', 'content_key'], how='left')
+    plan['newRank'] = plan['rank'].map(fold_text).map({fold_text(r): r for r in RANK_OPTIONS})
+
+    # Điều kiện sau ghi đè điều kiện trước: lỗi gốc rễ nhất được báo
+    status = pd.Series('Cập nhật', index=plan.index)
+    status = status.mask(plan['newRank'] == plan['oldRank'], 'Không đổi')
+    status = status.mask(plan['entryId'].notna() & plan['entryId'].duplicated(keep=False), 'Trùng dòng trong file')
+    status = status.mask(plan['newRank'].isna(), 'Thứ hạng không hợp lệ')
+    status = status.mask(plan['entryId'].isna(), 'VĐV không đăng ký nội dung này')
+    status = status.mask(~plan['registrationId'].isin(set(reg_ids)), 'Không tìm thấy VĐV')
+    status = status.mask((plan['athleteId'] == '') & plan['person_key'].isin(ambiguous_keys), 'Trùng tên trong đơn vị, cần athleteId')
+    plan['status'] = status
+    return plan.drop(columns=['person_key', 'content_key'])
+
+def apply_result_import(plan):
+    """Ghi mọi thứ hạng thay đổi bằng một lệnh cập nhật gộp; trả về số dòng đã ghi.
+
+    Chỉ ghi khi các entries vẫn ở version lúc lập kế hoạch, không đè lên kết quả được sửa sau đó.
+    """
+    accepted = plan[plan['status'] == 'Cập nhật']
+    updates = {entry_id: {'rank': rank} for entry_id, rank in zip(accepted['entryId'], accepted['newRank'])}
+    if not updates:
+        return 0
+    missing = update_rows_data('entries', updates, dict(zip(accepted['entryId'], accepted['entryVersion'])))
+    if missing is None:
+        return 0
+    return len(updates) - len(missing)
+
+
+# --- ĐĂNG KÝ VĐV HÀNG LOẠT ---
+REGISTRATION_IMPORT_COLUMNS = ['athleteName', 'gender', 'dob', 'cccd', 'studentId', 'systemName', 'ageGroup', 'contents']
+
+def normalize_id_number(series):
+    """So khớp CCCD/mã HS: Google Sheets có thể đã bỏ số 0 đầu khi đọc dạng số"""
+    return series.astype(str).str.strip().str.lstrip('0')
+
+def parse_dob(series):
+    """Nhận ngày sinh dạng YYYY-MM-DD hoặc DD/MM/YYYY"""
+    iso = pd.to_datetime(series, format='%Y-%m-%d', errors='coerce')
+    return iso.fillna(pd.to_datetime(series, format='%d/%m/%Y', errors='coerce'))
+
+def plan_registration_import(df_in, unit):
+    """Kiểm tra toàn bộ file đăng ký trong một lượt, trả về (bảng VĐV có cột errors, bảng entries dự kiến)"""
+    df = ensure_columns(df_in.copy(), REGISTRATION_IMPORT_COLUMNS)[REGISTRATION_IMPORT_COLUMNS].astype(str).reset_index(drop=True)
+    df.insert(0, 'row', range(2, len(df) + 2))
+    errors = pd.Series('', index=df.index)
+
+    def flag(mask, message):
+        nonlocal errors
+        errors = errors.where(~mask, errors + message + '; ')
+
+    flag(df['athleteName'] == '', "Thiếu họ tên")
+
+    gender_map = {fold_text(g): g for g in ['Nam', 'Nữ']}
+    df['gender'] = df['gender'].map(fold_text).map(gender_map)
+    flag(df['gender'].isna(), "Giới tính phải là Nam/Nữ")
+
+    dob = parse_dob(df['dob'])
+    flag(dob.isna(), "Ngày sinh không hợp lệ")
+    df['dob'] = dob.dt.strftime('%Y-%m-%d').fillna('')
+
+    df_sys = get_data('systems')
+    sys_names = df_sys['name'].astype(str).tolist() if not df_sys.empty else ["Mặc định"]
+    df['systemName'] = df['systemName'].where(df['systemName'] != '', sys_names[0])
+    flag(~df['systemName'].isin(sys_names), "Hệ thi đấu không tồn tại")
+    rules = get_registration_rules()
+    df['ageGroup'] = df['ageGroup'].where(df['ageGroup'] != '', rules.derive_age_groups(dob).fillna('Tự do'))
+
+    cccd = normalize_id_number(df['cccd'])
+    flag((cccd != '') & cccd.duplicated(keep=False), "CCCD trùng trong file")
+
+    # Tách cột contents thành từng nội dung rồi đối chiếu danh mục bằng một phép merge
+    catalog = get_content_frame()
+    catalog['key'] = catalog['label'].map(fold_text)
+    wanted = df['contents'].str.split(';').explode().str.strip()
+    wanted = wanted[wanted.notna() & (wanted != '')]
+    picks = pd.DataFrame({'idx': wanted.index, 'key': wanted.map(fold_text).values, 'raw': wanted.values})
+    picks = picks.merge(catalog.rename(columns={'gender': 'content_gender'}), on='key', how='left')
+    picks['athlete_gender'] = df.loc[picks['idx'], 'gender'].values
+    unknown = picks[picks['label'].isna()].groupby('idx')['raw'].agg(', '.join)
+    wrong_gender = picks[picks['label'].notna() & ~picks['content_gender'].isin(['Nam & Nữ']) &
+                         (picks['content_gender'] != picks['athlete_gender'])].groupby('idx')['label'].agg(', '.join)
+    flag(~df.index.isin(picks['idx']), "Chưa chọn nội dung")
+    errors = errors + ("Nội dung không tồn tại: " + unknown + "; ").reindex(df.index, fill_value='')
+    errors = errors + ("Sai giới tính với nội dung: " + wrong_gender + "; ").reindex(df.index, fill_value='')
+    picks = picks[picks['label'].notna()].drop_duplicates(['idx', 'label'])
+    df['contents'] = picks.groupby('idx')['label'].agg(ENTRY_SEPARATOR.join).reindex(df.index, fill_value='')
+    errors = errors + rules.batch_errors(df, picks, unit['id'])
+
+    df['gender'] = df['gender'].fillna('')
+    df['errors'] = errors.str.rstrip('; ')
+    return df, picks[['idx', 'discipline_id', 'content_id']]
+
+def apply_registration_import(plan, picks, unit):
+    """Ghi các dòng hợp lệ: một lệnh append cho registrations và một cho entries; trả về số VĐV đã ghi"""
+    accepted = plan[plan['errors'] == '']
+    if accepted.empty:
+        return 0
+    reg_rows, reg_id_of = [], {}
+    for idx, row in accepted.iterrows():
+        reg_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+        reg_id_of[idx] = reg_id
+        reg_rows.append({'id': reg_id, 'unitId': unit['id'], 'unitName': unit['name'], 'athleteName': row['athleteName'],
+                         'gender': row['gender'], 'dob': row['dob'], 'cccd': row['cccd'], 'studentId': row['studentId'],
+                         'systemName': row['systemName'], 'ageGroup': row['ageGroup'], 'registered_contents': row['contents']})
+    entry_rows = [{'registrationId': reg_id_of[idx], 'unitId': str(unit['id']), 'discipline_id': disc_id, 'content_id': cont_id, 'rank': ''}
+                  for idx, disc_id, cont_id in picks.itertuples(index=False) if idx in reg_id_of]
+    if not save_rows('registrations', reg_rows):
+        return 0
+    if entry_rows:
+        save_rows('entries', entry_rows)
+    return len(reg_rows)
+
+# --- XUẤT DỮ LIỆU ---
+EXPORT_KINDS = {
+    'registrations': "Danh sách VĐV",
+    'start_lists': "Danh sách thi theo nội dung",
+    'results': "Bảng kết quả",
+}
+EXPORT_FORMATS = {
+    'csv': ('text/csv', '.csv'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', '.xlsx'),
+}
+
+def export_groups(kind, unit_id=None):
+    """Các nhóm (tên, DataFrame) cần xuất, lấy từ dữ liệu đã cache; lọc theo đơn vị nếu có unit_id.
+
+    start_lists / results chia nhóm theo nội dung (mỗi nhóm một sheet khi xuất XLSX).
+    """
+    if kind == 'registrations':
+        df = ensure_columns(get_data('registrations'), EXPECTED_HEADERS['registrations'])
+        if unit_id is not None:
+            df = df[df['unitId'] == str(unit_id)]
+        board = get_entry_board()
+        board = board[board['rank'].astype(str) != '']
+        results = (board['content'] + ": " + board['rank'].astype(str)).groupby(board['registrationId']).agg(ENTRY_SEPARATOR.join)
+        df = df.assign(results=df['id'].map(results).fillna(''), dob=format_dates(df['dob']))
+        cols = ['athleteName', 'gender', 'dob', 'studentId', 'cccd', 'systemName', 'ageGroup', 'unitName', 'registered_contents', 'results']
+        return [(EXPORT_KINDS[kind], df[cols])]
+
+    board = get_entry_board()
+    if unit_id is not None:
+        board = board[board['unitId'] == str(unit_id)]
+    if kind == 'results':
+        board = board[board['rank'].astype(str) != '']
+        rank_order = {r: i for i, r in enumerate(RANK_OPTIONS)}
+        board = board.assign(_order=board['rank'].astype(str).map(rank_order).fillna(len(RANK_OPTIONS)))
+        board = board.sort_values(['content', '_order', 'athleteName'])
+        cols = ['content', 'rank', 'athleteName', 'unitName']
+    else:
+        board = board.sort_values(['content', 'unitName', 'athleteName'])
+        cols = ['content', 'athleteName', 'unitName']
+    return [(content or "Chung", group[cols]) for content, group in board.groupby('content', sort=False)]
+
+def write_export_csv(groups, fh):
+    """Ghi nối tiếp các nhóm vào fh thành một bảng CSV (header một lần)"""
+    header = True
+    for _, df in groups:
+        df.to_csv(fh, index=False, header=header)
+        header = False
+    if header and groups:
+        groups[0][1].head(0).to_csv(fh, index=False)
+
+def write_export_xlsx(groups, fh):
+    """Workbook write-only của openpyxl (không giữ đối tượng ô), mỗi nhóm một sheet"""
+    wb = Workbook(write_only=True)
+    used = set()
+    for name, df in groups or [("Trống", pd.DataFrame())]:
+        # Tên sheet Excel tối đa 31 ký tự, không chứa []:*?/\ và không trùng nhau
+        title = re.sub(r'[\[\]:*?/\\]', ' ', str(name))[:31] or "Sheet"
+        base, n = title, 1
+        while title in used:
+            n += 1
+            title = f"{base[:28]}~{n}"
+        used.add(title)
+        ws = wb.create_sheet(title=title)
+        ws.append(list(df.columns))
+        for row in df.itertuples(index=False):
+            ws.append([str(v) for v in row])
+    wb.save(fh)
+
+def build_export(kind, fmt, unit_id=None):
+    """Tạo cả file xuất trong bộ nhớ từ dữ liệu đã cache; trả về nội dung (bytes) cho download_button"""
+    groups = export_groups(kind, unit_id)
+    buffer = io.BytesIO()
+    if fmt == 'csv':
+        fh = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+        write_export_csv(groups, fh)
+        # Tách wrapper để việc đóng nó không đóng luôn buffer
+        fh.flush()
+        fh.detach()
+    else:
+        write_export_xlsx(groups, buffer)
+    return buffer.getvalue()
+
+def export_panel(key, kinds, unit_id=None, file_prefix="export"):
+    """Chọn loại + định dạng, tạo file khi bấm nút (không tạo lại mỗi lần rerun) rồi hiện nút tải"""
+    c1, c2 = st.columns(2)
+    kind = c1.selectbox("Dữ liệu", kinds, format_func=EXPORT_KINDS.get, key=f"{key}_kind")
+    fmt = c2.radio("Định dạng", list(EXPORT_FORMATS), format_func=str.upper, horizontal=True, key=f"{key}_fmt")
+    state_key = f"{key}_file"
+    if st.button("Tạo file", key=f"{key}_build"):
+        with st.spinner("Đang tạo file..."):
+            data = build_export(kind, fmt, unit_id)
+        mime, suffix = EXPORT_FORMATS[fmt]
+        st.session_state[state_key] = (data, f"{file_prefix}_{kind}{suffix}", mime)
+    built = st.session_state.get(state_key)
+    if built:
+        data, file_name, mime = built
+        st.caption(f"{file_name} ({len(data) / 1024:.0f} KB)")
+        st.download_button("📥 Tải file", data=data, file_name=file_name, mime=mime, key=f"{key}_download")
+
+
+# --- ENDPOINT SỐ LIỆU ---
+def prometheus_metrics():
+    extra = {'quanlygd_change_feed_pending': len(get_change_feed().pending())}
+    storage = get_storage()
+    if isinstance(storage, OfflineMirror):
+        extra['quanlygd_mirror_pending_ops'] = storage.pending_count()
+        extra['quanlygd_mirror_online'] = int(bool(storage.online))
+    if client is not None:
+        g = get_sheets_governor().summary()
+        extra.update({'quanlygd_sheets_calls': g['calls'], 'quanlygd_sheets_retries': g['retries'],
+                      'quanlygd_sheets_failures': g['failures'], 'quanlygd_sheets_throttled_seconds': g['throttled_seconds']})
+    return get_perf_recorder().prometheus_text(extra)
+
+@st.cache_resource
+def start_metrics_server(host, port):
+    """HTTP GET /metrics (text Prometheus) trên cổng riêng, khởi động một lần mỗi tiến trình"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
 
 
 # ==============================================================================
@@ -197,8 +3427,14 @@ def set_config(key, value):
 # ==============================================================================
 
 def main():
-    if not client:
+    if get_storage() is None:
         st.stop()
+    refresher = get_background_refresher() if background_refresh_enabled() else None
+    recorder = get_perf_recorder()
+    run_log = recorder.begin_run()
+    metrics_port = get_int_setting('metrics_port', 0)
+    if metrics_port:
+        start_metrics_server(str(get_setting('metrics_host', '127.0.0.1')), metrics_port)
 
     if 'role' not in st.session_state:
         st.session_state.role = 'guest'
@@ -227,18 +3463,19 @@ def main():
                 else:
                     code = st.text_input("Mã Đăng Ký", max_chars=6).upper()
                     if st.button("Đăng nhập Đơn vị"):
-                        df = get_data('units')
-                        if not df.empty:
-                            df['registrationCode'] = df['registrationCode'].astype(str)
-                            u = df[df['registrationCode'] == code]
-                            if not u.empty:
-                                st.session_state.role = 'unit'
-                                st.session_state.user_info = u.iloc[0].to_dict()
-                                st.rerun()
-                            else:
-                                st.error("Mã không đúng")
-                        else:
+                        login_index = get_unit_login_index()
+                        clients = login_clients()
+                        u, status = login_index.login(code, clients)
+                        if status == 'ok':
+                            st.session_state.role = 'unit'
+                            st.session_state.user_info = u
+                            st.rerun()
+                        elif status == 'locked':
+                            st.error(f"Nhập sai quá nhiều lần, vui lòng thử lại sau {login_index.seconds_locked(clients)} giây")
+                        elif status == 'empty':
                             st.error("Chưa có dữ liệu")
+                        else:
+                            st.error("Mã không đúng")
         else:
             role_name = "ADMIN" if st.session_state.role == 'admin' else st.session_state.user_info['name']
             st.success(f"Xin chào: **{role_name}**")
@@ -247,16 +3484,112 @@ def main():
                 st.session_state.user_info = None
                 st.session_state.editing_athlete = None
                 st.rerun()
+            if st.session_state.role == 'admin' and st.button("🔄 Làm mới dữ liệu"):
+                refresh_data_handles()
+                st.rerun()
+            storage = get_storage()
+            if st.session_state.role == 'admin' and (refresher is not None or client is not None):
+                with st.expander("📡 Đồng bộ nền"):
+                    if refresher is not None:
+                        st.caption(f"Tải lại mỗi {refresher.interval:g} giây · đã chạy {refresher.cycles} vòng")
+                        st.dataframe(refresher.metrics(), use_container_width=True, hide_index=True)
+                    if isinstance(storage, OfflineMirror):
+                        m = storage.status()
+                        synced = datetime.fromtimestamp(m['last_sync_at']).strftime('%H:%M:%S') if m['last_sync_at'] else "chưa"
+                        st.caption(f"Bản sao cục bộ: {m['pending']} thay đổi chờ đẩy · đồng bộ lần cuối: {synced} · "
+                                   f"đối soát mỗi {storage.interval:g} giây")
+                        if m['last_error']:
+                            st.caption(f"Lỗi gần nhất: {m['last_error']}")
+                        if m['rejected']:
+                            st.caption(f"{m['rejected']} thay đổi bị Google Sheets từ chối (bảng _dead_letter trong bản sao cục bộ)")
+                        if storage.conflicts:
+                            st.dataframe(pd.DataFrame(list(storage.conflicts)), use_container_width=True, hide_index=True)
+                        if st.button("🔁 Đồng bộ ngay"):
+                            changed = storage.sync()
+                            st.success(f"Đã đồng bộ ({len(changed)} sheet có thay đổi)." if storage.online else "Chưa kết nối được Google Sheets.")
+                    if client is not None:
+                        g = get_sheets_governor().summary()
+                        st.caption(f"Google Sheets: {g['calls']} lệnh gọi · {g['retries']} lần thử lại · "
+                                   f"{g['failures']} lỗi · chờ hạn mức {g['throttled_seconds']:.1f} giây")
+
+        storage = get_storage()
+        if isinstance(storage, OfflineMirror) and storage.online is False:
+            st.warning(f"📴 Mất kết nối Google Sheets: dữ liệu vẫn lưu trên máy này ({storage.pending_count()} thay đổi chờ đồng bộ).")
         
         st.markdown("---")
         
         if st.session_state.role == 'admin':
-            menu = st.radio("Chức năng:", ["🏠 Tổng quan", "⚙️ Cấu hình Giải đấu", "🏅 Môn & Nội dung thi", "🏢 Quản lý Đơn vị", "🏆 Cập nhật Kết quả"])
+            menu = st.radio("Chức năng:", ["🏠 Tổng quan", "⚙️ Cấu hình Giải đấu", "🏅 Môn & Nội dung thi", "🏢 Quản lý Đơn vị", "🎲 Bốc thăm thi đấu", "🏆 Cập nhật Kết quả", "📦 Xuất dữ liệu", "🧾 Nhật ký thay đổi", "🩺 Hiệu năng"])
         elif st.session_state.role == 'unit':
             menu = st.radio("Chức năng:", ["🏠 Tổng quan", "📝 Đăng ký thi đấu", "📊 Xuất danh sách"])
         else:
             menu = "🏠 Tổng quan"
 
+    try:
+        with recorder.measure('page', menu):
+            render_page(menu)
+    finally:
+        st.session_state.last_run_perf = run_log
+        snapshot = get_sheet_cache().snapshot()
+        if snapshot is not None:
+            st.session_state.last_run_sheets = snapshot.summary()
+
+def render_draw_results(drawn):
+    """Nhập kết quả theo sơ đồ: chọn người thắng từng trận (loại trực tiếp) hoặc thứ hạng theo từng lượt"""
+    _, label_of = get_content_catalog()
+    by_label = {label_of.get(k, k[1]): k for k in drawn}
+    key = by_label[st.selectbox("Nội dung", sorted(by_label))]
+    draw, layout = drawn[key], drawn[key]['layout']
+    board = get_entry_board().set_index('id')
+    names = (board['athleteName'].astype(str) + " (" + board['unitName'].astype(str) + ")").to_dict()
+
+    if layout['format'] == draws.HEATS:
+        ranks = board['rank'].astype(str).to_dict()
+        current_versions = board[REVISION_COLUMN].to_dict()
+        with st.form(f"heat_form_{draw['id']}"):
+            new_ranks, versions = {}, {}
+            for no, heat in enumerate(layout['heats'], start=1):
+                st.markdown(f"**Lượt {no}**")
+                for entry_id in heat:
+                    versions[entry_id] = shown_version('entries', entry_id, current_versions.get(entry_id, ''))
+                    cur_rank = ranks.get(entry_id, '')
+                    opts = RANK_OPTIONS if cur_rank in RANK_OPTIONS else RANK_OPTIONS + [cur_rank]
+                    new_ranks[entry_id] = (cur_rank, st.selectbox(names.get(entry_id, entry_id), opts, index=opts.index(cur_rank),
+                                                                  key=f"heat_rank_{entry_id}"))
+            if st.form_submit_button("Lưu Kết quả"):
+                changed = {eid: {'rank': r} for eid, (old_r, r) in new_ranks.items() if r != old_r}
+                # Hai trọng tài cùng lưu một lượt: bản lưu sau bị từ chối thay vì đè lên bản trước
+                if not changed or update_rows_data('entries', changed, {eid: versions[eid] for eid in changed}) == []:
+                    st.success("Đã cập nhật!")
+                    st.rerun()
+        return
+
+    rounds = draws.bracket_rounds(layout)
+    round_names = {1: "Chung kết", 2: "Bán kết", 3: "Tứ kết"}
+    draw_version = shown_version('draws', draw['id'], draw['version'])
+    with st.form(f"bracket_form_{draw['id']}"):
+        picks = {}
+        for round_no, matches in enumerate(rounds):
+            st.markdown(f"**{round_names.get(len(rounds) - round_no, f'Vòng {round_no + 1}')}**")
+            for match_no, (a, b, winner) in enumerate(matches):
+                if not (a and b):
+                    if a is not None and b is not None:
+                        st.caption(f"Trận {match_no + 1}: {names.get(a or b, a or b)} được miễn đấu")
+                    continue
+                opts = [None, a, b]
+                picks[(round_no, match_no)] = (winner, st.radio(
+                    f"Trận {match_no + 1}", opts, index=opts.index(winner), horizontal=True,
+                    format_func=lambda e: "Chưa đấu" if e is None else names.get(e, e), key=f"match_{draw['id']}_{round_no}_{match_no}"))
+        if st.form_submit_button("Lưu Kết quả"):
+            new_layout = layout
+            for (round_no, match_no), (old, new) in picks.items():
+                if new != old:
+                    new_layout = draws.set_winner(new_layout, round_no, match_no, new)
+            if new_layout is layout or record_bracket(draw, new_layout, draw_version):
+                st.success("Đã cập nhật!")
+                st.rerun()
+
+def render_page(menu):
     # --- ROUTING ---
     
     # 1. TỔNG QUAN
@@ -275,19 +3608,29 @@ def main():
                     st.error(f"🔴 Đã hết hạn đăng ký từ ngày {deadline_str}")
             except: pass
         
-        df_reg = get_data('registrations')
+        stats = get_tournament_stats()
+        summary = stats.summary()
         c1, c2, c3 = st.columns(3)
-        c1.metric("Vận động viên", len(df_reg))
-        c2.metric("Đơn vị tham gia", len(get_data('units')))
-        c3.metric("Môn thi đấu", len(get_data('disciplines')))
+        c1.metric("Vận động viên", summary['athletes'])
+        c2.metric("Đơn vị tham gia", summary['units'])
+        c3.metric("Môn thi đấu", summary['disciplines'])
+
+        if summary['athletes']:
+            medal_table = stats.medal_table()
+            if not medal_table.empty:
+                st.subheader("Bảng tổng sắp huy chương")
+                st.dataframe(medal_table, use_container_width=True, hide_index=True)
 
-        if not df_reg.empty:
             st.subheader("Bảng vàng thành tích")
-            winners = df_reg[df_reg['rank'].isin(['Nhất', 'Nhì', 'Ba'])]
+            winners = stats.winners()
             if not winners.empty:
-                cols = ['athleteName', 'unitName', 'rank']
-                if 'registered_contents' in winners.columns: cols.insert(2, 'registered_contents')
-                st.dataframe(winners[cols], use_container_width=True)
+                st.dataframe(winners, use_container_width=True)
+
+            with st.expander("📈 Số lượt đăng ký theo môn / đơn vị"):
+                by_disc, by_unit = stats.entry_counts()
+                c4, c5 = st.columns(2)
+                c4.dataframe(by_disc, use_container_width=True, hide_index=True)
+                c5.dataframe(by_unit, use_container_width=True, hide_index=True)
 
     # 2. CẤU HÌNH (ADMIN)
     elif menu == "⚙️ Cấu hình Giải đấu":
@@ -295,16 +3638,46 @@ def main():
         with st.form("config_form"):
             t_name = st.text_input("Tên giải đấu", value=get_config('tournament_name') or "")
             deadline = st.date_input("Hạn chót đăng ký", value=datetime.today())
+            st.subheader("Luật đăng ký")
+            try:
+                current_quota = int(get_config('max_per_content') or 0)
+            except ValueError:
+                current_quota = 0
+            max_per_content = st.number_input("Số VĐV tối đa mỗi đơn vị / nội dung (0 = không giới hạn)", min_value=0, value=current_quota)
+            age_groups = st.text_input("Lứa tuổi theo năm sinh", value=get_config('age_groups') or "",
+                                       placeholder="U11: 2015-2016; U14: 2012-2014")
             st.subheader("Hệ thống tổ chức (Hệ thi đấu)")
             new_sys = st.text_input("Thêm Hệ thi đấu mới (Nhập tên):")
             if st.form_submit_button("Lưu Cấu hình"):
                 set_config('tournament_name', t_name)
                 set_config('deadline', str(deadline))
+                set_config('max_per_content', int(max_per_content))
+                set_config('age_groups', age_groups)
                 if new_sys: save_data('systems', {'name': new_sys})
                 st.success("Đã lưu!")
-                st.cache_data.clear()
                 st.rerun()
         
+        st.divider()
+        st.subheader("Rà soát đăng ký")
+        if st.button("Kiểm tra toàn giải"):
+            violations = get_registration_rules().audit()
+            if violations.empty:
+                st.success("Không phát hiện vi phạm.")
+            else:
+                st.warning(f"{len(violations)} vi phạm")
+                st.dataframe(violations, use_container_width=True, hide_index=True)
+
+        st.divider()
+        st.subheader("Dữ liệu nội dung đăng ký")
+        migrated_at = get_config('entries_migrated')
+        if migrated_at:
+            st.caption(f"Đã chuyển đổi dữ liệu cũ lúc {migrated_at}.")
+        if st.button("Chuyển đổi cột 'registered_contents' cũ sang bảng entries"):
+            created, unknown = migrate_registration_entries()
+            st.success(f"Đã tạo {created} lượt đăng ký nội dung.")
+            if unknown:
+                st.warning(f"Không khớp danh mục: {', '.join(unknown)}")
+
         st.divider()
         st.subheader("Danh sách Hệ thi đấu")
         df_sys = get_data('systems')
@@ -330,7 +3703,6 @@ def main():
                     if d_code and d_name:
                         save_data('disciplines', {'code': d_code, 'name': d_name, 'is_exempt': 'True' if d_exempt else 'False'})
                         st.success(f"Đã thêm {d_name}")
-                        st.cache_data.clear()
                         st.rerun()
         
         with c2: 
@@ -346,7 +3718,6 @@ def main():
                         if c_name:
                             save_data('contents', {'discipline_id': selected_disc['id'], 'name': c_name, 'gender': c_gender})
                             st.success("Đã thêm!")
-                            st.cache_data.clear()
                             st.rerun()
                 st.write(f"**Nội dung của {selected_disc_name}:**")
                 df_contents = get_data('contents')
@@ -376,7 +3747,6 @@ def main():
                     code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
                     save_data('units', {'name': u_name, 'manager': u_man, 'registrationCode': code})
                     st.success(f"Mã: {code}")
-                    st.cache_data.clear()
                     st.rerun()
         
         st.divider()
@@ -390,6 +3760,7 @@ def main():
             
             if selected_unit_name != "-- Chọn --":
                 selected_unit = df[df['name'] == selected_unit_name].iloc[0]
+                unit_version = shown_version('units', selected_unit['id'], selected_unit.get('version', ''))
                 
                 with st.container(border=True):
                     st.markdown(f"**Đang thao tác: {selected_unit['name']}** (Mã: `{selected_unit['registrationCode']}`)")
@@ -401,16 +3772,15 @@ def main():
                     col_save, col_del = st.columns([1, 1])
                     
                     if col_save.button("Lưu thay đổi", type="primary"):
-                        if update_row_data('units', selected_unit['id'], {'name': new_u_name, 'manager': new_u_man}):
+                        if update_row_data('units', selected_unit['id'], {'name': new_u_name, 'manager': new_u_man},
+                                           expected_version=unit_version):
                             st.success("Đã cập nhật!")
-                            st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
                     
                     if col_del.button("🗑️ Xóa Đơn vị này"):
-                        if delete_data('units', selected_unit['id']):
+                        if delete_data('units', selected_unit['id'], expected_version=unit_version):
                             st.warning("Đã xóa đơn vị.")
-                            st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
             
@@ -419,39 +3789,129 @@ def main():
         else:
             st.info("Chưa có đơn vị nào.")
 
-    # 5. CẬP NHẬT KẾT QUẢ (ADMIN)
+    # 5. BỐC THĂM THI ĐẤU (ADMIN)
+    elif menu == "🎲 Bốc thăm thi đấu":
+        st.header("🎲 Bốc thăm thi đấu")
+        deadline_str = get_config('deadline')
+        closed = bool(deadline_str) and deadline_str < str(date.today())
+        if not closed:
+            st.warning(f"Chưa hết hạn đăng ký ({deadline_str or 'chưa đặt hạn'}): danh sách VĐV có thể còn thay đổi.")
+        catalog = get_catalog()
+        disc_names = {d['id']: d['name'] for d in catalog.disciplines}
+        drawn = load_draws()
+        with st.form("draw_form"):
+            picked_discs = st.multiselect("Môn cần bốc thăm (để trống = tất cả)", list(disc_names), format_func=lambda d: disc_names[d])
+            c1, c2, c3 = st.columns(3)
+            heat_discs = c1.multiselect("Môn thi chia lượt (còn lại loại trực tiếp)", list(disc_names), format_func=lambda d: disc_names[d])
+            heat_size = c2.number_input("Số VĐV mỗi lượt", min_value=2, value=draws.DEFAULT_HEAT_SIZE)
+            # Mặc định sinh một lần cho phiên; widget có key cố định nên seed người dùng gõ được giữ qua các lần rerun
+            if 'draw_seed_input' not in st.session_state:
+                st.session_state.draw_seed_input = get_config('draw_seed') or str(random.randint(100000, 999999))
+            seed = c3.text_input("Mã bốc thăm (seed)", key='draw_seed_input')
+            redraw = st.checkbox("Bốc lại cả các nội dung đã có sơ đồ (xóa kết quả đã nhập theo sơ đồ)")
+            if st.form_submit_button("Bốc thăm", type="primary", disabled=not seed):
+                keys = [k for k in catalog.by_key if (not picked_discs or k[0] in picked_discs) and (redraw or k not in drawn)]
+                tasks = draw_tasks({d: draws.HEATS for d in heat_discs}, int(heat_size), seed, set(keys))
+                if not tasks:
+                    st.info("Không có nội dung nào cần bốc thăm.")
+                else:
+                    started = time.perf_counter()
+                    layouts = run_draws(tasks)
+                    if save_draws(layouts, seed):
+                        set_config('draw_seed', seed)
+                        st.success(f"Đã bốc thăm {len(layouts)} nội dung trong {time.perf_counter() - started:.1f} giây.")
+                        drawn = load_draws()
+
+        if drawn:
+            st.subheader("Sơ đồ đã bốc thăm")
+            names = get_entry_board().set_index('id')
+            names = (names['athleteName'].astype(str) + " (" + names['unitName'].astype(str) + ")").to_dict()
+            by_label = {catalog.by_key.get(k, k[1]): k for k in drawn}
+            key = by_label[st.selectbox("Nội dung", sorted(by_label))]
+            draw, layout = drawn[key], drawn[key]['layout']
+            st.caption(f"{draws.FORMATS.get(draw['format'], draw['format'])} · seed {draw['seed']}")
+            if layout['format'] == draws.HEATS:
+                for no, heat in enumerate(layout['heats'], start=1):
+                    st.markdown(f"**Lượt {no}**")
+                    st.dataframe(pd.DataFrame({'Đường': range(1, len(heat) + 1), 'VĐV': [names.get(e, e) for e in heat]}),
+                                 use_container_width=True, hide_index=True)
+            else:
+                first_round = draws.bracket_rounds(layout)[0]
+                st.dataframe(pd.DataFrame({'Trận': range(1, len(first_round) + 1),
+                                           'VĐV A': [names.get(a, a) or "(miễn)" for a, _, _ in first_round],
+                                           'VĐV B': [names.get(b, b) or "(miễn)" for _, b, _ in first_round]}),
+                             use_container_width=True, hide_index=True)
+
+    # 6. CẬP NHẬT KẾT QUẢ (ADMIN)
     elif menu == "🏆 Cập nhật Kết quả":
         st.header("🏆 Cập nhật Thành tích")
-        df_reg = get_data('registrations')
-        if df_reg.empty:
+        drawn = load_draws()
+        if drawn and st.radio("Nhập kết quả theo:", ["Sơ đồ thi đấu", "Từng VĐV"], horizontal=True) == "Sơ đồ thi đấu":
+            render_draw_results(drawn)
+            return
+        with st.expander("📥 Nhập kết quả hàng loạt (CSV/XLSX)"):
+            _, label_of = get_content_catalog()
+            tpl_content = st.selectbox("File mẫu cho nội dung:", ["Tất cả"] + sorted(label_of.values()))
+            tpl = result_import_template(None if tpl_content == "Tất cả" else tpl_content)
+            st.download_button("📄 Tải file mẫu", data=tpl.to_csv(index=False).encode('utf-8-sig'),
+                               file_name="mau_ket_qua.csv", mime="text/csv")
+            uploaded = st.file_uploader("Chọn file kết quả", type=['csv', 'xlsx'], key="result_upload")
+            if uploaded is not None:
+                try:
+                    plan = plan_result_import(read_uploaded_table(uploaded))
+                except Exception as e:
+                    st.error(f"Không đọc được file: {e}")
+                    plan = None
+                if plan is not None:
+                    counts = plan['status'].value_counts()
+                    st.write(" · ".join(f"{k}: **{v}**" for k, v in counts.items()))
+                    st.dataframe(plan[['athleteName', 'unitName', 'content', 'oldRank', 'newRank', 'status']],
+                                 use_container_width=True, hide_index=True)
+                    if counts.get('Cập nhật', 0) and st.button(f"Ghi {counts.get('Cập nhật', 0)} kết quả"):
+                        written = apply_result_import(plan)
+                        st.success(f"Đã ghi {written} kết quả.")
+                        st.rerun()
+
+        if not get_tournament_stats().summary()['athletes']:
             st.info("Chưa có dữ liệu.")
         else:
-            col_search, col_rank = st.columns(2)
-            search_txt = col_search.text_input("Tìm tên VĐV/Đơn vị:")
-            view_df = df_reg.copy()
-            if search_txt:
-                view_df = view_df[view_df.astype(str).apply(lambda x: x.str.contains(search_txt, case=False)).any(axis=1)]
+            col_search, col_page = st.columns([3, 1])
+            search_txt = col_search.text_input("Tìm tên VĐV/Đơn vị/Nội dung (không cần dấu):")
+            page_size = 20
+            search_index = get_athlete_search_index()
+            results, total = search_index.search(search_txt, page=1, page_size=page_size)
+            page_count = max(1, -(-total // page_size))
+            page = col_page.number_input(f"Trang (/{page_count})", min_value=1, max_value=page_count, value=1, step=1)
+            if page > 1:
+                results, total = search_index.search(search_txt, page=int(page), page_size=page_size)
+            st.caption(f"Tìm thấy {total} VĐV")
             
             st.write("---")
-            athlete_opts = []
-            for idx, row in view_df.iterrows():
-                cont = row.get('registered_contents', 'N/A')
-                name = row.get('athleteName', 'Unknown')
-                unit = row.get('unitName', 'Unknown')
-                athlete_opts.append(f"{name} ({unit}) - {cont}")
-
-            selected_str = st.selectbox("Chọn VĐV:", athlete_opts)
-            if selected_str:
-                selected_idx = athlete_opts.index(selected_str)
-                selected_id = view_df.iloc[selected_idx]['id']
-                new_rank = st.selectbox("Thành tích:", ["", "Nhất", "Nhì", "Ba", "Khuyến Khích", "Hoàn thành"])
-                if st.button("Lưu Kết quả"):
-                    if update_cell('registrations', selected_id, 'rank', new_rank):
-                        st.success("Đã cập nhật!")
-                        st.cache_data.clear()
-                        st.rerun()
+            selected_idx = st.selectbox("Chọn VĐV:", range(len(results)), format_func=lambda i: results[i][1])
+            if selected_idx is not None:
+                selected_id = results[selected_idx][0]
+                my_entries = get_entries(selected_id)
+                if my_entries.empty:
+                    st.warning("VĐV chưa có nội dung trong bảng entries (hãy chạy chuyển đổi dữ liệu ở trang Cấu hình).")
+                else:
+                    _, label_of = get_content_catalog()
+                    with st.form(f"result_form_{selected_id}"):
+                        new_ranks, versions = {}, {}
+                        for _, entry in my_entries.iterrows():
+                            cur_rank = str(entry['rank'] or '')
+                            opts = RANK_OPTIONS if cur_rank in RANK_OPTIONS else RANK_OPTIONS + [cur_rank]
+                            versions[entry['id']] = shown_version('entries', entry['id'], entry['version'])
+                            new_ranks[entry['id']] = (cur_rank, st.selectbox(
+                                label_of.get((entry['discipline_id'], entry['content_id']), entry['content_id']),
+                                opts, index=opts.index(cur_rank), key=f"rank_{entry['id']}"))
+                        if st.form_submit_button("Lưu Kết quả"):
+                            changed = {eid: {'rank': r} for eid, (old_r, r) in new_ranks.items() if r != old_r}
+                            # Chỉ ghi nếu không ai sửa các entries này kể từ lúc mở form
+                            if not changed or update_rows_data('entries', changed, {eid: versions[eid] for eid in changed}) == []:
+                                st.success("Đã cập nhật!")
+                                st.rerun()
 
-    # 6. ĐĂNG KÝ THI ĐẤU (UNIT)
+    # 7. ĐĂNG KÝ THI ĐẤU (UNIT)
     elif menu == "📝 Đăng ký thi đấu":
         unit = st.session_state.user_info
         st.header(f"📝 Đăng ký: {unit['name']}")
@@ -465,13 +3925,55 @@ def main():
         # Load dữ liệu cần thiết
         df_sys = get_data('systems')
         sys_opts = df_sys['name'].tolist() if not df_sys.empty else ["Mặc định"]
-        df_disc = get_data('disciplines')
-        df_cont = get_data('contents')
+        catalog = get_catalog()
+
+        if not is_editing:
+            with st.expander("📥 Đăng ký hàng loạt từ file (CSV/XLSX)"):
+                tpl = pd.DataFrame(columns=REGISTRATION_IMPORT_COLUMNS)
+                st.download_button("📄 Tải file mẫu", data=tpl.to_csv(index=False).encode('utf-8-sig'),
+                                   file_name="mau_dang_ky.csv", mime="text/csv")
+                st.caption("Ngày sinh: YYYY-MM-DD hoặc DD/MM/YYYY. Cột contents: các nội dung cách nhau bởi dấu ';', ví dụ "
+                           "\"Bóng đá: Nam 11 người; Điền kinh (Chung)\".")
+                uploaded = st.file_uploader("Chọn file danh sách VĐV", type=['csv', 'xlsx'], key="reg_upload")
+                if uploaded is not None:
+                    try:
+                        plan, picks = plan_registration_import(read_uploaded_table(uploaded), unit)
+                    except Exception as e:
+                        st.error(f"Không đọc được file: {e}")
+                        plan = None
+                    if plan is not None:
+                        n_ok = int((plan['errors'] == '').sum())
+                        st.write(f"Hợp lệ: **{n_ok}** · Lỗi: **{len(plan) - n_ok}**")
+                        st.dataframe(plan, use_container_width=True, hide_index=True)
+                        if n_ok and st.button(f"Ghi {n_ok} VĐV hợp lệ"):
+                            written = apply_registration_import(plan, picks, unit)
+                            st.success(f"Đã đăng ký {written} VĐV.")
+                            st.rerun()
 
         # Hiển thị form
         if is_editing:
             st.markdown(f'<div class="edit-form">Đang chỉnh sửa VĐV: <b>{edit_data.get("athleteName")}</b></div>', unsafe_allow_html=True)
 
+        # Lấy danh sách nội dung cũ của VĐV (để tick sẵn)
+        current_contents = []
+        if is_editing:
+            for _, entry in get_entries(edit_data['id']).iterrows():
+                key = (entry['discipline_id'], entry['content_id'])
+                if key in catalog.by_key:
+                    current_contents.append(catalog.by_key[key])
+            if not current_contents and edit_data.get('registered_contents'):
+                current_contents = edit_data.get('registered_contents').split(ENTRY_SEPARATOR)
+
+        # Chỉ dựng ô chọn nội dung cho các môn người dùng mở (gõ để tìm môn)
+        disc_names = {d['id']: d['name'] for d in catalog.disciplines}
+        current_disc_ids = []
+        for label in current_contents:
+            if label in catalog.by_label and catalog.by_label[label][0] not in current_disc_ids:
+                current_disc_ids.append(catalog.by_label[label][0])
+        open_disc_ids = st.multiselect("🔎 Chọn môn muốn đăng ký:", list(disc_names), default=current_disc_ids,
+                                       format_func=lambda d: disc_names.get(d, d),
+                                       key=f"open_discs_{edit_data['id'] if is_editing else 'new'}")
+
         with st.form("reg_form_v2"):
             st.subheader(form_title)
             
@@ -480,7 +3982,7 @@ def main():
             def_gender_idx = 0 if is_editing and edit_data.get('gender') == 'Nam' else 1 if is_editing and edit_data.get('gender') == 'Nữ' else 0
             
             try:
-                def_dob = datetime.strptime(edit_data.get('dob', '2008-01-01'), '%Y-%m-%d').date() if is_editing else date(2008, 1, 1)
+                def_dob = pd.Timestamp(edit_data['dob']).date() if is_editing and pd.notna(edit_data.get('dob')) else date(2008, 1, 1)
             except: def_dob = date(2008, 1, 1)
             
             def_cccd = edit_data.get('cccd', '') if is_editing else ''
@@ -507,45 +4009,31 @@ def main():
             st.subheader("Nội dung Thi đấu")
             
             selected_contents_text = []
-            
-            # Lấy danh sách nội dung cũ của VĐV (để tick sẵn)
-            current_contents = []
-            if is_editing and edit_data.get('registered_contents'):
-                current_contents = edit_data.get('registered_contents').split('; ')
 
-            if not df_disc.empty:
-                for _, disc in df_disc.iterrows():
-                    with st.expander(f"🏅 Môn {disc['name']}", expanded=is_editing):
-                        if not df_cont.empty:
-                            df_cont['discipline_id'] = df_cont['discipline_id'].astype(str)
-                            sub_contents = df_cont[df_cont['discipline_id'] == str(disc['id'])]
-                            
-                            if not sub_contents.empty:
-                                available_opts = sub_contents['name'].tolist()
-                                # Tính toán default options cho multiselect
-                                defaults = []
-                                if is_editing:
-                                    for opt in available_opts:
-                                        if f"{disc['name']}: {opt}" in current_contents:
-                                            defaults.append(opt)
-                                
-                                conts = st.multiselect(
-                                    f"Chọn nội dung {disc['name']}:", 
-                                    available_opts,
-                                    default=defaults,
-                                    key=f"m_sel_{disc['id']}"
-                                )
-                                if conts:
-                                    for c in conts: selected_contents_text.append(f"{disc['name']}: {c}")
-                            else:
-                                st.caption("Chưa có nội dung cụ thể.")
-                                # Checkbox fallback
-                                is_checked = False
-                                if is_editing and f"{disc['name']} (Chung)" in current_contents:
-                                    is_checked = True
-                                    
-                                if st.checkbox(f"Đăng ký {disc['name']} (Chung)", key=f"chk_{disc['id']}", value=is_checked):
-                                    selected_contents_text.append(f"{disc['name']} (Chung)")
+            if not open_disc_ids:
+                st.caption("Chọn môn ở ô phía trên để hiện nội dung thi đấu.")
+            for disc_id in open_disc_ids:
+                disc_name = disc_names[disc_id]
+                with st.expander(f"🏅 Môn {disc_name}", expanded=True):
+                    sub_contents = catalog.contents_by_discipline.get(disc_id, [])
+                    if sub_contents:
+                        available_opts = [c['name'] for c in sub_contents]
+                        # Tính toán default options cho multiselect
+                        defaults = [opt for opt in available_opts if f"{disc_name}: {opt}" in current_contents]
+                        
+                        conts = st.multiselect(
+                            f"Chọn nội dung {disc_name}:", 
+                            available_opts,
+                            default=defaults,
+                            key=f"m_sel_{disc_id}"
+                        )
+                        for c in conts: selected_contents_text.append(f"{disc_name}: {c}")
+                    else:
+                        st.caption("Chưa có nội dung cụ thể.")
+                        # Checkbox fallback
+                        is_checked = f"{disc_name} (Chung)" in current_contents
+                        if st.checkbox(f"Đăng ký {disc_name} (Chung)", key=f"chk_{disc_id}", value=is_checked):
+                            selected_contents_text.append(f"{disc_name} (Chung)")
             
             st.info(f"Đang chọn: {', '.join(selected_contents_text)}")
             
@@ -560,7 +4048,17 @@ def main():
                     st.rerun()
 
             if submitted:
-                if a_name and selected_contents_text:
+                rules = get_registration_rules()
+                if not a_age_group.strip():
+                    a_age_group = rules.derive_age_group(a_dob) or 'Tự do'
+                by_label = catalog.by_label
+                problems = rules.validate({'gender': a_gender, 'dob': a_dob, 'cccd': a_cccd, 'studentId': a_sid, 'ageGroup': a_age_group},
+                                          [by_label[label] for label in selected_contents_text if label in by_label], unit['id'],
+                                          registration_id=edit_data['id'] if is_editing else None)
+                if a_name and selected_contents_text and problems:
+                    for problem in problems:
+                        st.error(problem)
+                elif a_name and selected_contents_text:
                     payload = {
                         'unitId': unit['id'],
                         'unitName': unit['name'],
@@ -571,24 +4069,24 @@ def main():
                         'studentId': a_sid,
                         'systemName': a_system,
                         'ageGroup': a_age_group,
-                        'registered_contents': "; ".join(selected_contents_text)
+                        'registered_contents': ENTRY_SEPARATOR.join(selected_contents_text)
                     }
                     
                     if is_editing:
                         # Cập nhật
-                        if update_row_data('registrations', edit_data['id'], payload):
+                        if update_row_data('registrations', edit_data['id'], payload, expected_version=edit_data.get('version', '')):
+                            sync_registration_entries(edit_data['id'], unit['id'], selected_contents_text)
                             st.success("Đã cập nhật thành công!")
                             st.session_state.editing_athlete = None
-                            st.cache_data.clear()
                             time.sleep(1)
                             st.rerun()
                     else:
                         # Thêm mới
-                        save_data('registrations', payload)
-                        st.success("Đăng ký thành công!")
-                        st.cache_data.clear()
-                        time.sleep(1)
-                        st.rerun()
+                        if save_data('registrations', payload):
+                            sync_registration_entries(payload['id'], unit['id'], selected_contents_text)
+                            st.success("Đăng ký thành công!")
+                            time.sleep(1)
+                            st.rerun()
                 else:
                     st.warning("Thiếu tên hoặc chưa chọn nội dung thi đấu.")
 
@@ -596,7 +4094,6 @@ def main():
         st.subheader("Danh sách đã đăng ký")
         df_reg = get_data('registrations')
         if not df_reg.empty:
-            df_reg['unitId'] = df_reg['unitId'].astype(str)
             my_regs = df_reg[df_reg['unitId'] == str(unit['id'])]
             
             if not my_regs.empty:
@@ -608,10 +4105,11 @@ def main():
                         s_cont = row.get('registered_contents', '')
 
                         c1.markdown(f"**{s_name}** ({s_gender})")
-                        c1.caption(f"ID: {row.get('studentId','')} - {row.get('dob','')}")
+                        c1.caption(f"ID: {row.get('studentId','')} - {format_date(row.get('dob'))}")
                         c2.write(f"🎯 {s_cont}")
                         
                         col_edit, col_del = c3.columns(2)
+                        row_version = shown_version('registrations', row['id'], row.get('version', ''))
                         
                         # Nút SỬA
                         if col_edit.button("✏️", key=f"ed_{row['id']}", help="Sửa thông tin VĐV này"):
@@ -620,27 +4118,111 @@ def main():
                             
                         # Nút XÓA
                         if col_del.button("🗑️", key=f"del_{row['id']}", help="Xóa VĐV này"):
-                            delete_data('registrations', row['id'])
-                            # Nếu đang sửa chính người bị xóa thì reset form
-                            if st.session_state.editing_athlete and st.session_state.editing_athlete['id'] == row['id']:
-                                st.session_state.editing_athlete = None
-                            st.rerun()
+                            # Xung đột/lỗi thì không rerun để cảnh báo còn hiển thị
+                            if delete_registration(row['id'], expected_version=row_version):
+                                # Nếu đang sửa chính người bị xóa thì reset form
+                                if st.session_state.editing_athlete and st.session_state.editing_athlete['id'] == row['id']:
+                                    st.session_state.editing_athlete = None
+                                st.rerun()
 
-    # 7. XUẤT DANH SÁCH (UNIT)
+    # 8. XUẤT DANH SÁCH (UNIT)
     elif menu == "📊 Xuất danh sách":
         unit = st.session_state.user_info
         st.title("📊 Xuất dữ liệu")
         df_reg = get_data('registrations')
         if not df_reg.empty:
-            df_reg['unitId'] = df_reg['unitId'].astype(str)
             my_regs = df_reg[df_reg['unitId'] == str(unit['id'])]
             if not my_regs.empty:
-                cols_order = ['athleteName', 'gender', 'dob', 'studentId', 'cccd', 'systemName', 'ageGroup', 'registered_contents', 'rank']
-                final_cols = [c for c in cols_order if c in my_regs.columns]
-                st.dataframe(my_regs[final_cols], use_container_width=True)
-                csv = my_regs[final_cols].to_csv(index=False).encode('utf-8-sig')
-                st.download_button(label="📥 Tải CSV", data=csv, file_name=f"ds_{unit['name']}.csv", mime="text/csv")
+                preview = export_groups('registrations', unit['id'])[0][1]
+                st.dataframe(preview.drop(columns=['unitName']), use_container_width=True)
+                export_panel("unit_export", list(EXPORT_KINDS), unit_id=unit['id'], file_prefix=f"ds_{unit['name']}")
             else: st.info("Chưa có dữ liệu.")
 
+    # 9. XUẤT DỮ LIỆU TOÀN GIẢI (ADMIN)
+    elif menu == "📦 Xuất dữ liệu":
+        st.header("📦 Xuất dữ liệu toàn giải")
+        st.caption("File được tạo trong bộ nhớ từ dữ liệu đã tải (không đọc lại Google Sheets).")
+        export_panel("admin_export", list(EXPORT_KINDS), file_prefix="giai_dau")
+
+    # 10. NHẬT KÝ THAY ĐỔI (ADMIN)
+    elif menu == "🧾 Nhật ký thay đổi":
+        st.header("🧾 Nhật ký thay đổi")
+        feed = get_change_feed()
+        page_size = 200
+        c1, c2, c3 = st.columns(3)
+        sheet_filter = c1.selectbox("Sheet", ["Tất cả"] + [name for name in EXPECTED_HEADERS if name != 'changes'])
+        id_filter = c2.text_input("ID dòng").strip()
+        page = int(c3.number_input("Trang (mới nhất trước)", min_value=1, value=1, step=1))
+        shown, total = feed.latest(page, page_size, None if sheet_filter == "Tất cả" else sheet_filter, id_filter)
+        pending = len(feed.pending())
+        st.caption(f"{total} mục · trang {page}/{max(1, -(-total // page_size))}" + (f" · {pending} mục đang chờ ghi" if pending else ""))
+        if not shown:
+            st.info("Chưa có thay đổi nào.")
+        else:
+            op_names = {'insert': "Thêm", 'update': "Sửa", 'delete': "Xóa"}
+
+            def describe(e):
+                if e['op'] == 'update' and e['before'] is not None and e['after'] is not None:
+                    return ", ".join(f"{k}: {e['before'].get(k, '')} → {v}" for k, v in e['after'].items() if e['before'].get(k, '') != v)
+                return ", ".join(f"{k}: {v}" for k, v in list((e['after'] or e['before'] or {}).items())[:4])
+
+            st.dataframe(pd.DataFrame({'Lúc': [e['at'] for e in shown], 'Người thực hiện': [e['actor'] for e in shown],
+                                       'Sheet': [e['sheet'] for e in shown], 'ID': [e['docId'] for e in shown],
+                                       'Thao tác': [op_names.get(e['op'], e['op']) for e in shown],
+                                       'Nội dung': [describe(e) for e in shown]}),
+                         use_container_width=True, hide_index=True)
+            by_label = {f"{e['at']} · {op_names.get(e['op'], e['op'])} {e['sheet']}/{e['docId']} · {e['actor']}": e for e in shown}
+            picked = by_label[st.selectbox("Xem chi tiết", list(by_label))]
+            c1, c2 = st.columns(2)
+            c1.markdown("**Trước**")
+            c1.json(picked['before'] or {})
+            c2.markdown("**Sau**")
+            c2.json(picked['after'] or {})
+            if st.button("↩️ Hoàn tác thay đổi này", disabled=picked['op'] != 'insert' and not picked['before']):
+                if undo_change(picked):
+                    st.success("Đã hoàn tác.")
+                    st.rerun()
+                else:
+                    st.error("Không hoàn tác được (dòng không còn tồn tại hoặc thiếu dữ liệu cũ).")
+
+    # 11. HIỆU NĂNG (ADMIN)
+    elif menu == "🩺 Hiệu năng":
+        st.header("🩺 Hiệu năng hệ thống")
+        recorder = get_perf_recorder()
+        last_run = st.session_state.get('last_run_perf') or []
+        st.subheader("Lượt tải trang trước")
+        if last_run:
+            df_run = pd.DataFrame(last_run)
+            page_row = df_run[df_run['kind'] == 'page']
+            if not page_row.empty:
+                st.caption(f"Trang {page_row.iloc[-1]['name']}: {page_row.iloc[-1]['ms']} ms · "
+                           f"{df_run[df_run['depth'] == 0]['api_calls'].sum()} lệnh gọi API")
+            st.dataframe(df_run, use_container_width=True, hide_index=True)
+        else:
+            st.info("Chưa có số liệu.")
+        last_sheets = st.session_state.get('last_run_sheets')
+        if last_sheets is not None and not last_sheets.empty:
+            st.caption(f"Sheet đã dùng: {len(last_sheets)} · đọc từ nơi lưu trữ: {(last_sheets['source'] == 'tải').sum()} · "
+                       f"lần đọc dùng lại bản đã ghim: {int(last_sheets['reads'].sum()) - len(last_sheets)}")
+            st.dataframe(last_sheets, use_container_width=True, hide_index=True)
+
+        st.subheader(f"Tổng hợp từ {datetime.fromtimestamp(recorder.started_at).strftime('%Y-%m-%d %H:%M:%S')}")
+        st.dataframe(recorder.table(), use_container_width=True, hide_index=True)
+        memory = get_sheet_cache().memory_usage()
+        if memory:
+            st.caption("Bộ nhớ dữ liệu đang cache: " + " · ".join(f"{name} {size / 1024:.0f} KB" for name, size in sorted(memory.items())))
+        c1, c2 = st.columns(2)
+        c1.download_button("📥 Tải số liệu (Prometheus)", data=prometheus_metrics(), file_name="metrics.prom", mime="text/plain")
+        if c2.button("Đặt lại số liệu"):
+            recorder.reset()
+            st.rerun()
+        metrics_port = get_int_setting('metrics_port', 0)
+        if metrics_port:
+            st.caption(f"Endpoint Prometheus: http://{get_setting('metrics_host', '127.0.0.1')}:{metrics_port}/metrics")
+        else:
+            st.caption("Đặt Secrets/biến môi trường \"metrics_port\" để mở endpoint /metrics cho Prometheus.")
+
 if __name__ == "__main__":
-    main()
+    # Mỗi lượt chạy lại của Streamlit đọc mỗi sheet tối đa một lần
+    with get_sheet_cache().pinned():
+        main()
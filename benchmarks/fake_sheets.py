@@ -0,0 +1,225 @@
+"""Client gspread giả lập chạy trong bộ nhớ, dùng cho benchmark không cần tài khoản Google.
+
+Chỉ cài đặt các phương thức app.py thực sự gọi; mỗi lệnh gọi được đếm, có thể thêm độ trễ
+và giới hạn số lệnh/phút (vượt hạn mức thì ném APIError 429 như Google Sheets thật).
+"""
+import re
+import threading
+import time
+from collections import deque
+
+import gspread
+
+
+class FakeResponse:
+    """Đủ thuộc tính để khởi tạo gspread.exceptions.APIError"""
+
+    def __init__(self, code, message):
+        self.status_code = code
+        self.headers = {}
+        self._payload = {'error': {'code': code, 'message': message, 'status': 'RESOURCE_EXHAUSTED' if code == 429 else 'ERROR'}}
+        self.text = str(self._payload)
+
+    def json(self):
+        return self._payload
+
+
+def col_to_number(letters):
+    n = 0
+    for ch in letters.upper():
+        n = n * 26 + ord(ch) - ord('A') + 1
+    return n
+
+
+def parse_cell(a1):
+    """'B7' → (7, 2); 'B' → (None, 2); '7' → (7, None)"""
+    m = re.fullmatch(r'([A-Za-z]*)(\d*)', a1.split('!')[-1].replace('$', ''))
+    if m is None:
+        raise ValueError(f"Ô không hợp lệ: {a1}")
+    letters, digits = m.groups()
+    return (int(digits) if digits else None), (col_to_number(letters) if letters else None)
+
+
+def trim(values):
+    """Google Sheets bỏ các ô trống ở cuối dòng và các dòng trống ở cuối vùng"""
+    rows = []
+    for row in values:
+        row = list(row)
+        while row and row[-1] == '':
+            row.pop()
+        rows.append(row)
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+class FakeClient:
+    """Thay cho gspread.Client: latency (giây) mỗi lệnh gọi, quota_per_minute=None là không giới hạn"""
+
+    def __init__(self, spreadsheets=None, latency=0.0, quota_per_minute=None):
+        self.latency = latency
+        self.quota_per_minute = quota_per_minute
+        self.calls = 0
+        self.calls_by_method = {}
+        self.rejected = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+        self._spreadsheets = {}
+        for name, sheets in (spreadsheets or {}).items():
+            sh = FakeSpreadsheet(self, name)
+            for title, values in sheets.items():
+                sh.add_worksheet(title, rows=len(values), cols=len(values[0]) if values else 0, _values=values)
+            self._spreadsheets[name] = sh
+        self.reset_counters()
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls = 0
+            self.calls_by_method = {}
+            self.rejected = 0
+
+    def api_call(self, method):
+        with self._lock:
+            now = time.monotonic()
+            if self.quota_per_minute is not None:
+                while self._recent and now - self._recent[0] > 60:
+                    self._recent.popleft()
+                if len(self._recent) >= self.quota_per_minute:
+                    self.rejected += 1
+                    raise gspread.exceptions.APIError(FakeResponse(429, "Quota exceeded for quota metric 'Read requests'"))
+                self._recent.append(now)
+            self.calls += 1
+            self.calls_by_method[method] = self.calls_by_method.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def open(self, title):
+        self.api_call('open')
+        sh = self._spreadsheets.get(title)
+        if sh is None:
+            raise gspread.exceptions.SpreadsheetNotFound(title)
+        return sh
+
+
+class FakeSpreadsheet(gspread.Spreadsheet):
+    # Không gọi __init__ của gspread (cần HTTP client); kế thừa để app nhận diện và bọc qua SheetsGovernor
+    def __init__(self, fake_client, title):
+        self._fake = fake_client
+        self._properties = {'title': title, 'id': title}
+        self._worksheets = {}
+
+    @property
+    def id(self):
+        return self._properties['id']
+
+    def worksheet(self, title):
+        self._fake.api_call('worksheet')
+        ws = self._worksheets.get(title)
+        if ws is None:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return ws
+
+    def worksheets(self, *args, **kwargs):
+        self._fake.api_call('worksheets')
+        return list(self._worksheets.values())
+
+    def add_worksheet(self, title, rows=100, cols=20, index=None, _values=None):
+        if _values is None:
+            self._fake.api_call('add_worksheet')
+        ws = FakeWorksheet(self._fake, self, title, _values or [])
+        self._worksheets[title] = ws
+        return ws
+
+
+class FakeWorksheet(gspread.Worksheet):
+    def __init__(self, fake_client, spreadsheet, title, values):
+        self._fake = fake_client
+        self._sh = spreadsheet
+        self._properties = {'title': title, 'sheetId': len(spreadsheet._worksheets), 'index': len(spreadsheet._worksheets)}
+        self._values = [[str(v) for v in row] for row in values]
+        self._lock = threading.RLock()
+
+    @property
+    def title(self):
+        return self._properties['title']
+
+    @property
+    def id(self):
+        return self._properties['sheetId']
+
+    def _width(self):
+        return max((len(r) for r in self._values), default=0)
+
+    def _set(self, row, col, value):
+        while len(self._values) < row:
+            self._values.append([])
+        line = self._values[row - 1]
+        while len(line) < col:
+            line.append('')
+        line[col - 1] = str(value)
+
+    def _read(self, a1):
+        start, _, end = a1.partition(':')
+        r1, c1 = parse_cell(start)
+        r2, c2 = parse_cell(end) if end else (r1, c1)
+        r1, c1 = r1 or 1, c1 or 1
+        r2 = min(r2 or len(self._values), len(self._values))
+        c2 = c2 or self._width()
+        return trim([(self._values[r - 1] + [''] * c2)[c1 - 1:c2] for r in range(r1, r2 + 1)])
+
+    # --- Các lệnh gọi API app.py dùng ---
+    def row_values(self, row, **kwargs):
+        self._fake.api_call('row_values')
+        with self._lock:
+            rows = trim([self._values[row - 1]]) if row <= len(self._values) else []
+        return rows[0] if rows else []
+
+    def col_values(self, col, **kwargs):
+        self._fake.api_call('col_values')
+        with self._lock:
+            values = [r[col - 1] if col <= len(r) else '' for r in self._values]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def get_all_values(self, **kwargs):
+        self._fake.api_call('get_all_values')
+        with self._lock:
+            width = self._width()
+            return [list(r) + [''] * (width - len(r)) for r in trim(self._values)]
+
+    def batch_get(self, ranges, **kwargs):
+        self._fake.api_call('batch_get')
+        with self._lock:
+            return [self._read(a1) for a1 in ranges]
+
+    def update_cell(self, row, col, value):
+        self._fake.api_call('update_cell')
+        with self._lock:
+            self._set(row, col, value)
+
+    def batch_update(self, data, **kwargs):
+        self._fake.api_call('batch_update')
+        with self._lock:
+            for item in data:
+                row, col = parse_cell(item['range'].split(':')[0])
+                for i, line in enumerate(item['values']):
+                    for j, value in enumerate(line):
+                        self._set(row + i, col + j, value)
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], _method='append_row')
+
+    def append_rows(self, values, _method='append_rows', **kwargs):
+        self._fake.api_call(_method)
+        with self._lock:
+            self._values = trim(self._values)
+            start = len(self._values) + 1
+            self._values.extend([str(v) for v in row] for row in values)
+            last = gspread.utils.rowcol_to_a1(start + len(values) - 1, max(len(values[0]), 1) if values else 1)
+            return {'updates': {'updatedRange': f"'{self.title}'!A{start}:{last}"}}
+
+    def delete_rows(self, start_index, end_index=None):
+        self._fake.api_call('delete_rows')
+        with self._lock:
+            del self._values[start_index - 1:(end_index or start_index)]
@@ -0,0 +1,226 @@
+"""Benchmark lớp dữ liệu của app.py trên Google Sheets giả lập (không cần mạng hay tài khoản Google).
+
+Sinh giải đấu giả (đơn vị, môn, nội dung, VĐV, lượt đăng ký), thay get_gsheet_client() bằng
+FakeClient rồi đo các luồng chính: tổng quan, đăng nhập đơn vị, đăng ký VĐV, cập nhật kết quả, xuất file.
+Mỗi luồng chạy hai lần: "lạnh" (vừa làm mới dữ liệu) và "nóng" (cache đã có), ghi thời gian và số lệnh gọi API.
+
+Cách dùng:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --registrations 1000 10000 50000 --latency 0.05
+    python benchmarks/run_benchmarks.py --quota 60 --json bench.jsonl   # nối kết quả để so sánh giữa các commit
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DISCIPLINES = ["Bóng đá", "Điền kinh", "Bơi lội", "Cầu lông", "Bóng bàn", "Cờ vua", "Võ thuật", "Bóng chuyền"]
+SYSTEMS = ["Tiểu học", "THCS", "THPT"]
+GENDERS = ["Nam", "Nữ", "Nam & Nữ"]
+FIRST_NAMES = ["An", "Bình", "Chi", "Dũng", "Giang", "Hà", "Hùng", "Lan", "Minh", "Ngọc", "Phúc", "Quân", "Thảo", "Trang", "Việt"]
+LAST_NAMES = ["Nguyễn", "Trần", "Lê", "Phạm", "Hoàng", "Vũ", "Đặng", "Bùi"]
+
+
+def generate_tournament(n_registrations, seed=0, contents_per_discipline=4, entries_per_athlete=(1, 3)):
+    """Dữ liệu các sheet dạng {tên sheet: [header, dòng...]} theo EXPECTED_HEADERS của app"""
+    import app
+
+    rng = random.Random(seed)
+    now = datetime(2026, 1, 1).strftime("%Y-%m-%d %H:%M:%S")
+    sheets = {name: [list(headers)] for name, headers in app.EXPECTED_HEADERS.items()}
+
+    def add(sheet_name, row):
+        row.setdefault('createdAt', now)
+        row.setdefault('updatedAt', now)
+        row.setdefault('version', 1)
+        sheets[sheet_name].append([str(row.get(h, '')) for h in sheets[sheet_name][0]])
+
+    sheets['config'] += [['tournament_name', 'Giải benchmark'], ['deadline', '2026-12-31']]
+    for i, name in enumerate(SYSTEMS):
+        add('systems', {'id': f"S{i:04d}", 'name': name})
+
+    contents = []
+    for d, disc_name in enumerate(DISCIPLINES):
+        disc_id = f"D{d:04d}"
+        add('disciplines', {'id': disc_id, 'code': f"M{d}", 'name': disc_name, 'is_exempt': 'False'})
+        contents.append((disc_id, '', f"{disc_name} (Chung)"))
+        for c in range(contents_per_discipline):
+            cont_id = f"C{d:02d}{c:02d}"
+            cont_name = f"Nội dung {c + 1}"
+            add('contents', {'id': cont_id, 'discipline_id': disc_id, 'name': cont_name, 'gender': GENDERS[c % 3]})
+            contents.append((disc_id, cont_id, f"{disc_name}: {cont_name}"))
+
+    units = []
+    for u in range(max(10, n_registrations // 50)):
+        unit = {'id': f"U{u:05d}", 'name': f"Lớp {u + 1:03d}", 'manager': f"GV {u + 1}", 'registrationCode': f"R{u:05d}"}
+        add('units', unit)
+        units.append(unit)
+
+    born = datetime(2008, 1, 1)
+    entry_no = 0
+    for r in range(n_registrations):
+        unit = rng.choice(units)
+        reg_id = f"A{r:06d}"
+        picked = rng.sample(contents, rng.randint(*entries_per_athlete))
+        add('registrations', {'id': reg_id, 'unitId': unit['id'], 'unitName': unit['name'],
+                              'athleteName': f"{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)} {r}",
+                              'gender': rng.choice(['Nam', 'Nữ']),
+                              'dob': (born + timedelta(days=rng.randint(0, 3650))).strftime("%Y-%m-%d"),
+                              'cccd': f"{r:012d}", 'studentId': f"HS{r:06d}", 'systemName': rng.choice(SYSTEMS),
+                              'ageGroup': '', 'registered_contents': app.ENTRY_SEPARATOR.join(label for _, _, label in picked)})
+        for disc_id, cont_id, _ in picked:
+            rank = rng.choice(app.RANK_OPTIONS) if rng.random() < 0.3 else ''
+            add('entries', {'id': f"E{entry_no:07d}", 'registrationId': reg_id, 'unitId': unit['id'],
+                            'discipline_id': disc_id, 'content_id': cont_id, 'rank': rank})
+            entry_no += 1
+    return sheets
+
+
+# --- Các luồng cần đo ---
+def flow_overview(app, ctx):
+    app.get_config('deadline')
+    app.get_config('tournament_name')
+    stats = app.get_tournament_stats()
+    stats.summary()
+    stats.medal_table()
+    stats.winners()
+    stats.entry_counts()
+
+
+def flow_unit_login(app, ctx):
+    unit, status = app.get_unit_login_index().login(ctx['rng'].choice(ctx['codes']))
+    assert status == 'ok', status
+
+
+def flow_registration_submit(app, ctx):
+    unit = app.get_unit_login_index().login(ctx['rng'].choice(ctx['codes']))[0]
+    labels = ctx['rng'].sample(list(app.get_content_catalog()[0]), 2)
+    payload = {'unitId': unit['id'], 'unitName': unit['name'], 'athleteName': f"VĐV mới {ctx['rng'].random():.6f}",
+               'gender': 'Nam', 'dob': '2010-05-05', 'cccd': '', 'studentId': '', 'systemName': SYSTEMS[0],
+               'ageGroup': '', 'registered_contents': app.ENTRY_SEPARATOR.join(labels)}
+    assert app.save_data('registrations', payload)
+    app.sync_registration_entries(payload['id'], unit['id'], labels)
+
+
+def flow_results_update(app, ctx):
+    entries = app.get_entries()
+    ids = ctx['rng'].sample(list(entries['id']), min(50, len(entries)))
+    missing = app.update_rows_data('entries', {eid: {'rank': ctx['rng'].choice(app.MEDAL_RANKS)} for eid in ids})
+    assert missing == [], missing
+
+
+def flow_athlete_search(app, ctx):
+    app.get_athlete_search_index().search(ctx['rng'].choice(FIRST_NAMES), page=1, page_size=20)
+
+
+def flow_export_csv(app, ctx):
+    app.build_export('registrations', 'csv')
+
+
+def flow_export_start_lists_xlsx(app, ctx):
+    app.build_export('start_lists', 'xlsx')
+
+
+FLOWS = [
+    ('overview', flow_overview),
+    ('unit_login', flow_unit_login),
+    ('registration_submit', flow_registration_submit),
+    ('results_update', flow_results_update),
+    ('athlete_search', flow_athlete_search),
+    ('export_csv', flow_export_csv),
+    ('export_start_lists_xlsx', flow_export_start_lists_xlsx),
+]
+
+
+def run_flow(app, fake, fn, ctx):
+    fake.reset_counters()
+    started = time.perf_counter()
+    # Mỗi luồng tương ứng một lượt chạy lại của Streamlit: đọc dữ liệu qua bản ghim như trong app
+    with app.get_sheet_cache().pinned():
+        fn(app, ctx)
+    return (time.perf_counter() - started) * 1000, fake.calls
+
+
+def bench_size(app, n_registrations, args):
+    import streamlit as st
+    from fake_sheets import FakeClient
+
+    sheets = generate_tournament(n_registrations, seed=args.seed)
+    fake = FakeClient({app.SPREADSHEET_NAME: sheets}, latency=args.latency, quota_per_minute=args.quota)
+    # Tạo lại mọi tài nguyên dùng chung (registry, backend, cache, chỉ mục) trên client giả
+    st.cache_resource.clear()
+    app.client = fake
+    ctx = {'rng': random.Random(args.seed), 'codes': [row[3] for row in sheets['units'][1:]]}
+    results = []
+    for name, fn in FLOWS:
+        if args.flows and name not in args.flows:
+            continue
+        app.refresh_data_handles()
+        cold_ms, cold_calls = run_flow(app, fake, fn, ctx)
+        warm_ms, warm_calls = run_flow(app, fake, fn, ctx)
+        results.append({'flow': name, 'registrations': n_registrations, 'cold_ms': round(cold_ms, 1), 'cold_api_calls': cold_calls,
+                        'warm_ms': round(warm_ms, 1), 'warm_api_calls': warm_calls})
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def print_table(rows):
+    cols = ['flow', 'registrations', 'cold_ms', 'cold_api_calls', 'warm_ms', 'warm_api_calls']
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in cols}
+    print('  '.join(c.ljust(widths[c]) for c in cols))
+    for r in rows:
+        print('  '.join(str(r[c]).ljust(widths[c]) for c in cols))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--registrations', type=int, nargs='+', default=[1000, 10000], help="số VĐV của mỗi giải giả lập")
+    parser.add_argument('--latency', type=float, default=0.0, help="độ trễ giả lập mỗi lệnh gọi API (giây)")
+    parser.add_argument('--quota', type=int, default=None, help="hạn mức lệnh gọi/phút của Sheets giả lập (mặc định không giới hạn)")
+    parser.add_argument('--flows', nargs='*', choices=[name for name, _ in FLOWS], help="chỉ chạy các luồng này")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="nối kết quả (JSON lines) vào file này")
+    args = parser.parse_args()
+
+    # Cấu hình app qua biến môi trường trước khi import: Sheets đồng bộ, không luồng nền, governor theo quota giả lập
+    os.environ['STORAGE_BACKEND'] = 'sheets'
+    os.environ['WRITE_BEHIND'] = 'false'
+    os.environ['BACKGROUND_REFRESH'] = 'false'
+    os.environ['SHEETS_QUOTA_PER_MINUTE'] = str(args.quota or 1000000)
+    os.environ['SHEETS_BURST'] = str(min(args.quota or 1000000, 10 if args.quota else 1000000))
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    try:
+        from streamlit import logger as st_logger
+        st_logger.set_log_level('error')
+    except (ImportError, AttributeError):
+        pass
+    import app
+
+    rows = []
+    for n in args.registrations:
+        rows.extend(bench_size(app, n, args))
+    print_table(rows)
+    if args.json:
+        record = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+                  'latency': args.latency, 'quota': args.quota, 'seed': args.seed, 'results': rows}
+        with open(args.json, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+if __name__ == '__main__':
+    main()
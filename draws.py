@@ -0,0 +1,163 @@
+"""Bốc thăm cho từng nội dung thi: sơ đồ loại trực tiếp hoặc chia lượt (heat).
+
+Chỉ gồm hàm thuần trên kiểu dữ liệu cơ bản (không dùng Streamlit/gspread) để app.py chạy được
+trong process pool. Cùng seed và cùng danh sách VĐV luôn cho cùng kết quả bốc thăm.
+"""
+import math
+import random
+
+KNOCKOUT = 'knockout'
+HEATS = 'heats'
+FORMATS = {KNOCKOUT: "Loại trực tiếp", HEATS: "Chia lượt"}
+DEFAULT_HEAT_SIZE = 8
+
+
+def content_rng(seed, discipline_id, content_id):
+    """Mỗi nội dung một bộ sinh số riêng, không phụ thuộc thứ tự xử lý giữa các process"""
+    return random.Random(f"{seed}|{discipline_id}|{content_id}")
+
+
+def by_unit(entries, rng):
+    """[(entry_id, unit_id)] → các nhóm VĐV cùng đơn vị, nhóm đông nhất trước (hòa thì theo thăm)"""
+    groups = {}
+    for entry_id, unit_id in sorted(entries):
+        groups.setdefault(unit_id, []).append(entry_id)
+    groups = list(groups.values())
+    for members in groups:
+        rng.shuffle(members)
+    rng.shuffle(groups)
+    return sorted(groups, key=len, reverse=True)
+
+
+def seed_order(size):
+    """Hạt giống tại từng vị trí của sơ đồ size (lũy thừa của 2): [1, 8, 4, 5, 2, 7, 3, 6] với size 8"""
+    order = [1]
+    while len(order) < size:
+        n = len(order) * 2
+        order = [s for seed in order for s in (seed, n + 1 - seed)]
+    return order
+
+
+def split_halves(members_by_unit, positions, rng, slots):
+    """Chia đệ quy VĐV vào hai nửa sơ đồ, đồng đội được rải đều hai nửa ở mọi cấp nên gặp nhau muộn nhất có thể"""
+    if len(positions) == 1:
+        slots[positions[0]] = members_by_unit[0][0]
+        return
+    span = 1 << (positions[-1] ^ positions[0]).bit_length()
+    mid = positions[0] // span * span + span // 2
+    halves = ([p for p in positions if p < mid], [p for p in positions if p >= mid])
+    if not halves[0] or not halves[1]:
+        split_halves(members_by_unit, halves[0] or halves[1], rng, slots)
+        return
+    room = [len(halves[0]), len(halves[1])]
+    sides = ([], [])
+    for members in members_by_unit:
+        placed = [[], []]
+        for entry_id in members:
+            # Nửa đang ít đồng đội hơn (hòa thì bốc thăm), trừ khi nửa đó đã đầy
+            side = min((0, 1), key=lambda s: (len(placed[s]), rng.random()))
+            if room[side] == 0:
+                side = 1 - side
+            room[side] -= 1
+            placed[side].append(entry_id)
+        for side in (0, 1):
+            if placed[side]:
+                sides[side].append(placed[side])
+    for side in (0, 1):
+        split_halves(sorted(sides[side], key=len, reverse=True), halves[side], rng, slots)
+
+
+def draw_knockout(entries, rng):
+    """Xếp VĐV vào sơ đồ; VĐV cùng đơn vị được đặt để gặp nhau muộn nhất có thể.
+
+    Vị trí trống (bye) nằm ở các hạt giống cuối, nên không có trận nào hai bên đều trống.
+    """
+    size = 1 << max(1, math.ceil(math.log2(max(len(entries), 2))))
+    order = seed_order(size)
+    slots = [''] * size
+    if entries:
+        split_halves(by_unit(entries, rng), [pos for pos in range(size) if order[pos] <= len(entries)], rng, slots)
+    return {'format': KNOCKOUT, 'slots': slots, 'winners': []}
+
+
+def draw_heats(entries, rng, heat_size=DEFAULT_HEAT_SIZE):
+    """Chia VĐV thành các lượt đều nhau, đồng đội rải sang các lượt khác nhau; thứ tự đường chạy theo thăm"""
+    heat_count = max(1, math.ceil(len(entries) / max(heat_size, 1)))
+    heats = [[] for _ in range(heat_count)]
+    ordered = [entry_id for members in by_unit(entries, rng) for entry_id in members]
+    for i, entry_id in enumerate(ordered):
+        heats[i % heat_count].append(entry_id)
+    for heat in heats:
+        rng.shuffle(heat)
+    return {'format': HEATS, 'heats': heats}
+
+
+def draw_content(task):
+    """Một đơn vị công việc cho process pool.
+
+    task = ((discipline_id, content_id), [(entry_id, unit_id)], format, heat_size, seed) → ((discipline_id, content_id), layout)
+    """
+    key, entries, fmt, heat_size, seed = task
+    rng = content_rng(seed, *key)
+    if fmt == HEATS:
+        return key, draw_heats(entries, rng, heat_size)
+    return key, draw_knockout(entries, rng)
+
+
+# --- Diễn biến sơ đồ loại trực tiếp ---
+def bracket_rounds(layout):
+    """Các vòng đấu [[(a, b, người thắng), ...], ...] suy ra từ slots và winners đã nhập.
+
+    '' là vị trí trống (bye): bên còn lại tự đi tiếp. None là trận trước chưa có kết quả.
+    Người thắng không còn thuộc trận (do sửa kết quả vòng trước) bị bỏ qua.
+    """
+    players = list(layout['slots'])
+    winners = layout.get('winners') or []
+    rounds = []
+    while len(players) > 1:
+        picked = winners[len(rounds)] if len(rounds) < len(winners) else []
+        matches = []
+        for i in range(0, len(players), 2):
+            a, b = players[i], players[i + 1]
+            winner = picked[i // 2] if i // 2 < len(picked) else None
+            if a is None or b is None:
+                winner = None
+            elif not (a and b):
+                winner = a or b
+            elif winner not in (a, b):
+                winner = None
+            matches.append((a, b, winner))
+        rounds.append(matches)
+        players = [winner for _, _, winner in matches]
+    return rounds
+
+
+def set_winner(layout, round_no, match_no, winner):
+    """Layout mới sau khi ghi người thắng trận match_no của vòng round_no (tính từ 0)"""
+    winners = [list(r) for r in layout.get('winners') or []]
+    while len(winners) <= round_no:
+        winners.append([])
+    while len(winners[round_no]) <= match_no:
+        winners[round_no].append(None)
+    winners[round_no][match_no] = winner
+    return dict(layout, winners=winners)
+
+
+def bracket_ranks(layout, medals=('Nhất', 'Nhì', 'Ba')):
+    """Thứ hạng huy chương khi đã có kết quả: thắng chung kết Nhất, thua chung kết Nhì, thua bán kết đồng hạng Ba"""
+    rounds = bracket_rounds(layout)
+    if not rounds:
+        return {}
+    ranks = {}
+    a, b, winner = rounds[-1][0]
+    if winner:
+        ranks[winner] = medals[0]
+        loser = b if winner == a else a
+        if loser:
+            ranks[loser] = medals[1]
+    if len(rounds) > 1:
+        for a, b, winner in rounds[-2]:
+            loser = b if winner == a else a
+            if winner and loser:
+                ranks[loser] = medals[2]
+    return ranks
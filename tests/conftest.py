@@ -0,0 +1,76 @@
+"""Cấu hình chung cho pytest: app chạy trên SQLite tạm, Google Sheets thay bằng FakeClient của benchmarks."""
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# Phải đặt trước khi import app: không luồng nền, không chờ thử lại, dữ liệu cục bộ trong thư mục tạm
+_TMP = tempfile.mkdtemp(prefix='quanlygd-tests-')
+os.environ.update(STORAGE_BACKEND='sqlite', SQLITE_PATH=os.path.join(_TMP, 'app.db'), BACKGROUND_REFRESH='false',
+                  WRITE_BEHIND='false', SHEETS_QUOTA_PER_MINUTE='1000000', SHEETS_BURST='1000000', SHEETS_MAX_RETRIES='0',
+                  FEED_FLUSH_INTERVAL='3600')
+
+
+@pytest.fixture(scope='session')
+def app():
+    import app as app_module
+    return app_module
+
+
+@pytest.fixture
+def fake(app):
+    """Google Sheets giả với một giải nhỏ; mọi tài nguyên dùng chung được tạo lại trên client giả"""
+    import streamlit as st
+    from fake_sheets import FakeClient
+    from run_benchmarks import generate_tournament
+
+    client = FakeClient({app.SPREADSHEET_NAME: generate_tournament(20)})
+    st.cache_resource.clear()
+    app.client = client
+    yield client
+    app.client = None
+    st.cache_resource.clear()
+
+
+@pytest.fixture
+def remote(app, fake):
+    return app.GoogleSheetsBackend(app.get_worksheet_registry(), full_sync_interval=300)
+
+
+@pytest.fixture
+def mirror(app, remote, tmp_path):
+    """OfflineMirror đã đồng bộ lần đầu; luồng đối soát nền sau đó chờ (interval rất dài) nên test tự gọi sync()"""
+    m = app.OfflineMirror(app.SQLiteBackend(str(tmp_path / 'mirror.db')), remote, interval=3600)
+    deadline = time.monotonic() + 10
+    while m.last_sync_at is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert m.online, m.last_error
+    return m
+
+
+@pytest.fixture
+def storage(app, tmp_path, monkeypatch):
+    """SQLite riêng cho một test: get_data / save_rows chỉ thấy dữ liệu do test tự tạo"""
+    backend = app.SQLiteBackend(str(tmp_path / 'isolated.db'))
+    monkeypatch.setattr(app, 'get_storage', lambda: backend)
+
+    def reset():
+        app.get_sheet_cache().invalidate()
+        app.get_content_catalog_store().invalidate()
+        app.get_registration_rules().invalidate()
+
+    reset()
+    yield backend
+    reset()
+
+
+def worksheet_rows(fake, app, sheet_name):
+    """Nội dung sheet trên client giả dạng [{cột: giá trị}]"""
+    values = fake._spreadsheets[app.SPREADSHEET_NAME]._worksheets[sheet_name]._values
+    return [dict(zip(values[0], row + [''] * (len(values[0]) - len(row)))) for row in values[1:] if any(row)]
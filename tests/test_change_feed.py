@@ -0,0 +1,134 @@
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def feed(app):
+    return app.ChangeFeed(interval=3600)
+
+
+def frame(app, entries):
+    return pd.DataFrame(entries, columns=app.EXPECTED_HEADERS['changes'])
+
+
+def entry(app, seq, origin='other', sheet='units', doc_id='U1'):
+    return {'id': f"{seq:020d}", 'at': '', 'origin': origin, 'actor': 'x', 'sheet': sheet, 'docId': doc_id,
+            'op': 'update', 'before': '{"name":"A"}', 'after': '{"name":"B"}'}
+
+
+def test_record_keeps_only_changed_columns(app, feed):
+    feed.record([('units', 'update', 'U1', {'name': 'A', 'manager': 'M', 'version': '1'}, {'name': 'B', 'version': '2'})],
+                actor='admin')
+    (e,), total = feed.latest(frame=frame(app, []))
+    assert (e['before'], e['after'], e['origin'], e['actor'], total) == ({'name': 'A'}, {'name': 'B'}, feed.origin, 'admin', 1)
+
+
+def test_read_pages_by_cursor(app, feed):
+    rows = [entry(app, n) for n in (1, 2, 3, 4, 5)]
+    page, cursor = feed.read(frame=frame(app, rows), limit=2)
+    assert [e['id'] for e in page] == [r['id'] for r in rows[:2]]
+    rest, cursor = feed.read(cursor, frame=frame(app, rows))
+    assert [e['id'] for e in rest] == [r['id'] for r in rows[2:]]
+    assert feed.read(cursor, frame=frame(app, rows)) == ([], cursor)
+
+
+def test_late_flushed_foreign_entry_is_delivered(app, feed):
+    # Mục của tiến trình khác được đẩy lên sau, dù id (giờ ghi) nhỏ hơn mục cuối đã đọc
+    rows = [entry(app, 100, origin=feed.origin)]
+    _, cursor = feed.read(frame=frame(app, rows), foreign_only=True)
+    rows.append(entry(app, 99, sheet='registrations'))
+    entries, _ = feed.read(cursor, frame=frame(app, rows), foreign_only=True)
+    assert [(e['id'], e['sheet']) for e in entries] == [(f"{99:020d}", 'registrations')]
+
+
+def test_cursor_recovers_when_rows_before_it_are_removed(app, feed):
+    rows = [entry(app, n) for n in (1, 2, 3)]
+    _, cursor = feed.read(frame=frame(app, rows))
+    rows = rows[1:] + [entry(app, 4)]
+    entries, _ = feed.read(cursor, frame=frame(app, rows))
+    assert [e['id'] for e in entries] == [f"{4:020d}"]
+
+
+def test_foreign_only_skips_own_entries(app, feed):
+    df = frame(app, [entry(app, 1, origin=feed.origin), entry(app, 2)])
+    entries, _ = feed.read(frame=df, foreign_only=True)
+    assert [e['origin'] for e in entries] == ['other']
+
+
+def test_latest_filters_and_pages_newest_first(app, feed):
+    rows = [entry(app, n, doc_id=f"U{n % 2}") for n in range(1, 8)]
+    page, total = feed.latest(page=2, page_size=2, doc_id='U1', frame=frame(app, rows))
+    assert total == 4
+    assert [e['id'] for e in page] == [f"{n:020d}" for n in (3, 1)]
+
+
+def test_undo_registration_changes_keeps_entries_in_sync(app):
+    app.save_rows('disciplines', [{'id': 'D1', 'code': 'M1', 'name': 'Cờ vua', 'is_exempt': 'False'}])
+    app.save_rows('contents', [{'id': 'C1', 'discipline_id': 'D1', 'name': 'Nhanh', 'gender': 'Nam & Nữ'},
+                               {'id': 'C2', 'discipline_id': 'D1', 'name': 'Chớp', 'gender': 'Nam & Nữ'}])
+    app.get_content_catalog_store().invalidate()
+    feed = app.get_change_feed()
+    reg = {'unitId': 'U1', 'unitName': 'Lớp 1', 'athleteName': 'An', 'gender': 'Nam', 'registered_contents': 'Cờ vua: Nhanh'}
+    app.save_rows('registrations', [reg])
+    app.sync_registration_entries(reg['id'], 'U1', ['Cờ vua: Nhanh'])
+    assert app.update_row_data('registrations', reg['id'], {'registered_contents': 'Cờ vua: Chớp'})
+    app.sync_registration_entries(reg['id'], 'U1', ['Cờ vua: Chớp'])
+
+    def logged(op):
+        return next(e for e in feed.latest(sheet_name='registrations', doc_id=reg['id'])[0] if e['op'] == op)
+
+    assert app.undo_change(logged('update'))
+    assert list(app.get_entries(reg['id'])['content_id']) == ['C1']
+    assert app.undo_change(logged('insert'))
+    assert app.get_entries(reg['id']).empty
+    assert reg['id'] not in set(app.get_data('registrations')['id'])
+
+
+def test_feed_cycle_keeps_unchanged_sheets_fresh(app, feed, monkeypatch):
+    cache = app.SheetCache(ttl=60)
+    for name in app.EXPECTED_HEADERS:
+        cache.put(name, frame(app, []) if name == 'changes' else pd.DataFrame())
+    refresher = app.BackgroundRefresher.__new__(app.BackgroundRefresher)
+    refresher.cache, refresher.feed, refresher.cursor = cache, feed, (0, '')
+    refresher._metrics, refresher._lock = {}, app.threading.Lock()
+    loaded = []
+    rows = frame(app, [entry(app, 1, sheet='units')])
+    monkeypatch.setattr(app, 'load_sheet', lambda name: loaded.append(name) or (rows if name == 'changes' else pd.DataFrame()))
+    clock = app.time.monotonic() + 61
+    monkeypatch.setattr(app.time, 'monotonic', lambda: clock)
+    refresher.refresh_from_feed()
+    assert loaded == ['changes', 'units']
+    assert all(cache.get(name) is not None for name in app.EXPECTED_HEADERS)
+
+
+def test_undo_refuses_when_row_was_edited_afterwards(app):
+    feed = app.get_change_feed()
+    unit = {'name': 'Lớp A', 'manager': 'M', 'registrationCode': 'UNDO01'}
+    app.save_rows('units', [unit])
+    assert app.update_row_data('units', unit['id'], {'name': 'Lớp B'})
+    assert app.update_row_data('units', unit['id'], {'name': 'Lớp C'})
+    first = next(e for e in reversed(feed.latest(sheet_name='units', doc_id=unit['id'])[0])
+                 if e['op'] == 'update')
+    assert first['after'] == {'name': 'Lớp B'}
+    assert not app.undo_change(first)
+    assert app.stored_rows('units', [unit['id']])[unit['id']]['name'] == 'Lớp C'
+
+
+def test_idle_feed_poll_reads_only_new_rows(app, fake, remote, monkeypatch):
+    values = fake._spreadsheets[app.SPREADSHEET_NAME]._worksheets['changes']._values
+    values.extend([entry(app, n)[h] for h in app.EXPECTED_HEADERS['changes']] for n in range(2000))
+    monkeypatch.setattr(app, 'get_storage', lambda: remote)
+    refresher = app.BackgroundRefresher.__new__(app.BackgroundRefresher)
+    refresher.cache, refresher.feed, refresher.cursor = app.SheetCache(ttl=60), app.ChangeFeed(interval=3600), None
+    refresher._metrics, refresher._lock = {}, app.threading.Lock()
+    refresher.refresh_sheet('changes')
+    refresher.refresh_sheet('config')
+    refresher.cursor = refresher.feed.end_cursor(refresher.cache.peek('changes'))
+    fake.reset_counters()
+    refresher.refresh_from_feed()
+    assert fake.calls_by_method == {'batch_get': 1}
+    values.append([entry(app, 2000, sheet='config')[h] for h in app.EXPECTED_HEADERS['changes']])
+    fake.reset_counters()
+    refresher.refresh_from_feed()
+    # Cột id + các dòng mới của 'changes', rồi tải lại sheet config vừa đổi
+    assert fake.calls_by_method == {'batch_get': 2, 'get_all_values': 1}
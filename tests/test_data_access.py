@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+
+
+def test_fetch_sheet_does_not_hide_programming_errors(app, monkeypatch):
+    def broken(sheet_name):
+        raise KeyError('cột lạ')
+
+    monkeypatch.setattr(app, 'load_sheet', broken)
+    with pytest.raises(KeyError):
+        app.fetch_sheet(app.SheetCache(ttl=60), 'units')
+
+
+def test_fetch_sheet_serves_stale_copy_on_storage_error(app, monkeypatch):
+    def down(sheet_name):
+        raise app.StorageError('mất kết nối')
+
+    cache = app.SheetCache(ttl=0)
+    cache.put('units', pd.DataFrame({'id': ['U1']}))
+    monkeypatch.setattr(app, 'load_sheet', down)
+    df, source = app.fetch_sheet(cache, 'units')
+    assert (list(df['id']), source) == (['U1'], 'bản cũ')
+
+
+def test_set_config_does_not_append_after_unexpected_error(app, monkeypatch):
+    app.set_config('tournament_name', 'Giải A')
+    storage = app.get_storage()
+
+    def broken(*args, **kwargs):
+        raise TypeError('lỗi lập trình')
+
+    monkeypatch.setattr(storage, 'update_row', broken)
+    with pytest.raises(TypeError):
+        app.set_config('tournament_name', 'Giải B')
+    monkeypatch.undo()
+    app.get_sheet_cache().invalidate('config')
+    assert list(app.get_data('config')['key']).count('tournament_name') == 1
+
+
+def test_exports_are_built_in_memory(app):
+    import io
+    from openpyxl import load_workbook
+
+    csv = app.build_export('registrations', 'csv')
+    assert csv.startswith('﻿athleteName,'.encode('utf-8'))
+    xlsx = app.build_export('start_lists', 'xlsx')
+    assert load_workbook(io.BytesIO(xlsx), read_only=True).sheetnames
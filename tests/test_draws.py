@@ -0,0 +1,66 @@
+from collections import Counter
+
+import draws
+
+
+def entries(n, units=4):
+    return [(f"E{i:03d}", f"U{i % units}") for i in range(n)]
+
+
+def first_meeting_round(layout, a, b):
+    """Vòng (tính từ 0) mà hai vị trí của a và b thuộc cùng nhánh"""
+    pa, pb = layout['slots'].index(a), layout['slots'].index(b)
+    r = 0
+    while pa != pb:
+        pa, pb, r = pa // 2, pb // 2, r + 1
+    return r
+
+
+def test_seed_order():
+    assert draws.seed_order(8) == [1, 8, 4, 5, 2, 7, 3, 6]
+
+
+def test_draw_is_reproducible_per_seed():
+    task = (('D1', 'C1'), entries(13), draws.KNOCKOUT, 8, '777')
+    assert draws.draw_content(task) == draws.draw_content(task)
+    other = draws.draw_content((('D1', 'C1'), entries(13), draws.KNOCKOUT, 8, '778'))
+    assert other != draws.draw_content(task)
+
+
+def test_knockout_places_everyone_and_byes_never_meet():
+    layout = draws.draw_knockout(entries(11), draws.content_rng('1', 'D', 'C'))
+    assert len(layout['slots']) == 16
+    assert sorted(s for s in layout['slots'] if s) == sorted(e for e, _ in entries(11))
+    pairs = zip(layout['slots'][::2], layout['slots'][1::2])
+    assert all(a or b for a, b in pairs)
+
+
+def test_knockout_teammates_split_across_halves():
+    # 2 đơn vị × 4 VĐV: mỗi nửa sơ đồ có đúng 2 VĐV mỗi đơn vị
+    layout = draws.draw_knockout(entries(8, units=2), draws.content_rng('1', 'D', 'C'))
+    units = dict(entries(8, units=2))
+    for half in (layout['slots'][:4], layout['slots'][4:]):
+        assert Counter(units[e] for e in half) == Counter({'U0': 2, 'U1': 2})
+    assert first_meeting_round(layout, 'E000', 'E002') >= 1
+
+
+def test_heats_balanced_and_teammates_spread():
+    layout = draws.draw_heats(entries(20, units=5), draws.content_rng('1', 'D', 'C'), heat_size=8)
+    sizes = [len(h) for h in layout['heats']]
+    assert len(sizes) == 3 and max(sizes) - min(sizes) <= 1
+    units = dict(entries(20, units=5))
+    for heat in layout['heats']:
+        assert max(Counter(units[e] for e in heat).values()) <= 2
+
+
+def test_bracket_progression_and_ranks():
+    layout = {'format': draws.KNOCKOUT, 'slots': ['A', 'B', 'C', ''], 'winners': []}
+    rounds = draws.bracket_rounds(layout)
+    assert rounds[0] == [('A', 'B', None), ('C', '', 'C')]
+    assert rounds[1] == [(None, 'C', None)]
+    layout = draws.set_winner(layout, 0, 0, 'B')
+    layout = draws.set_winner(layout, 1, 0, 'C')
+    assert draws.bracket_ranks(layout) == {'C': 'Nhất', 'B': 'Nhì', 'A': 'Ba'}
+    # Sửa kết quả vòng trước: người thắng chung kết cũ không còn hợp lệ nếu không còn trong trận
+    layout = draws.set_winner(layout, 0, 0, 'A')
+    assert draws.bracket_rounds(layout)[1] == [('A', 'C', 'C')]
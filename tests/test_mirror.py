@@ -0,0 +1,79 @@
+from conftest import worksheet_rows
+
+
+def local_row(mirror, sheet_name, doc_id):
+    return next((r for r in mirror.local.read_records(sheet_name) if r['id'] == doc_id), None)
+
+
+def test_offline_writes_are_pushed_when_back_online(app, fake, mirror):
+    real_call = fake.api_call
+
+    def down(method):
+        raise ConnectionError("network down")
+
+    fake.api_call = down
+    mirror.append_rows('units', [{'id': 'UNEW', 'name': 'Lớp mới', 'version': '1'}])
+    assert mirror.update_row('units', 'U00000', {'name': 'Sửa offline'}, expected_version='1')
+    mirror.sync()
+    assert mirror.online is False and mirror.pending_count() == 2
+    assert local_row(mirror, 'units', 'U00000')['name'] == 'Sửa offline'
+
+    fake.api_call = real_call
+    mirror.sync()
+    assert mirror.online and mirror.pending_count() == 0
+    remote = {r['id']: r for r in worksheet_rows(fake, app, 'units')}
+    assert remote['UNEW']['name'] == 'Lớp mới'
+    assert (remote['U00000']['name'], remote['U00000']['version']) == ('Sửa offline', '2')
+
+
+def test_conflict_higher_version_wins(app, fake, mirror):
+    ws = fake._spreadsheets[app.SPREADSHEET_NAME]._worksheets['units']
+    header = ws._values[0]
+    mirror.update_row('units', 'U00001', {'name': 'Sửa cục bộ'}, expected_version='1')
+    row = next(r for r in ws._values if r[0] == 'U00001')
+    row[header.index('name')], row[header.index('version')] = 'Sửa trên Sheets', '3'
+    mirror.sync()
+    assert mirror.conflicts[0]['Kết quả'] == "giữ bản trên Google Sheets"
+    assert local_row(mirror, 'units', 'U00001')['name'] == 'Sửa trên Sheets'
+
+
+def test_local_edit_survives_remote_delete(app, fake, mirror):
+    mirror.update_row('units', 'U00002', {'name': 'Sửa cục bộ'}, expected_version='1')
+    ws = fake._spreadsheets[app.SPREADSHEET_NAME]._worksheets['units']
+    ws._values = [r for r in ws._values if r[0] != 'U00002']
+    mirror.sync()
+    remote = [r for r in worksheet_rows(fake, app, 'units') if r['id'] == 'U00002']
+    assert [(r['name'], r['version']) for r in remote] == [('Sửa cục bộ', '2')]
+    assert mirror.local.get_row('units', 'U00002')['name'] == 'Sửa cục bộ'
+    assert mirror.conflicts[0]['Kết quả'].startswith("dòng đã bị xóa trên Google Sheets")
+
+
+def test_rejected_op_moves_to_dead_letter(app, fake, mirror, monkeypatch):
+    import gspread
+    from fake_sheets import FakeResponse
+
+    real_call = fake.api_call
+
+    def reject_updates(method):
+        if method == 'batch_update':
+            raise gspread.exceptions.APIError(FakeResponse(400, "Invalid value"))
+        real_call(method)
+
+    monkeypatch.setattr(fake, 'api_call', reject_updates)
+    mirror.update_row('units', 'U00003', {'name': 'Bị từ chối'}, expected_version='1')
+    mirror.append_rows('units', [{'id': 'UAFTER', 'name': 'Lệnh sau', 'version': '1'}])
+    mirror.sync()
+    assert mirror.online and mirror.pending_count() == 0
+    assert any(r['id'] == 'UAFTER' for r in worksheet_rows(fake, app, 'units'))
+    (dead,) = mirror.dead_letters()
+    assert dead['Sheet'] == 'units' and 'Invalid value' in dead['Lỗi']
+
+
+def test_consecutive_deletes_are_pushed_as_one_batch(app, fake, mirror):
+    assert mirror.delete_rows('entries', ['E0000005', 'E0000006', 'E0000007', 'NOPE']) == ['NOPE']
+    assert local_row(mirror, 'entries', 'E0000006') is None
+    fake.reset_counters()
+    mirror.sync()
+    assert mirror.pending_count() == 0
+    assert fake.calls_by_method.get('delete_rows') == 1
+    assert not {'E0000005', 'E0000006', 'E0000007'} & {r['id'] for r in worksheet_rows(fake, app, 'entries')}
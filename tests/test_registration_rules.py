@@ -0,0 +1,88 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+RUN, RELAY, CHESS = ('DK', 'C100'), ('DK', 'CTS'), ('CV', 'CNH')
+
+
+@pytest.fixture
+def rules(app, storage):
+    app.save_rows('disciplines', [{'id': 'DK', 'code': 'DK', 'name': 'Điền kinh', 'is_exempt': 'False'},
+                                  {'id': 'CV', 'code': 'CV', 'name': 'Cờ vua', 'is_exempt': 'True'}])
+    app.save_rows('contents', [{'id': 'C100', 'discipline_id': 'DK', 'name': '100m', 'gender': 'Nam'},
+                               {'id': 'CTS', 'discipline_id': 'DK', 'name': 'Tiếp sức', 'gender': 'Nam & Nữ'},
+                               {'id': 'CNH', 'discipline_id': 'CV', 'name': 'Nhanh', 'gender': 'Nam & Nữ'}])
+    app.set_config('max_per_content', 1)
+    app.set_config('age_groups', 'U11: 2015-2016; U14: 2012-2014')
+    app.save_rows('registrations', [
+        {'id': 'R1', 'unitId': 'U1', 'unitName': 'Lớp 1', 'athleteName': 'An', 'gender': 'Nam', 'cccd': '001',
+         'studentId': 'HS1', 'dob': '2015-05-01', 'ageGroup': 'U11'},
+        {'id': 'R2', 'unitId': 'U2', 'unitName': 'Lớp 2', 'athleteName': 'Bích', 'gender': 'Nữ', 'cccd': '1',
+         'studentId': 'HS2', 'dob': '2010-01-01', 'ageGroup': 'U11'},
+    ])
+    app.save_rows('entries', [
+        {'registrationId': 'R1', 'unitId': 'U1', 'discipline_id': 'DK', 'content_id': 'C100', 'rank': ''},
+        {'registrationId': 'R1', 'unitId': 'U1', 'discipline_id': 'CV', 'content_id': 'CNH', 'rank': ''},
+        {'registrationId': 'R2', 'unitId': 'U2', 'discipline_id': 'DK', 'content_id': 'C100', 'rank': ''},
+    ])
+    return app.RegistrationRules()
+
+
+def athlete(**fields):
+    return dict({'gender': 'Nam', 'cccd': '', 'studentId': '', 'dob': pd.Timestamp('2015-03-03'), 'ageGroup': 'U11'}, **fields)
+
+
+def test_validate_gender_of_content(rules):
+    assert rules.validate(athlete(gender='Nữ'), [RELAY], 'U3') == []
+    assert rules.validate(athlete(gender='Nữ'), [RUN], 'U3') == ["Điền kinh: 100m chỉ dành cho VĐV Nam"]
+
+
+def test_validate_quota_per_unit_skips_exempt_disciplines(rules):
+    assert rules.validate(athlete(), [RUN], 'U1') == ["Đơn vị đã đủ 1 VĐV cho nội dung Điền kinh: 100m"]
+    assert rules.validate(athlete(), [RUN], 'U3') == []
+    # Cờ vua không giới hạn; VĐV sửa thông tin khác thì nội dung đã có không bị tính lại
+    assert rules.validate(athlete(), [CHESS], 'U1') == []
+    assert rules.validate(athlete(), [RUN, CHESS], 'U1', registration_id='R1') == []
+
+
+def test_validate_duplicate_cccd_across_units(rules):
+    problems = rules.validate(athlete(cccd='0001'), [], 'U3')
+    assert problems == ["CCCD 0001 đã được đăng ký (Lớp 1, Lớp 2)"]
+    assert rules.validate(athlete(cccd='001'), [], 'U1', registration_id='R1') == ["CCCD 001 đã được đăng ký (Lớp 2)"]
+
+
+def test_age_group_from_dob(rules):
+    assert rules.derive_age_group(date(2015, 5, 1)) == 'U11'
+    assert rules.derive_age_group(date(2013, 1, 1)) == 'U14'
+    assert rules.derive_age_group(date(2000, 1, 1)) is None
+    dob = pd.Series(pd.to_datetime(['2016-12-31', '2012-01-01', '2017-01-01']))
+    assert rules.derive_age_groups(dob).fillna('').tolist() == ['U11', 'U14', '']
+    assert rules.validate(athlete(ageGroup='U14'), [], 'U3') == ["Năm sinh không thuộc lứa tuổi U14 (2012-2014)"]
+
+
+def test_batch_errors(rules):
+    df = pd.DataFrame({'cccd': ['001', '', '', ''], 'studentId': ['', 'X', 'X', ''],
+                       'dob': ['01/05/2015', '2015-01-01', '2016-01-01', '2013-01-01'], 'ageGroup': ['U11', 'U11', 'U11', 'U11']})
+    picks = pd.DataFrame({'idx': [1, 2, 1, 2], 'discipline_id': ['DK', 'DK', 'CV', 'CV'], 'content_id': ['CTS', 'CTS', 'CNH', 'CNH'],
+                          'label': ['Điền kinh: Tiếp sức'] * 2 + ['Cờ vua: Nhanh'] * 2})
+    errors = rules.batch_errors(df, picks, 'U3')
+    assert errors.tolist() == ["CCCD đã được đăng ký; ",
+                               "Mã học sinh trùng trong file; ",
+                               "Mã học sinh trùng trong file; Vượt hạn mức 1 VĐV/nội dung: Điền kinh: Tiếp sức; ",
+                               "Năm sinh không thuộc lứa tuổi; "]
+
+
+def test_audit(app, rules):
+    app.save_rows('registrations', [{'id': 'R3', 'unitId': 'U1', 'unitName': 'Lớp 1', 'athleteName': 'Cường', 'gender': 'Nam',
+                                     'cccd': '3', 'studentId': 'HS3', 'dob': '2016-02-02', 'ageGroup': 'U11'}])
+    app.save_rows('entries', [{'registrationId': 'R3', 'unitId': 'U1', 'discipline_id': 'DK', 'content_id': 'C100', 'rank': ''},
+                              {'registrationId': 'R3', 'unitId': 'U1', 'discipline_id': 'CV', 'content_id': 'CNH', 'rank': ''}])
+    found = {(r['Luật'], r['VĐV'], r['Đơn vị'], r['Chi tiết']) for r in rules.audit().to_dict('records')}
+    assert found == {
+        ("Trùng CCCD", 'An', 'Lớp 1', "CCCD 001"),
+        ("Trùng CCCD", 'Bích', 'Lớp 2', "CCCD 1"),
+        ("Sai giới tính", 'Bích', 'Lớp 2', "Điền kinh: 100m (Nam)"),
+        ("Vượt hạn mức", '', 'Lớp 1', "Điền kinh: 100m: 2/1 VĐV"),
+        ("Sai lứa tuổi", 'Bích', 'Lớp 2', "U11: năm sinh 2010"),
+    }
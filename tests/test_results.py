@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def athlete(app):
+    app.save_rows('disciplines', [{'id': 'DR1', 'code': 'R1', 'name': 'Bơi', 'is_exempt': 'False'}])
+    app.save_rows('contents', [{'id': 'CR1', 'discipline_id': 'DR1', 'name': '50m', 'gender': 'Nam & Nữ'}])
+    app.get_content_catalog_store().invalidate()
+    reg = {'unitId': 'UR1', 'unitName': 'Lớp R', 'athleteName': 'Bình', 'gender': 'Nam', 'registered_contents': 'Bơi: 50m'}
+    app.save_rows('registrations', [reg])
+    app.sync_registration_entries(reg['id'], 'UR1', ['Bơi: 50m'])
+    entry_id = app.get_entries(reg['id'])['id'].iloc[0]
+    yield reg, entry_id
+    app.delete_registration(reg['id'])
+
+
+def test_result_import_applies_plan(app, athlete):
+    reg, entry_id = athlete
+    plan = app.plan_result_import(pd.DataFrame([{'athleteId': reg['id'], 'content': 'Bơi: 50m', 'rank': 'Nhất'}]))
+    assert app.apply_result_import(plan) == 1
+    assert app.get_entries(reg['id'])['rank'].astype(str).tolist() == ['Nhất']
+
+
+def test_result_import_does_not_overwrite_later_edit(app, athlete):
+    reg, entry_id = athlete
+    plan = app.plan_result_import(pd.DataFrame([{'athleteId': reg['id'], 'content': 'Bơi: 50m', 'rank': 'Nhất'}]))
+    assert app.update_rows_data('entries', {entry_id: {'rank': 'Nhì'}}) == []
+    assert app.apply_result_import(plan) == 0
+    assert app.get_entries(reg['id'])['rank'].astype(str).tolist() == ['Nhì']
@@ -0,0 +1,85 @@
+import pytest
+
+
+def sheet_values(fake, app, sheet_name):
+    return fake._spreadsheets[app.SPREADSHEET_NAME]._worksheets[sheet_name]._values
+
+
+def test_delta_sync_sees_in_place_edit_of_unversioned_sheet(app, fake, remote):
+    assert {r['key']: r['value'] for r in remote.read_records('config')}['deadline'] == '2026-12-31'
+    row = next(r for r in sheet_values(fake, app, 'config') if r[0] == 'deadline')
+    row[1] = '2027-01-15'
+    assert {r['key']: r['value'] for r in remote.read_records('config')}['deadline'] == '2027-01-15'
+
+
+def test_delta_sync_fetches_only_rows_with_new_version(app, fake, remote):
+    remote.read_records('units')
+    values = sheet_values(fake, app, 'units')
+    header = values[0]
+    row = next(r for r in values if r[0] == 'U00002')
+    row[header.index('name')], row[header.index('version')] = 'Sửa tay', '2'
+    names = {r['id']: r['name'] for r in remote.read_records('units')}
+    assert names['U00002'] == 'Sửa tay'
+
+
+def change_row(app, n):
+    return [f"{n:020d}", '', 'other', 'x', 'units', 'U00001', 'update', '{}', '{}']
+
+
+def test_append_only_log_reads_only_new_rows(app, fake, remote):
+    sheet_values(fake, app, 'changes').extend(change_row(app, n) for n in range(5000))
+    remote.read_records('changes')
+    fake.reset_counters()
+    assert len(remote.read_records('changes')) == 5000
+    assert fake.calls_by_method == {'batch_get': 1}
+    sheet_values(fake, app, 'changes').append(change_row(app, 5000))
+    fake.reset_counters()
+    assert remote.read_records('changes')[-1]['id'] == f"{5000:020d}"
+    assert fake.calls_by_method == {'batch_get': 2}
+
+
+def test_delete_rows_removes_each_contiguous_span_in_one_call(app, fake, remote):
+    remote.read_records('entries')
+    doomed = ['E0000002', 'E0000003', 'E0000004', 'E0000010']
+    fake.reset_counters()
+    assert remote.delete_rows('entries', doomed) == []
+    assert fake.calls_by_method == {'batch_get': 1, 'delete_rows': 2}
+    left = [r[0] for r in sheet_values(fake, app, 'entries')[1:]]
+    assert not set(doomed) & set(left) and len(left) == 38 - 4
+    # Chỉ mục dòng đã dịch đúng: sửa một dòng phía dưới trúng đúng dòng
+    assert remote.update_row('entries', 'E0000011', {'rank': 'Nhất'}, expected_version='1')
+    assert next(r for r in sheet_values(fake, app, 'entries') if r[0] == 'E0000011')[5] == 'Nhất'
+    assert [r['id'] for r in remote.read_records('entries')] == left
+
+
+def test_delete_rows_conflict_deletes_nothing(app, fake, remote):
+    with pytest.raises(app.ConflictError):
+        remote.delete_rows('entries', ['E0000000', 'E0000001'], expected_versions={'E0000000': '1', 'E0000001': '7'})
+    assert len(sheet_values(fake, app, 'entries')) == 39
+
+
+def test_delete_registration_removes_entries_in_one_batch(app, fake, remote, monkeypatch):
+    monkeypatch.setattr(app, 'get_storage', lambda: remote)
+    app.get_sheet_cache().invalidate()
+    try:
+        assert len(app.get_entries('A000000')) == 2
+        fake.reset_counters()
+        assert app.delete_registration('A000000')
+        # Một lệnh xóa VĐV, một lệnh cho đoạn entries liền nhau của VĐV đó
+        assert fake.calls_by_method['delete_rows'] == 2
+        assert app.get_entries('A000000').empty
+    finally:
+        app.get_sheet_cache().invalidate()
+
+
+def test_sync_headers_logs_and_keeps_existing_headers_on_storage_error(app, caplog):
+    class Worksheet:
+        def row_values(self, row):
+            return ['id', 'name']
+
+        def update_cell(self, row, col, value):
+            raise app.StorageError("Google Sheets từ chối lệnh update_cell")
+
+    with caplog.at_level('ERROR', logger='quanlygd'):
+        assert app.sync_headers(Worksheet(), 'systems') == ['id', 'name']
+    assert "Lỗi sync header sheet systems" in caplog.text
@@ -0,0 +1,45 @@
+import pytest
+
+
+@pytest.fixture
+def index(app):
+    index = app.UnitLoginIndex()
+    index._by_code = {'ABC123': {'id': 'U1', 'name': 'Lớp 1', 'registrationCode': 'ABC123'}}
+    index._built_at = app.time.monotonic()
+    return index
+
+
+ALICE = [('session', 'a'), ('address', '10.0.0.1')]
+BOB = [('session', 'b'), ('address', '10.0.0.1')]
+
+
+def test_every_wrong_code_counts_per_session(app, index):
+    for n in range(index.MAX_FAILURES):
+        assert index.login(f"X{n}", ALICE)[1] == 'not_found'
+    assert index.login('ABC123', ALICE) == (None, 'locked')
+    assert index.seconds_locked(ALICE) > 0
+    # Phiên khác cùng IP chưa chạm giới hạn theo IP
+    assert index.login('ABC123', BOB)[1] == 'ok'
+
+
+def test_successful_login_does_not_reset_failures(app, index):
+    for n in range(index.MAX_FAILURES - 1):
+        index.login(f"X{n}", ALICE)
+    assert index.login('abc123', ALICE)[1] == 'ok'
+    assert index.login('X9', ALICE)[1] == 'not_found'
+    assert index.login('ABC123', ALICE)[1] == 'locked'
+
+
+def test_address_limit_spans_sessions(app, index):
+    for n in range(index.MAX_FAILURES_PER_ADDRESS):
+        index.login(f"X{n}", [('session', str(n)), ('address', '10.0.0.2')])
+    assert index.login('ABC123', [('session', 'new'), ('address', '10.0.0.2')])[1] == 'locked'
+
+
+def test_expired_failures_are_evicted(app, index, monkeypatch):
+    for n in range(50):
+        index.login('X', [('session', str(n))])
+    later = app.time.monotonic() + index.LOCK_SECONDS + 1
+    monkeypatch.setattr(app.time, 'monotonic', lambda: later)
+    assert index.login('ABC123', ALICE)[1] == 'ok'
+    assert index._failures == {}
@@ -0,0 +1,40 @@
+import gspread
+import pytest
+from fake_sheets import FakeResponse
+
+from conftest import worksheet_rows
+
+
+@pytest.fixture
+def queue(app, remote, tmp_path):
+    return app.WriteBehindQueue(remote, str(tmp_path / 'journal.jsonl'), interval=3600)
+
+
+def test_append_after_lost_response_is_not_duplicated(app, fake, queue, monkeypatch):
+    ws = fake._spreadsheets[app.SPREADSHEET_NAME]._worksheets['units']
+    real_append = ws.append_rows
+
+    def append_then_fail(values, **kwargs):
+        # Sheets đã ghi nhưng phản hồi bị mất (503)
+        real_append(values, **kwargs)
+        raise gspread.exceptions.APIError(FakeResponse(503, "Backend error"))
+
+    queue.append_rows('units', [{'id': 'UW1', 'name': 'Lớp W1'}, {'id': 'UW2', 'name': 'Lớp W2'}])
+    monkeypatch.setattr(ws, 'append_rows', append_then_fail)
+    with pytest.raises(app.ServiceUnavailableError):
+        queue.flush()
+    assert queue.pending_count() == 2
+    monkeypatch.setattr(ws, 'append_rows', real_append)
+    queue.flush()
+    assert queue.pending_count() == 0
+    assert [r['id'] for r in worksheet_rows(fake, app, 'units')].count('UW1') == 1
+
+
+def test_update_rows_reports_unknown_ids(app, queue):
+    queue.append_rows('units', [{'id': 'UQUEUED', 'name': 'Chưa đẩy'}])
+    missing = queue.update_rows('units', {'U00000': {'name': 'A'}, 'UQUEUED': {'name': 'B'}, 'NOPE': {'name': 'C'}})
+    assert missing == ['NOPE']
+    assert queue.pending_count() == 3
+    queue.flush()
+    names = {r['id']: r['name'] for r in queue.read_records('units')}
+    assert (names['U00000'], names['UQUEUED']) == ('A', 'B') and 'NOPE' not in names